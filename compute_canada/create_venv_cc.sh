@@ -59,16 +59,19 @@ apptainer exec \
 
 
 # ────────────────────────────────────
-# 4) Tar up each env and copy it back
+# 4) Export the envs as bundles (one .tar.gz per env + bundles.json)
 # ────────────────────────────────────
-for envdir in "$WORKDIR"/eval_venvs/gcham_venv_*; do
-  name=$(basename "$envdir")
-  tarball="$WORKDIR/${name}.tar.gz"
-
-  # 1) create the tarball
-  tar -czf "$tarball" \
-      -C "$WORKDIR/eval_venvs" "$name"
-
-  # 2) copy it back to your storage area
-  cp "$tarball" "$ENV_STORAGE_PATH/"
-done
\ No newline at end of file
+apptainer exec \
+  --bind "$WORKDIR:/app/repo" \
+  --bind "$ENV_STORAGE_PATH:/app/bundles" \
+  --env PYENV_VERSION=3.10.14 \
+  "$WORKDIR/gc_1.0.sif" \
+  bash -lc "\
+    cd /app/repo && \
+    source eval_main_venv/bin/activate && \
+    python src/create_venvs.py export \
+      --dataset dataset/final_fix_dataset.jsonl \
+      --base_path eval_venvs \
+      --bundle_dir /app/bundles \
+      --start ${START} \
+      --end   ${END}"
@@ -38,16 +38,10 @@ if [ ! -f "$WORKDIR/gc_1.0.sif" ]; then
 fi
 
 
-# 1) Copy your tarballs into fast local disk
-cp $ENV_STORAGE_PATH/gcham_venv_*.tar.gz "$WORKDIR/eval_venvs/"
-
-# 2) Unpack each one
-for t in gcham_venv_*.tar.gz; do
-  tar -xzf "$t"
-done
-
+# 1) Unpack the env bundles into fast local disk (checksums are verified)
 apptainer exec \
     --bind "$WORKDIR:/app/repo" \
+    --bind "$ENV_STORAGE_PATH:/app/bundles" \
     --env PYENV_VERSION=3.10.14 \
     --env REQUESTS_CA_BUNDLE=/etc/ssl/certs/ca-certificates.crt \
     gc_1.0.sif \
@@ -55,6 +49,11 @@ apptainer exec \
       cd /app/repo && \
       python -m venv eval_main_venv && \
       source eval_main_venv/bin/activate && \
+      python src/create_venvs.py import \
+        --dataset dataset/final_fix_dataset.jsonl \
+        --base_path eval_venvs \
+        --bundle_dir /app/bundles \
+        --jobs 4 && \
       python verify_dataset.py \
         dataset/final_fix_dataset.jsonl \
         eval_venvs \
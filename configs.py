@@ -107,5 +107,74 @@ def get_evaluate_args():
         "--n-jobs", type=int, default=-1
     )  # number of jobs to run in parallel
     parser.add_argument("--feedback", action="store_true")
+    parser.add_argument(
+        "--env-budget", type=str, default=None
+    )  # disk budget of the environment store, e.g. 200G
+    parser.add_argument(
+        "--env-bundle-dir", type=str, default=None
+    )  # re-import evicted environments from these bundles
+    parser.add_argument(
+        "--restore-envs", action="store_true", default=False
+    )  # rebuild evicted environments
+    parser.add_argument(
+        "--env-wheelhouse", type=str, default=None
+    )  # environments built during the evaluation install only from this wheelhouse (--no-index)
+    parser.add_argument(
+        "--env-clone",
+        type=str,
+        choices=["none", "hardlink", "reflink", "copy"],
+        default="none",
+    )  # clone environments built during the evaluation from templates
+    parser.add_argument(
+        "--env-interpreter", type=str, choices=["copy", "shared"], default="copy"
+    )  # copy or symlink the interpreter of environments built during the evaluation
+    parser.add_argument(
+        "--env-layers", action="store_true", default=False
+    )  # environments built during the evaluation use the shared library layers
+    parser.add_argument(
+        "--verify-envs", type=str, choices=["quick", "full"], default=None
+    )  # check the environments before evaluating (full: also file hashes)
+    parser.add_argument(
+        "--exec-backend",
+        type=str,
+        choices=["subprocess", "zygote"],
+        default="subprocess",
+    )  # run candidates in new interpreters or in forks of a warm one per environment
+    parser.add_argument(
+        "--scratch-backend",
+        type=str,
+        choices=["disk", "tmpfs", "memfd", "stdin"],
+        default="disk",
+    )  # where candidate scripts are stored while they run: --scratch, tmpfs, in memory or stdin
+    parser.add_argument(
+        "--sandbox-threads", type=int, default=-1
+    )  # threads of the BLAS/OpenMP pools of each run: -1 = no limit (default), 0 = CPUs / jobs
+    parser.add_argument(
+        "--pin-cpus", action="store_true", default=False
+    )  # pin each run to CPUs of its own
+    parser.add_argument(
+        "--adaptive-timeouts", action="store_true", default=False
+    )  # per-example timeouts from the reference runtimes (python -m src.timeouts calibrate)
+    parser.add_argument(
+        "--timeout-multiplier", type=float, default=5.0
+    )  # adaptive timeout = multiplier * reference runtime
+    parser.add_argument(
+        "--timeout-floor", type=float, default=10.0
+    )  # adaptive timeouts are at least this many seconds
+    parser.add_argument(
+        "--output-limit", type=str, default="64K"
+    )  # bytes kept of the stdout and of the stderr of each run (first and last ones), 0 = all
+    parser.add_argument(
+        "--compress-logs", action="store_true", default=False
+    )  # store the error logs compressed in the CSV (python -m src.capture expand)
+    parser.add_argument(
+        "--result-cache", type=str, default=None
+    )  # SQLite cache of execution results, reused across runs
+    parser.add_argument(
+        "--build-envs", action="store_true", default=False
+    )  # build missing environments while evaluating the ready ones
+    parser.add_argument(
+        "--build-jobs", type=int, default=2
+    )  # number of environments built in parallel with --build-envs
     args = parser.parse_args()
     return args
@@ -15,6 +15,7 @@ from transformers import AutoTokenizer
 from collections import defaultdict
 from src.sanitize import sanitize
 from src.eval_code import evaluate_model, load_outputs_from_json, prepare_eval_df
+from src.env_verify import verification_gate
 from configs import get_evaluate_args
 
 
@@ -69,6 +70,13 @@ if __name__ == "__main__":
     assert output_df is not None, "No outputs to evaluate. Exiting..."
     df = prepare_eval_df(options, df, output_df)
     print(df.head())
+    if options.verify_envs:
+        # refuse to evaluate in broken environments
+        venv_names = [f"gcham_venv_{example_id}" for example_id in df["example_id"]]
+        if not verification_gate(
+            options.base_path, venv_names, full=options.verify_envs == "full"
+        ):
+            sys.exit("Broken environments found, rebuild them with `python src/create_venvs.py rebuild`.")
     print("---Evaluation---")
     cot_str = "" if not options.cot else "_cot"
     eval_save_file = (
@@ -7,53 +7,79 @@ from tqdm import tqdm
 import pandas as pd
 import subprocess
 import tempfile
-import py_compile
 import wandb
 from concurrent.futures import ThreadPoolExecutor, as_completed
+from src.capture import compress_log, set_output_limit
+from src.env_cache import build_options, parse_size, use_environment
+from src.env_pipeline import pipelined_map
+from src.env_store import resolve_env_path
+from src.env_verify import verification_gate
 from src.eval_sample import eval_sample
+from src.result_cache import cached_run, print_session_stats
+from src.sandbox import sandbox_env, set_thread_budget
+from src.scratch import SCRATCH_BACKENDS, ScratchFile
+from src.syntax_check import check_syntax
+from src.timeouts import DEFAULT_FLOOR, DEFAULT_MULTIPLIER, Timeouts
+from src.zygote import EXEC_BACKENDS, run_python
 
-def run_script(env_path, py_file="temp.py"):
+def run_script(env_path, py_file="temp.py", backend="subprocess", cache=None, timeout=120):
+    """
+    Compile and run `py_file` (a path or a ScratchFile, see src/scratch.py) in the environment `env_path`.
+    cache: path of a result cache (see src/result_cache.py); a script that already
+    ran in the same environment is not run again.
+    timeout: in seconds (see src/timeouts.py).
+    """
     python_executable = os.path.join(env_path, "bin", "python")
     if py_file is None:
         return False, False, "", ""
 
-    parsed_code = ""
-    try:
-        with open(py_file, "r") as file:
-            parsed_code = file.read()
-    except Exception as e:
-        print(py_file, type(py_file))
-        print("Error at py_file open:", e)
-
-    error_log = ""
-    try:
-        # Try to compile the temporary file
-        py_compile.compile(py_file, doraise=True)
-        compile_code = 0  # Compilation successful
-    except py_compile.PyCompileError as e:
-        compile_code = 1  # Compilation failed due to a syntax error
-        error_log = str(e)
-    if compile_code == 0:
-        # Run the Python script within the virtual environment
-        command = [python_executable, py_file]
+    if not isinstance(py_file, ScratchFile):
+        parsed_code = ""
         try:
-            result = subprocess.run(command, capture_output=True, text=True, timeout=120)
-            exit_code = result.returncode
-            error_log = result.stderr
-        except subprocess.TimeoutExpired as e:
-            print(e)
-            exit_code = 1
-            error_log = "TimeoutError"
-    else:
-        exit_code = 1  # since Compilation failed, the script will not run
-    try:
-        os.remove(py_file)
-    except Exception as e:
-        print(e)
+            with open(py_file, "r") as file:
+                parsed_code = file.read()
+        except Exception as e:
+            print(py_file, type(py_file))
+            print("Error at py_file open:", e)
+        py_file = ScratchFile.on_disk(parsed_code, py_file)
+    parsed_code = py_file.source
+
+    def execute():
+        timed_out = False
+        # Compile in memory with the Python version of the environment
+        error_log = check_syntax(python_executable, parsed_code, py_file.name)
+        compile_code = 0 if error_log is None else 1  # 1: syntax error
+        error_log = error_log or ""
+        if compile_code == 0:
+            # Run the Python script within the virtual environment
+            try:
+                result = run_python(
+                    python_executable,
+                    py_file.args(),
+                    timeout=timeout,
+                    env=sandbox_env(env_path),
+                    backend=backend,
+                    input=py_file.input,
+                    pass_fds=py_file.pass_fds,
+                )
+                exit_code = result.returncode
+                error_log = result.stderr
+            except subprocess.TimeoutExpired as e:
+                print(e)
+                exit_code = 1
+                error_log = "TimeoutError"
+                timed_out = True
+        else:
+            exit_code = 1  # since Compilation failed, the script will not run
+        return {"passed": exit_code == 0, "compiled": compile_code == 0, "output": error_log, "timeout": timed_out}
+
+    run_result = cached_run(cache if parsed_code else None, "script", env_path, [parsed_code], execute)
+    py_file.close()
     result = {
-        "compiled_manual": bool(1 - compile_code),
-        "passed_manual": bool(1 - exit_code),
-        "output_manual": error_log,
+        "compiled_manual": run_result["compiled"],
+        "passed_manual": run_result["passed"],
+        "output_manual": run_result["output"],
+        "timeout_manual": run_result.get("timeout", False),
     }
     return result  # 1 = pass, 0 = fail
 
@@ -90,10 +116,120 @@ def get_example_id(record):
     return id
 
 
-def process_record(idx, record, starting_codes, manual_tests, env_dir, test_dir):
+def process_record(
+    idx,
+    record,
+    starting_codes,
+    manual_tests,
+    env_dir,
+    test_dir,
+    env_options=None,
+    backend="subprocess",
+    cache=None,
+    scratch="disk",
+    timeouts=None,
+):
+    """
+    Hold the environment of one JSON record while evaluating it (see src/env_cache.py).
+    env_options: optional dict with "specs" (example_id -> dataset row, to rebuild
+    evicted environments), "bundle_dir", "budget" and "build_options" for use_environment().
+    backend: "subprocess" or "zygote", how the tests are run (see src/zygote.py).
+    cache: path of a result cache to reuse the results of earlier runs (see src/result_cache.py).
+    scratch: where the scripts are stored while they run (see src/scratch.py).
+    timeouts: Timeouts of the examples (see src/timeouts.py), fixed ones if None.
+    """
+    return process_example(
+        [(idx, record)], starting_codes, manual_tests, env_dir, test_dir, env_options, backend, cache, scratch, timeouts
+    )[0]
+
+
+def process_example(
+    idx_records,
+    starting_codes,
+    manual_tests,
+    env_dir,
+    test_dir,
+    env_options=None,
+    backend="subprocess",
+    cache=None,
+    scratch="disk",
+    timeouts=None,
+):
+    """
+    Evaluate the (idx, record) pairs of one example while holding its environment,
+    like process_record(). The hidden tests of all the records run in one pytest
+    session (see src/eval_batch.py).
+    """
+    env_options = dict(env_options or {})
+    specs = env_options.pop("specs", None) or {}
+    example_id = get_example_id(idx_records[0][1])
+    with use_environment(
+        env_dir,
+        f"gcham_venv_{example_id}",
+        spec=specs.get(str(example_id)),
+        **env_options,
+    ):
+        hidden_results = {}
+        if len(idx_records) > 1:
+            hidden_results = batch_hidden_results(idx_records, env_dir, test_dir, backend, cache, scratch, timeouts)
+        return [
+            evaluate_record(
+                idx,
+                record,
+                starting_codes,
+                manual_tests,
+                env_dir,
+                test_dir,
+                backend,
+                hidden_results.get(idx),
+                cache,
+                scratch,
+                timeouts,
+            )
+            for idx, record in idx_records
+        ]
+
+
+def batch_hidden_results(idx_records, env_dir, test_dir, backend="subprocess", cache=None, scratch="disk", timeouts=None):
+    """
+    Run the hidden tests of the records of one example in one batch.
+    Returns {idx: eval_sample() result}; records that fail here are left to evaluate_record().
+    """
+    example_id = get_example_id(idx_records[0][1])
+    try:
+        example_id = int(example_id)
+        env_path = resolve_env_path(env_dir, f"gcham_venv_{example_id}")
+        with open(os.path.join(test_dir, f"test_sample_{example_id}.py"), "r") as tf:
+            test_file_content = tf.read()
+        codes = {str(idx): {"code": get_solution(record)} for idx, record in idx_records}
+        code_dict = {"test_file": test_file_content, "codes": codes}
+        timeout = timeouts.get(example_id, "hidden", 120) if timeouts else 120
+        eval_res = eval_sample(
+            example_id, env_path, code_dict, backend=backend, batch=True, cache=cache, scratch=scratch, timeout=timeout
+        )["codes"]
+    except Exception as e:
+        print(f"Error processing example (batch) {example_id}: {e}")
+        return {}
+    return {int(code_id): res for code_id, res in eval_res.items()}
+
+
+def evaluate_record(
+    idx,
+    record,
+    starting_codes,
+    manual_tests,
+    env_dir,
+    test_dir,
+    backend="subprocess",
+    hidden_result=None,
+    cache=None,
+    scratch="disk",
+    timeouts=None,
+):
     """
     Process one JSON record: run eval_sample() and return a dict
-    with example_id, code_id, output, passed, compiled, and idx.
+    with example_id, code_id, output, passed, compiled, timeout, and idx.
+    hidden_result: eval_sample() result of the hidden tests if they already ran.
     """
     example_id = get_example_id(record)
     try:
@@ -101,7 +237,7 @@ def process_record(idx, record, starting_codes, manual_tests, env_dir, test_dir)
         code = starting_codes[example_id]
         manual_test = manual_tests[example_id]
         solution = get_solution(record)
-        env_path = os.path.join(env_dir, f"gcham_venv_{example_id}")
+        env_path = resolve_env_path(env_dir, f"gcham_venv_{example_id}")
 
         test_file_path = os.path.join(test_dir, f"test_sample_{example_id}.py")
         with open(test_file_path, "r") as tf:
@@ -111,9 +247,12 @@ def process_record(idx, record, starting_codes, manual_tests, env_dir, test_dir)
             "test_file": test_file_content,
             "codes": {"solution_code": {"code": solution}},
         }
-        eval_res = eval_sample(example_id, env_path, code_dict)["codes"][
-            "solution_code"
-        ]
+        eval_res = hidden_result
+        if eval_res is None:
+            timeout = timeouts.get(example_id, "hidden", 120) if timeouts else 120
+            eval_res = eval_sample(
+                example_id, env_path, code_dict, backend=backend, cache=cache, scratch=scratch, timeout=timeout
+            )["codes"]["solution_code"]
         res = {
             "idx": idx,
             "example_id": example_id,
@@ -121,6 +260,7 @@ def process_record(idx, record, starting_codes, manual_tests, env_dir, test_dir)
             "output": eval_res.get("output", "").strip(),
             "passed": eval_res.get("pass", False),
             "compiled": eval_res.get("compile", True),
+            "timeout": eval_res.get("timeout", False),
         }
     except Exception as e:
         print(f"Error processing record (hidden) {idx}: {e}")
@@ -131,19 +271,26 @@ def process_record(idx, record, starting_codes, manual_tests, env_dir, test_dir)
             "output": f"Error: {e}",
             "passed": False,
             "compiled": False,
+            "timeout": False,
         }
     try:
-        with tempfile.TemporaryDirectory() as temp_dir:
-            test_code = solution + '\n' + manual_test
-            test_file = os.path.join(temp_dir, f"manual_test_sample_{example_id}.py")
-            with open(test_file, "w") as f:
-                f.write(test_code)
-            eval_res_manual = run_script(env_path, test_file)
+        test_code = solution + '\n' + manual_test
+        test_name = f"manual_test_sample_{example_id}.py"
+        timeout = timeouts.get(example_id, "visible", 120) if timeouts else 120
+        if scratch == "disk":
+            with tempfile.TemporaryDirectory() as temp_dir:
+                test_file = os.path.join(temp_dir, test_name)
+                with open(test_file, "w") as f:
+                    f.write(test_code)
+                eval_res_manual = run_script(env_path, test_file, backend, cache, timeout)
+        else:
+            eval_res_manual = run_script(env_path, ScratchFile(test_code, test_name, scratch), backend, cache, timeout)
         res.update(
             {
                 "output_manual": eval_res_manual.get("output_manual", "").strip(),
                 "passed_manual": eval_res_manual.get("passed_manual", False),
                 "compiled_manual": eval_res_manual.get("compiled_manual", True),
+                "timeout_manual": eval_res_manual.get("timeout_manual", False),
             }
         )
 
@@ -153,6 +300,7 @@ def process_record(idx, record, starting_codes, manual_tests, env_dir, test_dir)
             "output_manual": f"Error: {e}",
             "passed_manual": False,
             "compiled_manual": False,
+            "timeout_manual": False,
         })
     return res
 
@@ -178,7 +326,126 @@ def main():
         action="store_true",
         help="Log results to Weights & Biases (wandb)",
     )
+    parser.add_argument(
+        "--env-budget",
+        default=None,
+        help="Disk budget of the environments in env_dir (e.g. 200G); least recently used ones are evicted",
+    )
+    parser.add_argument(
+        "--env-bundle-dir",
+        default=None,
+        help="Re-import evicted environments from the bundles in this directory",
+    )
+    parser.add_argument(
+        "--restore-envs",
+        action="store_true",
+        help="Rebuild evicted environments from the dataset",
+    )
+    parser.add_argument(
+        "--env-wheelhouse",
+        default=None,
+        help="Environments built during the evaluation install only from this wheelhouse (--no-index)",
+    )
+    parser.add_argument(
+        "--env-clone",
+        choices=["none", "hardlink", "reflink", "copy"],
+        default="none",
+        help="Clone environments built during the evaluation from per-Python-version templates",
+    )
+    parser.add_argument(
+        "--env-interpreter",
+        choices=["copy", "shared"],
+        default="copy",
+        help="Copy or symlink the interpreter of environments built during the evaluation",
+    )
+    parser.add_argument(
+        "--env-layers",
+        action="store_true",
+        help="Environments built during the evaluation use the shared library layers",
+    )
+    parser.add_argument(
+        "--exec-backend",
+        choices=EXEC_BACKENDS,
+        default="subprocess",
+        help="Run each test in a new interpreter (subprocess) or in a fork of a warm interpreter per environment (zygote)",
+    )
+    parser.add_argument(
+        "--scratch-backend",
+        choices=SCRATCH_BACKENDS,
+        default="disk",
+        help="Where the scripts are stored while they run: temporary files (disk), tmpfs, in memory (memfd) or stdin",
+    )
+    parser.add_argument(
+        "--sandbox-threads",
+        type=int,
+        default=-1,
+        help="Threads of the BLAS/OpenMP pools of each test (default -1: no limit, 0: CPU count / workers)",
+    )
+    parser.add_argument(
+        "--pin-cpus",
+        action="store_true",
+        help="Pin each test to CPUs of its own while it runs",
+    )
+    parser.add_argument(
+        "--output-limit",
+        default="64K",
+        help="Bytes kept of the stdout and of the stderr of each test, its first and last ones (e.g. 1M, 0: all)",
+    )
+    parser.add_argument(
+        "--compress-logs",
+        action="store_true",
+        help="Store the outputs compressed in the CSV (expand them with `python -m src.capture expand`)",
+    )
+    parser.add_argument(
+        "--result-cache",
+        default=None,
+        help="SQLite file caching the results of the runs, so that re-evaluating the same code is free",
+    )
+    parser.add_argument(
+        "--adaptive-timeouts",
+        action="store_true",
+        help="Per-example timeouts from the reference runtimes in env_dir (python -m src.timeouts calibrate) instead of 120 s",
+    )
+    parser.add_argument(
+        "--timeout-multiplier",
+        type=float,
+        default=DEFAULT_MULTIPLIER,
+        help="Adaptive timeout of a test as a multiple of the runtime of the reference solution",
+    )
+    parser.add_argument(
+        "--timeout-floor",
+        type=float,
+        default=DEFAULT_FLOOR,
+        help="Minimum adaptive timeout in seconds",
+    )
+    parser.add_argument(
+        "--pytest-batch",
+        action="store_true",
+        help="Run the hidden tests of all the records of an example in one pytest session, "
+        "each candidate in a fork of it (see the README)",
+    )
+    parser.add_argument(
+        "--build-envs",
+        action="store_true",
+        help="Build missing environments (cheapest first) while evaluating the records whose environment is ready",
+    )
+    parser.add_argument(
+        "--build-jobs",
+        type=int,
+        default=2,
+        help="Number of environments built in parallel with --build-envs",
+    )
+    parser.add_argument(
+        "--verify-envs",
+        choices=["quick", "full"],
+        default=None,
+        help="Check the environments against their RECORDs and manifests before evaluating (full: also file hashes)",
+    )
     args = parser.parse_args()
+    threads = set_thread_budget(args.workers, args.sandbox_threads, args.pin_cpus)
+    set_output_limit(parse_size(args.output_limit))
+    if threads is not None:
+        print(f"Running tests with {threads} thread(s) each")
 
     if args.wandb:
         run = wandb.init(
@@ -191,6 +458,8 @@ def main():
     # Load JSONL records
     starting_codes = {}
     manual_tests = {}
+    specs = {}
+    rows = {}
     with open(args.data_file, "r", encoding="utf-8") as f:
         for line in f:
             line = line.strip()
@@ -198,6 +467,15 @@ def main():
                 data = json.loads(line)
                 starting_codes[int(data["example_id"])] = data["starting_code"]
                 manual_tests[int(data["example_id"])] = data["test"]
+                rows[str(data["example_id"])] = data
+                if args.restore_envs:
+                    specs[str(data["example_id"])] = data
+    env_options = {
+        "specs": specs,
+        "bundle_dir": args.env_bundle_dir,
+        "budget": parse_size(args.env_budget),
+        "build_options": build_options(args),
+    }
 
     # Load JSONL records
     outputs = []
@@ -207,20 +485,74 @@ def main():
             if line:
                 outputs.append(json.loads(line))
 
+    if args.verify_envs:
+        venv_names = sorted({f"gcham_venv_{get_example_id(rec)}" for rec in outputs})
+        if not verification_gate(
+            args.env_dir, venv_names, jobs=args.workers, full=args.verify_envs == "full"
+        ):
+            raise SystemExit("Broken environments found, rebuild them with `python src/create_venvs.py rebuild`.")
+
+    # Records evaluated together: one example at a time with --pytest-batch, else one record at a time
+    groups = {}
+    for idx, rec in enumerate(outputs):
+        key = str(get_example_id(rec)) if args.pytest_batch else idx
+        groups.setdefault(key, []).append((idx, rec))
+    timeouts = None
+    if args.adaptive_timeouts:
+        timeouts = Timeouts.load(args.env_dir, args.timeout_multiplier, args.timeout_floor)
+    work = [
+        (
+            idx_records,
+            starting_codes,
+            manual_tests,
+            args.env_dir,
+            args.test_dir,
+            env_options,
+            args.exec_backend,
+            args.result_cache,
+            args.scratch_backend,
+            timeouts,
+        )
+        for idx_records in groups.values()
+    ]
+
     results = []
-    # Kick off parallel tasks
-    with ThreadPoolExecutor(max_workers=args.workers) as exe:
-        futures = [
-            exe.submit(process_record, idx, rec, starting_codes, manual_tests, args.env_dir, args.test_dir)
-            for idx, rec in enumerate(outputs)
-        ]
-        for fut in tqdm(as_completed(futures), total=len(futures), desc="Evaluating"):
-            results.append(fut.result())
+    progress = tqdm(total=len(outputs), desc="Evaluating")
+    if args.build_envs:
+        # Build missing environments while the records of the ready ones run
+        tasks = []
+        for task_args in work:
+            example_id = str(get_example_id(task_args[0][0][1]))
+            tasks.append((rows.get(example_id, {"example_id": example_id}), task_args))
+        for _, res in pipelined_map(
+            process_example,
+            tasks,
+            args.env_dir,
+            build_jobs=args.build_jobs,
+            eval_jobs=args.workers,
+            test_dir=args.test_dir,
+            **build_options(args),
+        ):
+            results.extend(res)
+            progress.update(len(res))
+    else:
+        # Kick off parallel tasks
+        with ThreadPoolExecutor(max_workers=args.workers) as exe:
+            futures = [exe.submit(process_example, *task_args) for task_args in work]
+            for fut in as_completed(futures):
+                res = fut.result()
+                results.extend(res)
+                progress.update(len(res))
+    progress.close()
+    print_session_stats(args.result_cache)
 
     # Sort back into original order
     results.sort(key=lambda row: row["idx"])
     # Build DataFrame, drop the helper idx column
     df = pd.DataFrame(results).drop(columns=["idx"])
+    if args.compress_logs:
+        for column in ["output", "output_manual"]:
+            df[column] = df[column].map(compress_log)
 
     # Save CSV
     output_csv = os.path.splitext(args.jsonl_file)[0] + "_eval_results.csv"
@@ -245,6 +577,8 @@ def main():
     print(f"[✓] {passed}/{total} tests passed (hidden) ({passed/total:.2%})")
     compiled = df["compiled"].sum()
     print(f"[✓] {compiled}/{total} tests compiled (hidden) ({compiled/total:.2%})")
+    timed_out = df["timeout"].sum()
+    print(f"[✓] {timed_out}/{total} tests timed out (hidden) ({timed_out/total:.2%})")
 
     # fraction passed manual
     passed_manual = df["passed_manual"].sum()
@@ -252,6 +586,8 @@ def main():
     print(f"[✓] {passed_manual}/{total_manual} tests passed (visible) ({passed_manual/total_manual:.2%})")
     compiled_manual = df["compiled_manual"].sum()
     print(f"[✓] {compiled_manual}/{total_manual} tests compiled (visible) ({compiled_manual/total_manual:.2%})")
+    timed_out_manual = df["timeout_manual"].sum()
+    print(f"[✓] {timed_out_manual}/{total_manual} tests timed out (visible) ({timed_out_manual/total_manual:.2%})")
 
     if args.wandb:
         run.log({
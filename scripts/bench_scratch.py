@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+Benchmark the scratch backends (see src/scratch.py) against the on-disk path.
+
+Runs the same candidate scripts in an environment the way run_script does
+(store the script, read it back, check its syntax, run it, delete it) with
+every backend, checks that the outcomes and tracebacks match those of "disk"
+(but for the source lines, which memfd and stdin do not print), and reports
+the time spent storing and removing the scripts and in total.
+
+    python scripts/bench_scratch.py eval_venvs/gcham_venv_12 --scratch $SCRATCH --runs 200
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.sandbox import sandbox_env
+from src.scratch import SCRATCH_BACKENDS, ScratchFile
+from src.syntax_check import check_syntax
+from src.zygote import EXEC_BACKENDS, run_python
+
+CANDIDATES = [
+    "import math\nassert math.sqrt(4) == 2\nprint('ok')\n",
+    "def f(x):\n    return x / 0\n\nassert f(1) == 1\n",
+    "import sys\nprint('out')\nsys.exit(3)\n",
+    "def f(:\n    pass\n",
+]
+
+
+def traceback_summary(stderr):
+    """`stderr` without the source lines of the traceback."""
+    return "\n".join(
+        line for line in stderr.splitlines() if not line.startswith("    ")
+    )
+
+
+def run_candidate(python_executable, env, source, py_file, scratch, backend):
+    """Store, check and run one script like run_script; returns (outcome, seconds spent on the file)."""
+    start = time.perf_counter()
+    scratch_file = ScratchFile(source, py_file, scratch)
+    if scratch == "disk":
+        # run_script reads the script back
+        with open(py_file, "r") as f:
+            f.read()
+    file_seconds = time.perf_counter() - start
+    error = check_syntax(python_executable, source, scratch_file.name)
+    if error is None:
+        result = run_python(
+            python_executable,
+            scratch_file.args(),
+            timeout=60,
+            env=env,
+            backend=backend,
+            input=scratch_file.input,
+            pass_fds=scratch_file.pass_fds,
+        )
+        outcome = (
+            True,
+            result.returncode,
+            result.stdout,
+            traceback_summary(result.stderr),
+        )
+    else:
+        outcome = (False, 1, "", error)
+    path = scratch_file.path
+    start = time.perf_counter()
+    scratch_file.close()
+    file_seconds += time.perf_counter() - start
+    if path is not None and path != py_file:
+        outcome = tuple(
+            o.replace(path, py_file) if isinstance(o, str) else o for o in outcome
+        )
+    return outcome, file_seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("env_path", help="Environment to run the scripts in")
+    parser.add_argument(
+        "--scratch", default="./", help="Directory of the scripts with the disk backend"
+    )
+    parser.add_argument("--runs", type=int, default=100, help="Scripts run per backend")
+    parser.add_argument(
+        "--backends", nargs="+", choices=SCRATCH_BACKENDS, default=SCRATCH_BACKENDS
+    )
+    parser.add_argument("--exec-backend", choices=EXEC_BACKENDS, default="subprocess")
+    args = parser.parse_args()
+
+    python_executable = os.path.join(args.env_path, "bin", "python")
+    env = sandbox_env(args.env_path)
+    tmp_dir = os.path.join(args.scratch, "tmp_files", "bench_scratch")
+    os.makedirs(tmp_dir, exist_ok=True)
+    # start the syntax checker (and the zygote) before timing
+    run_candidate(
+        python_executable,
+        env,
+        CANDIDATES[0],
+        os.path.join(tmp_dir, "warmup.py"),
+        "disk",
+        args.exec_backend,
+    )
+
+    reference = None
+    timings = {}
+    for scratch in args.backends:
+        outcomes = []
+        file_seconds = 0.0
+        start = time.perf_counter()
+        for i in range(args.runs):
+            py_file = os.path.join(tmp_dir, f"temp_{i}.py")
+            outcome, seconds = run_candidate(
+                python_executable,
+                env,
+                CANDIDATES[i % len(CANDIDATES)],
+                py_file,
+                scratch,
+                args.exec_backend,
+            )
+            outcomes.append(outcome)
+            file_seconds += seconds
+        timings[scratch] = (time.perf_counter() - start, file_seconds)
+        if reference is None:
+            reference = outcomes
+        mismatches = [i for i, (a, b) in enumerate(zip(reference, outcomes)) if a != b]
+        if mismatches:
+            i = mismatches[0]
+            print(
+                f"{scratch}: {len(mismatches)} outcomes differ from {args.backends[0]}, e.g."
+            )
+            print(f"  {reference[i]}\n  {outcomes[i]}")
+    os.rmdir(tmp_dir)
+
+    base = timings[args.backends[0]][0]
+    print(
+        f"{'backend':<8} {'total s':>9} {'ms/run':>8} {'file ms/run':>12} {'speedup':>8}"
+    )
+    for scratch, (total, file_seconds) in timings.items():
+        print(
+            f"{scratch:<8} {total:>9.2f} {1000 * total / args.runs:>8.2f} "
+            f"{1000 * file_seconds / args.runs:>12.3f} {base / total:>7.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
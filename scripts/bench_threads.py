@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Benchmark thread budgets of concurrent sandbox runs (see src/sandbox.py).
+
+Runs the same BLAS-heavy script (numpy matrix products by default) `--tasks`
+times in an environment, with every number of concurrent workers and every
+thread budget given, the way the evaluation runs candidates, and reports the
+wall time and the throughput of each combination. A budget of -1 is the
+unlimited default of the libraries (and of the evaluation), 0 the CPUs divided
+among the workers.
+
+    python scripts/bench_threads.py eval_venvs/gcham_venv_12 --workers 4 16 --threads -1 0 1
+"""
+
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.sandbox import THREAD_VARS, available_cpus, sandbox_env, set_thread_budget
+from src.zygote import EXEC_BACKENDS, run_python
+
+WORKLOAD = """
+import sys
+import numpy as np
+size = int(sys.argv[1])
+a = np.random.default_rng(0).random((size, size))
+for _ in range(5):
+    a = a @ a
+    a /= np.abs(a).max()
+print(float(a.sum()))
+"""
+
+
+def run_tasks(python_executable, env_path, script, args, workers, tasks, backend):
+    """Run `script` `tasks` times on `workers` threads; returns the wall time and the failures."""
+
+    def task(_):
+        # like the evaluation, read the budget when each run starts
+        result = run_python(
+            python_executable,
+            ["-c", script] + args,
+            timeout=600,
+            env=sandbox_env(env_path),
+            backend=backend,
+        )
+        return result.returncode
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        failures = sum(code != 0 for code in executor.map(task, range(tasks)))
+    return time.perf_counter() - start, failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("env_path", help="Environment to run the script in")
+    parser.add_argument("--workers", type=int, nargs="+", default=[os.cpu_count() or 1])
+    parser.add_argument("--threads", type=int, nargs="+", default=[-1, 0])
+    parser.add_argument("--tasks", type=int, default=32, help="Runs per combination")
+    parser.add_argument(
+        "--size",
+        type=int,
+        default=800,
+        help="Size of the matrices of the default script",
+    )
+    parser.add_argument("--script", default=None, help="Script to run instead of numpy")
+    parser.add_argument("--pin", action="store_true", help="Pin each run to its CPUs")
+    parser.add_argument("--exec-backend", choices=EXEC_BACKENDS, default="subprocess")
+    args = parser.parse_args()
+
+    python_executable = os.path.join(args.env_path, "bin", "python")
+    if args.script:
+        with open(args.script, "r") as f:
+            script, script_args = f.read(), []
+    else:
+        script, script_args = WORKLOAD, [str(args.size)]
+    for variable in THREAD_VARS:
+        # the budget of each combination is the only limit
+        os.environ.pop(variable, None)
+    print(f"{len(available_cpus())} CPUs")
+
+    print(
+        f"{'workers':>7} {'threads':>7} {'pinned':>6} {'wall s':>8} {'tasks/s':>8} {'failed':>6}"
+    )
+    for workers in args.workers:
+        for threads in args.threads:
+            budget = set_thread_budget(workers, threads, args.pin)
+            seconds, failures = run_tasks(
+                python_executable,
+                args.env_path,
+                script,
+                script_args,
+                workers,
+                args.tasks,
+                args.exec_backend,
+            )
+            print(
+                f"{workers:>7} {budget if budget is not None else '-':>7} "
+                f"{'yes' if args.pin and budget is not None else 'no':>6} "
+                f"{seconds:>8.2f} {args.tasks / seconds:>8.2f} {failures:>6}"
+            )
+
+
+if __name__ == "__main__":
+    main()
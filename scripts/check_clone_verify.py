@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Check that environments cloned from a template pass `verify_environment`.
+
+Creates a template (a plain virtual environment, with pip and its scripts in
+bin/), clones it with every mode of `clone_environment` (or the ones given),
+writes the manifest of each clone as a build does and verifies it with sha256
+hashes. `clone_environment` rewrites the bin/ scripts that embed the template
+path, so the clone must verify with their new sizes and hashes, and the
+template, which a hardlinked clone shares files with, must still verify too.
+
+    python scripts/check_clone_verify.py --python-version 3.10
+    python scripts/check_clone_verify.py --modes hardlink --keep
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.create_venvs import (
+    base_python_executable,
+    clone_environment,
+    clone_flags,
+    create_virtual_environment,
+    python_versions,
+    write_environment_manifest,
+)
+from src.env_verify import verify_environment
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--python-version", choices=sorted(python_versions), default="3.10"
+    )
+    parser.add_argument(
+        "--modes",
+        nargs="+",
+        choices=sorted(clone_flags),
+        default=sorted(clone_flags),
+        help="Clone modes to check",
+    )
+    parser.add_argument(
+        "--keep", action="store_true", help="Keep the temporary directory"
+    )
+    args = parser.parse_args()
+
+    python_executable = base_python_executable(python_versions[args.python_version])
+    if not os.path.exists(python_executable):
+        sys.exit(
+            f"FAILED: no interpreter {python_executable} for Python {args.python_version}"
+        )
+    sample = {
+        "python_version": args.python_version,
+        "library": "pip",
+        "version": "",
+        "additional_dependencies": "",
+    }
+    work_dir = tempfile.mkdtemp(prefix="gcham_clone_check_")
+    failures = []
+    try:
+        template_path = os.path.join(work_dir, "templates", "check")
+        create_virtual_environment(template_path, python_versions[args.python_version])
+        open(os.path.join(template_path, ".template_complete"), "w").close()
+        for mode in args.modes:
+            env_path = clone_environment(
+                template_path, os.path.join(work_dir, "envs", mode), mode=mode
+            )
+            write_environment_manifest(env_path, sample, 0.0)
+            problems = {
+                kind: items
+                for kind, items in verify_environment(env_path, full=True).items()
+                if items
+            }
+            print(f"{mode}: {problems or 'OK'}")
+            if problems:
+                failures.append(mode)
+        template_problems = verify_environment(template_path, full=True)
+        # the template has no manifest, only its files are checked
+        if template_problems["missing"] or template_problems["corrupted"]:
+            print(f"template: {template_problems}")
+            failures.append("template")
+    finally:
+        if args.keep:
+            print(f"Kept {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    if failures:
+        sys.exit(f"FAILED: {', '.join(failures)}")
+    print("OK: cloned environments verify")
+
+
+if __name__ == "__main__":
+    main()
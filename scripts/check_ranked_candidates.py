@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Check that ranked candidates get the results of the candidates they copy.
+
+`eval_sample_k` and `pytest_eval_sample_k` (src/eval_code.py) only run the n
+candidates of a row (`best_of_both`) and give the ranked outputs
+(best_mean_logp, best_sum_logp, random) the results of the candidates they
+point to (`resolve_ranks`). This compares that, on random rows with repeated
+candidates and random ranks, with running every output column on its own as
+the evaluation did before, using a deterministic stand-in for the runs.
+
+    python scripts/check_ranked_candidates.py --rows 1000 --n 10
+"""
+
+import argparse
+import hashlib
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.eval_code import best_of_both, resolve_ranks
+
+
+def fake_run(candidate, add_starter):
+    """A run of `candidate`: (pass, compile, parsed code, error log, timeout), decided by its text."""
+    digest = hashlib.sha256(f"{candidate}\0{add_starter}".encode()).digest()
+    passed = int(digest[0] % 3 == 0)
+    return (
+        passed,
+        int(digest[1] % 4 != 0),
+        candidate,
+        f"log {digest[2]}",
+        digest[3] % 10 == 0,
+    )
+
+
+def run_every_column(columns):
+    """The results of running every output column on its own, as before resolve_ranks."""
+    results = []
+    for candidate in columns:
+        result = fake_run(candidate, True)
+        if not result[0]:
+            result_wo_starter = fake_run(candidate, False)
+            if result_wo_starter[0] > result[0]:
+                result = result_wo_starter
+        results.append(result)
+    return [list(values) for values in zip(*results)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1000, help="Random rows to check")
+    parser.add_argument("--n", type=int, default=10, help="Candidates per row")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    mismatches = set()
+    for row in range(args.rows):
+        # few distinct candidates, so that rows have duplicates
+        candidates = [f"candidate {rng.randrange(args.n)}" for _ in range(args.n)]
+        ranks = [rng.randrange(args.n) for _ in range(3)]
+        calls = []
+
+        def run(i, add_starter):
+            calls.append(i)
+            return fake_run(candidates[i], add_starter)
+
+        resolved = [
+            resolve_ranks(values, ranks) for values in best_of_both(candidates, run)
+        ]
+        expected = run_every_column(candidates + [candidates[rank] for rank in ranks])
+        if resolved != expected:
+            mismatches.add(row)
+            print(f"Row {row} differs: ranks {ranks}")
+        if any(i >= args.n for i in calls):
+            mismatches.add(row)
+            print(f"Row {row} ran a ranked output")
+
+    print(f"{args.rows - len(mismatches)}/{args.rows} rows match")
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
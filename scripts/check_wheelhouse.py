@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+"""
+Check that an environment builds from a local wheelhouse with --no-index.
+
+By default, writes a tiny pure-Python wheel (gcham-wheel-check 1.0) into a
+temporary wheelhouse and builds the environment of a row that needs it with
+`build_environments(..., wheelhouse=...)`, without any network access. With
+`--dataset` and `--example-id`, the distributions of that dataset row are first
+downloaded into the wheelhouse with `prefetch_wheelhouse` (this part needs the
+index), then its environment is built the same way.
+
+The package index is pointed at a local server that records the requests it
+gets (pip would only warn about an unreachable one): the check fails if pip
+contacted it during the build. The environment must then
+be up to date with its manifest (see `stale_reason`) and the library
+importable. Pinned packages the wheelhouse lacks (all of them with the check
+wheel) are dropped, as in any build, and reported.
+
+    python scripts/check_wheelhouse.py --python-version 3.10
+    python scripts/check_wheelhouse.py --dataset dataset/final_fix_dataset.jsonl --example-id 12 --wheelhouse wheels
+"""
+
+import argparse
+import base64
+import hashlib
+import http.server
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import zipfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.create_venvs import (
+    base_python_executable,
+    build_environments,
+    import_name,
+    prefetch_wheelhouse,
+    python_versions,
+    stale_reason,
+    wheelhouse_dir,
+)
+from src.env_store import read_manifest
+
+CHECK_PACKAGE = "gcham-wheel-check"
+CHECK_VERSION = "1.0"
+
+
+class RecordingIndex(http.server.BaseHTTPRequestHandler):
+    """Package index that has nothing and records what pip asked it."""
+
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(self.path)
+        self.send_error(404)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_index():
+    """Start a RecordingIndex on a free local port; returns the server."""
+    server = http.server.HTTPServer(("127.0.0.1", 0), RecordingIndex)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def write_check_wheel(directory):
+    """Write the wheel of gcham-wheel-check into `directory`; returns its path."""
+    module = import_name(CHECK_PACKAGE)
+    dist_info = f"{module}-{CHECK_VERSION}.dist-info"
+    files = {
+        f"{module}/__init__.py": f'__version__ = "{CHECK_VERSION}"\n',
+        f"{dist_info}/METADATA": (
+            f"Metadata-Version: 2.1\nName: {CHECK_PACKAGE}\nVersion: {CHECK_VERSION}\n"
+        ),
+        f"{dist_info}/WHEEL": (
+            "Wheel-Version: 1.0\nGenerator: check_wheelhouse\n"
+            "Root-Is-Purelib: true\nTag: py3-none-any\n"
+        ),
+    }
+    record = []
+    for name, content in files.items():
+        digest = hashlib.sha256(content.encode()).digest()
+        encoded = base64.urlsafe_b64encode(digest).rstrip(b"=").decode()
+        record.append(f"{name},sha256={encoded},{len(content.encode())}")
+    files[f"{dist_info}/RECORD"] = "\n".join(record + [f"{dist_info}/RECORD,,"]) + "\n"
+
+    os.makedirs(directory, exist_ok=True)
+    wheel_path = os.path.join(directory, f"{module}-{CHECK_VERSION}-py3-none-any.whl")
+    with zipfile.ZipFile(wheel_path, "w") as wheel:
+        for name, content in files.items():
+            wheel.writestr(name, content)
+    return wheel_path
+
+
+def load_row(dataset, example_id):
+    with open(dataset, "r") as f:
+        for line in f:
+            if line.strip():
+                row = json.loads(line)
+                if str(row["example_id"]) == str(example_id):
+                    return row
+    sys.exit(f"Example {example_id} is not in {dataset}")
+
+
+def check_environment(env_path, sample):
+    """Problems of the built environment of `sample`, empty if none."""
+    problems = []
+    reason = stale_reason(env_path, sample)
+    if reason is not None:
+        problems.append(reason)
+    module = import_name(sample["library"])
+    result = subprocess.run(
+        [os.path.join(env_path, "bin", "python"), "-c", f"import {module}"],
+        text=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    if result.returncode != 0:
+        problems.append(f"cannot import {module}: {result.stderr.strip()}")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--python-version", choices=sorted(python_versions), default="3.10"
+    )
+    parser.add_argument("--dataset", default=None, help="Dataset JSONL of --example-id")
+    parser.add_argument(
+        "--example-id", default=None, help="Row to build instead of the check wheel"
+    )
+    parser.add_argument(
+        "--wheelhouse", default=None, help="Wheelhouse (default: a temporary one)"
+    )
+    parser.add_argument(
+        "--base-path",
+        default=None,
+        help="Where to build (default: a temporary directory)",
+    )
+    parser.add_argument(
+        "--keep", action="store_true", help="Keep the temporary directories"
+    )
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="gcham_wheelhouse_check_")
+    wheelhouse = args.wheelhouse or os.path.join(work_dir, "wheelhouse")
+    base_path = args.base_path or os.path.join(work_dir, "envs")
+    try:
+        if args.example_id is not None:
+            assert args.dataset, "--example-id needs --dataset."
+            sample = load_row(args.dataset, args.example_id)
+            failed = prefetch_wheelhouse([sample], wheelhouse)
+            if failed:
+                sys.exit(f"FAILED: could not download {failed}")
+        else:
+            sample = {
+                "example_id": "0",
+                "python_version": args.python_version,
+                "library": CHECK_PACKAGE,
+                "version": CHECK_VERSION,
+                "additional_dependencies": "",
+            }
+            write_check_wheel(wheelhouse_dir(wheelhouse, args.python_version))
+        python_executable = base_python_executable(
+            python_versions[sample["python_version"]]
+        )
+        if not os.path.exists(python_executable):
+            sys.exit(
+                f"FAILED: no interpreter {python_executable} for Python {sample['python_version']}"
+            )
+
+        index = start_index()
+        os.environ["PIP_INDEX_URL"] = f"http://127.0.0.1:{index.server_port}/simple"
+        statuses = build_environments(
+            [sample], base_path, install_pkgs=True, shared=False, wheelhouse=wheelhouse
+        )
+        index.shutdown()
+        if RecordingIndex.requests:
+            sys.exit(f"FAILED: pip contacted the index: {RecordingIndex.requests[:5]}")
+        status = statuses.get(str(sample["example_id"]))
+        if status != "built":
+            sys.exit(
+                f"FAILED: the environment was not built from {wheelhouse} ({status})"
+            )
+        env_path = os.path.join(base_path, f"gcham_venv_{sample['example_id']}")
+        problems = check_environment(env_path, sample)
+        if problems:
+            sys.exit("FAILED: " + "; ".join(problems))
+        print(
+            f"OK: {sample['library']}=={sample['version']} built from {wheelhouse} with --no-index"
+        )
+        dropped = read_manifest(env_path).get("dropped_pins")
+        if dropped:
+            print(f"Pinned packages missing from the wheelhouse, dropped: {dropped}")
+    finally:
+        if args.keep:
+            print(f"Kept {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
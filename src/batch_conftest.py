@@ -0,0 +1,150 @@
+"""
+conftest.py of a batched pytest session (see src/eval_batch.py).
+
+Every candidate of an example lives in its own directory `<root>/<i>/` with its
+module (e.g. sample_12.py) and a copy of the test file. The session starts
+pytest once, then collects and runs each candidate in a fork of itself, one
+after the other, with the candidate's directory first on sys.path. A candidate
+therefore sees the interpreter as it was before any candidate was imported:
+whatever it changes (module attributes, library state, environment variables,
+the working directory) goes away with its process, as in a session of its own.
+The random seeds are drawn again in each fork.
+
+With --gcham-timeout, each candidate gets that many seconds (collection and
+tests together); the session kills the process group of a candidate that runs
+out of time, writes a "timeout" event and goes on with the next one. A
+candidate whose process dies is left without a complete set of reports.
+
+Progress is appended to the JSON-lines file given by --gcham-report as it
+happens, so that the outcomes of the candidates that completed survive a crash
+or a timeout of the session:
+    {"event": "start", "candidate": "3"}
+    {"event": "collecterror", "candidate": "3", "error": ...}
+    {"event": "collected", "candidate": "3", "items": 2}
+    {"event": "report", "candidate": "3", "nodeid": ..., "when": "call",
+     "outcome": "failed", "longrepr": ...}
+    {"event": "timeout", "candidate": "3", "seconds": 60.0}
+
+This file runs in interpreters from Python 3.7 on and pytest 6 on.
+"""
+
+import json
+import os
+import random
+import signal
+import sys
+import time
+
+import pytest
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+_report = []
+# candidate of this process, None in the session that forks them
+_current = {"candidate": None, "timeout": 0.0}
+
+
+def pytest_addoption(parser):
+    parser.addoption("--gcham-report", default=None)
+    parser.addoption("--gcham-timeout", type=float, default=0.0)
+
+
+def pytest_configure(config):
+    _report.append(open(config.getoption("gcham_report"), "a"))
+    _current["timeout"] = config.getoption("gcham_timeout")
+
+
+def _write(event, **fields):
+    fields["event"] = event
+    _report[0].write(json.dumps(fields) + "\n")
+    _report[0].flush()
+
+
+def _candidates():
+    return sorted(
+        (
+            entry
+            for entry in os.listdir(ROOT)
+            if entry.isdigit() and os.path.isdir(os.path.join(ROOT, entry))
+        ),
+        key=int,
+    )
+
+
+def _wait(pid, seconds):
+    """Wait for the candidate process `pid`, killing it after `seconds` (0: no limit). False if killed."""
+    if seconds <= 0:
+        os.waitpid(pid, 0)
+        return True
+    deadline = time.monotonic() + seconds
+    while os.waitpid(pid, os.WNOHANG)[0] == 0:
+        if time.monotonic() >= deadline:
+            try:
+                os.killpg(pid, signal.SIGKILL)
+            except OSError:
+                os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+            return False
+        time.sleep(0.005)
+    return True
+
+
+def _enter(candidate):
+    """Set up the process of `candidate`, just forked from the session."""
+    _current["candidate"] = candidate
+    random.seed()
+    if "numpy" in sys.modules:
+        try:
+            sys.modules["numpy"].random.seed()
+        except Exception:
+            pass
+    sys.path.insert(0, os.path.join(ROOT, candidate))
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_collection(session):
+    for candidate in _candidates():
+        _write("start", candidate=candidate)
+        pid = os.fork()
+        if pid == 0:
+            os.setpgid(0, 0)
+            _enter(candidate)
+            session.perform_collect([os.path.join(ROOT, candidate)])
+            return True
+        try:
+            # also here, so that a kill right after the fork reaches the group
+            os.setpgid(pid, pid)
+        except OSError:
+            pass
+        if not _wait(pid, _current["timeout"]):
+            _write("timeout", candidate=candidate, seconds=_current["timeout"])
+    # the candidates ran in their processes, the session runs nothing
+    session.items = []
+    return True
+
+
+def pytest_collectreport(report):
+    if _current["candidate"] is not None and report.failed:
+        _write(
+            "collecterror", candidate=_current["candidate"], error=str(report.longrepr)
+        )
+
+
+def pytest_collection_modifyitems(session, config, items):
+    _write("collected", candidate=_current["candidate"], items=len(items))
+
+
+def pytest_runtest_logreport(report):
+    longrepr = None
+    if report.failed:
+        longrepr = str(report.longrepr)
+        for name, content in report.sections:
+            longrepr += f"\n{name}\n{content}"
+    _write(
+        "report",
+        candidate=_current["candidate"],
+        nodeid=report.nodeid,
+        when=report.when,
+        outcome=report.outcome,
+        longrepr=longrepr,
+    )
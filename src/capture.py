@@ -0,0 +1,240 @@
+"""
+Bounded capture of the output of candidate runs.
+
+Runs used to capture the whole stdout and stderr of a candidate
+(`capture_output=True`), which the evaluation then stored in its result
+frames, CSVs and result cache: a candidate printing a large tensor in a loop
+could take gigabytes of memory and make a CSV hundreds of MB large.
+`run_captured` instead streams each output of the child through a
+`BoundedBuffer` that keeps only its first and last bytes (the traceback is at
+the end), so memory stays bounded whatever the candidate prints. What is
+dropped is replaced by a marker that records how many bytes were printed:
+
+    <first bytes>
+    [... 12345678 bytes omitted, 12411214 bytes in total ...]
+    <last bytes>
+
+`set_output_limit` sets the number of bytes kept per stream for the runs of
+this process and of its workers (like the thread budget of src/sandbox.py).
+The zygote (src/zygote_server.py) bounds the output of its runs the same way.
+
+Stored logs can also be compressed (`compress_log`); `decompress_log` reads
+both compressed and plain logs.
+
+    python -m src.capture expand results_eval_results.csv
+"""
+
+import base64
+import os
+import select
+import selectors
+import subprocess
+import time
+import zlib
+
+# bytes kept of each of stdout and stderr: the first quarter and the last three quarters
+DEFAULT_LIMIT = 64 * 1024
+OUTPUT_LIMIT_VAR = "GCHAM_OUTPUT_LIMIT"
+
+COMPRESSED_PREFIX = "zlib+b64:"
+# logs shorter than this are stored as they are
+COMPRESS_MIN_CHARS = 1024
+
+_READ_SIZE = 1 << 16
+
+
+def set_output_limit(limit):
+    """Keep `limit` bytes of each output of the runs (0: everything)."""
+    os.environ[OUTPUT_LIMIT_VAR] = str(int(limit))
+
+
+def output_limit():
+    """Bytes kept of each output of a run, 0 for everything."""
+    try:
+        return int(os.environ.get(OUTPUT_LIMIT_VAR, DEFAULT_LIMIT))
+    except ValueError:
+        return DEFAULT_LIMIT
+
+
+def marker(omitted, total):
+    return f"\n[... {omitted} bytes omitted, {total} bytes in total ...]\n"
+
+
+def decode(data):
+    """Text of an output, like `subprocess.run(..., text=True)` reads it."""
+    text = data.decode("utf-8", errors="replace")
+    return text.replace("\r\n", "\n").replace("\r", "\n")
+
+
+def utf8_boundaries(head, tail):
+    """
+    `head` without a UTF-8 character cut at its end, and `tail` without one cut
+    at its start, so that the omitted bytes between them hold whole characters.
+    """
+    # at most 3 continuation bytes (10xxxxxx) follow the lead byte of a character
+    end = len(head)
+    for i in range(len(head) - 1, max(len(head) - 4, -1), -1):
+        byte = head[i]
+        if byte & 0xC0 != 0x80:
+            if byte >= 0xC0:
+                length = 2 if byte < 0xE0 else 3 if byte < 0xF0 else 4
+                if len(head) - i < length:
+                    end = i
+            break
+    start = 0
+    while start < min(3, len(tail)) and tail[start] & 0xC0 == 0x80:
+        start += 1
+    return head[:end], tail[start:]
+
+
+class BoundedBuffer:
+    """
+    The first and last bytes of a stream, out of `limit` bytes in all (0: no limit).
+    src/zygote_server.py has a copy of it (`Output`), since the zygote only uses
+    the standard library; keep both in sync.
+    """
+
+    def __init__(self, limit=DEFAULT_LIMIT):
+        self.limit = limit
+        self.head_size = limit // 4
+        self.tail_size = limit - self.head_size
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.total = 0
+
+    def write(self, data):
+        self.total += len(data)
+        if not self.limit:
+            self.head += data
+            return
+        if len(self.head) < self.head_size:
+            n = self.head_size - len(self.head)
+            self.head += data[:n]
+            data = data[n:]
+        self.tail += data
+        if len(self.tail) > self.tail_size:
+            del self.tail[: len(self.tail) - self.tail_size]
+
+    def getvalue(self):
+        omitted = self.total - len(self.head) - len(self.tail)
+        if omitted <= 0:
+            return decode(bytes(self.head + self.tail))
+        head, tail = utf8_boundaries(bytes(self.head), bytes(self.tail))
+        omitted = self.total - len(head) - len(tail)
+        return decode(head) + marker(omitted, self.total) + decode(tail)
+
+
+def run_captured(command, timeout=None, input=None, limit=None, **kwargs):
+    """
+    `subprocess.run(command, capture_output=True, text=True, timeout=timeout,
+    input=input, **kwargs)` keeping at most `limit` bytes (by default
+    output_limit()) of each of stdout and stderr. The CompletedProcess (or the
+    TimeoutExpired) also has `output_bytes`, the bytes printed on (stdout, stderr).
+    """
+    limit = output_limit() if limit is None else limit
+    deadline = None if timeout is None else time.monotonic() + timeout
+    with subprocess.Popen(
+        command,
+        stdin=None if input is None else subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        **kwargs,
+    ) as process:
+        buffers = {
+            process.stdout.fileno(): BoundedBuffer(limit),
+            process.stderr.fileno(): BoundedBuffer(limit),
+        }
+        pending = memoryview((input or "").encode("utf-8"))
+
+        def outputs():
+            out, err = (buffer.getvalue() for buffer in buffers.values())
+            return out, err, tuple(buffer.total for buffer in buffers.values())
+
+        try:
+            with selectors.DefaultSelector() as selector:
+                for fd in buffers:
+                    selector.register(fd, selectors.EVENT_READ)
+                if process.stdin is not None:
+                    if pending:
+                        selector.register(process.stdin.fileno(), selectors.EVENT_WRITE)
+                    else:
+                        process.stdin.close()
+                while selector.get_map():
+                    remaining = None
+                    if deadline is not None:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            raise subprocess.TimeoutExpired(command, timeout)
+                    for key, _ in selector.select(remaining):
+                        if key.fd in buffers:
+                            data = os.read(key.fd, _READ_SIZE)
+                            if data:
+                                buffers[key.fd].write(data)
+                            else:
+                                selector.unregister(key.fd)
+                            continue
+                        try:
+                            written = os.write(key.fd, pending[: select.PIPE_BUF])
+                            pending = pending[written:]
+                        except BrokenPipeError:
+                            pending = pending[:0]
+                        if not pending:
+                            selector.unregister(key.fd)
+                            process.stdin.close()
+            remaining = (
+                None if deadline is None else max(0, deadline - time.monotonic())
+            )
+            returncode = process.wait(timeout=remaining)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+            out, err, output_bytes = outputs()
+            expired = subprocess.TimeoutExpired(
+                command, timeout, output=out, stderr=err
+            )
+            expired.output_bytes = output_bytes
+            raise expired
+        except BaseException:
+            process.kill()
+            raise
+    out, err, output_bytes = outputs()
+    completed = subprocess.CompletedProcess(command, returncode, out, err)
+    completed.output_bytes = output_bytes
+    return completed
+
+
+def compress_log(text):
+    """`text` compressed into a printable string, if it is long enough to be worth it."""
+    if not isinstance(text, str) or len(text) < COMPRESS_MIN_CHARS:
+        return text
+    data = zlib.compress(text.encode("utf-8", errors="surrogatepass"), 9)
+    return COMPRESSED_PREFIX + base64.b64encode(data).decode("ascii")
+
+
+def decompress_log(text):
+    """A log stored by compress_log, or any other value as it is."""
+    if not isinstance(text, str) or not text.startswith(COMPRESSED_PREFIX):
+        return text
+    data = base64.b64decode(text[len(COMPRESSED_PREFIX) :])
+    return zlib.decompress(data).decode("utf-8", errors="surrogatepass")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    import pandas as pd
+
+    parser = argparse.ArgumentParser(description="Expand the compressed logs of a CSV.")
+    parser.add_argument("command", choices=["expand"])
+    parser.add_argument("csv_file", help="CSV written with --compress-logs.")
+    parser.add_argument(
+        "--output", default=None, help="Where to write it (default: in place)."
+    )
+    args = parser.parse_args()
+
+    df = pd.read_csv(args.csv_file)
+    for column in df.columns:
+        if df[column].dtype == object:
+            df[column] = df[column].map(decompress_log)
+    df.to_csv(args.output or args.csv_file, index=False)
+    print(f"Expanded the logs of {args.csv_file} into {args.output or args.csv_file}")
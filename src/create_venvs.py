@@ -1,76 +1,207 @@
 import hashlib
 import json
 import os
+import re
 import subprocess
 import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 
 import pandas as pd
 from tqdm import tqdm
 
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from src.env_bundles import export_bundles, import_bundles
+from src.env_verify import (
+    normalize_name,
+    read_distributions,
+    record_digest,
+    verification_gate,
+)
+from src.env_store import (
+    LAYERS_DIR,
+    LAYERS_PTH,
+    example_env_name,
+    layers_pth,
+    link_example,
+    read_manifest,
+    resolve_env_path,
+    store_env_path,
+    update_index,
+    write_manifest,
+)
+from src.sandbox import data_dir, data_dirs, find_data_assets, sandbox_env
+
 # Mapping of Python versions to pyenv-installed versions
 python_versions = {"3.7": "3.7.17", "3.9": "3.9.19", "3.10": "3.10.14"}
 
 
-def install_pinpointed_package(
-    package_name: str,
-    python_version: str,
-    python_executable: Path,
-    deps_lower: list,
-    version_mapping: dict,
-    env_path: str,
-):
+def python_version_key(value):
     """
-    Install a pinpointed package using the provided version mapping if the package is not
-    already included in additional dependencies.
+    Key of `python_versions` of the python_version of a dataset row, also when
+    pandas read it as a number (3.10 becomes 3.1). Empty values stay "".
+    Raises ValueError for a version that has no interpreter.
     """
-    # Check if the package appears in additional dependencies
-    if all(package_name not in dep for dep in deps_lower):
-        package_spec = version_mapping.get(python_version)
-        if package_spec:
-            install_cmd = [
-                python_executable,
-                "-m",
-                "pip",
-                "install",
-                package_spec,
-                "--quiet",
-            ]
-            result = subprocess.run(
-                install_cmd,
-                text=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-            )
-            if result.returncode == 0:
-                print(
-                    f"{package_name.capitalize()} installed successfully in {env_path} with version from mapping: {package_spec}"
-                )
-            else:
-                print(
-                    f"Failed to install {package_name} in {env_path}: {result.stderr}"
-                )
-        else:
-            print(
-                f"No {package_name} version mapping found for Python {python_version}. Skipping {package_name} installation."
-            )
+    if value is None or value == "":
+        return ""
+    if str(value) in python_versions:
+        return str(value)
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        number = None
+    for key in python_versions:
+        if number is not None and float(key) == number:
+            return key
+    raise ValueError(
+        f"Unknown python_version {value!r}, expected one of {sorted(python_versions)}"
+    )
+
+
+TEMPLATES_DIR = "templates"
+
+# dataset libraries whose import name differs from their distribution name
+import_names = {"scikit-learn": "sklearn", "pillow": "PIL"}
+
+# cp flags used to clone a template environment
+clone_flags = {"hardlink": ["-al"], "reflink": ["-a", "--reflink=auto"], "copy": ["-a"]}
+
+_template_locks = {}
+_template_locks_lock = threading.Lock()
+
+# Packages pinned in every environment: (package, library that replaces the pin, versions)
+pinned_packages = [
+    (
+        "pytest",
+        "pytest",
+        {"3.7": "pytest==6.2.5", "3.9": "pytest==7.1.2", "3.10": "pytest==7.2.0"},
+    ),
+    (
+        "pytest-cov",
+        "pytest",
+        {
+            "3.7": "pytest-cov==4.1.0",
+            "3.9": "pytest-cov==4.1.0",
+            "3.10": "pytest-cov==4.1.0",
+        },
+    ),
+    (
+        "numpy",
+        "numpy",
+        {"3.7": "numpy==1.21.6", "3.9": "numpy==1.21.6", "3.10": "numpy==1.23"},
+    ),
+    (
+        "scipy",
+        "scipy",
+        {"3.7": "scipy==1.7.1", "3.9": "scipy==1.9.1", "3.10": "scipy==1.10.1"},
+    ),
+]
+
+
+def pinned_companions(library):
+    """Return (package_name, version_mapping) of the pinned packages that apply to `library`."""
+    return [
+        (package_name, version_mapping)
+        for package_name, replaced_by, version_mapping in pinned_packages
+        if library.lower() != replaced_by
+    ]
+
+
+def pip_supports_report(pip_version):
+    """`pip install --report` exists since pip 22.2; `pip_version` None means the latest pip."""
+    if not pip_version:
+        return True
+    return tuple(int(part) for part in re.findall(r"\d+", pip_version)[:2]) >= (22, 2)
+
+
+def install_requirements(python_executable, requirements, pip_env=None, report=True):
+    """
+    Install `requirements` with a single pip resolver pass.
+
+    Returns the completed pip process and the "name==version" list of the
+    distributions pip resolved and installed (from `pip install --report`), or
+    None when no report is available.
+    """
+    with tempfile.TemporaryDirectory(dir=(pip_env or {}).get("TMPDIR")) as tmp_dir:
+        report_path = os.path.join(tmp_dir, "report.json")
+        install_cmd = [python_executable, "-m", "pip", "install", "--quiet"]
+        if report:
+            install_cmd += ["--report", report_path]
+        result = subprocess.run(
+            install_cmd + requirements,
+            text=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            env=pip_env,
+        )
+        resolved = None
+        if result.returncode == 0 and os.path.exists(report_path):
+            with open(report_path, "r") as f:
+                resolved = [
+                    f"{item['metadata']['name']}=={item['metadata']['version']}"
+                    for item in json.load(f).get("install", [])
+                ]
+    return result, resolved
+
+
+def base_python_executable(pyenv_version, docker=True):
+    """Interpreter of a pyenv version, as installed in the Docker image."""
+    return f"/root/.pyenv/versions/{pyenv_version}/bin/python" if docker else "python"
+
+
+def validate_shared_interpreter(env_path, python_executable):
+    """
+    Check that a `--symlinks` environment runs the shared pyenv interpreter:
+    bin/python must resolve to it and report the environment as its prefix.
+    Returns None if it does, else the reason it does not.
+    """
+    env_python = os.path.join(env_path, "bin", "python")
+    if os.path.realpath(env_python) != os.path.realpath(python_executable):
+        return f"{env_python} does not resolve to {python_executable}"
+    result = subprocess.run(
+        [env_python, "-c", "import sys; print(sys.prefix)"],
+        text=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    if result.returncode != 0:
+        return f"{env_python} does not run: {result.stderr}"
+    if os.path.realpath(result.stdout.strip()) != os.path.realpath(env_path):
+        return f"{env_python} runs with prefix {result.stdout.strip()}"
+    return None
 
 
 def create_virtual_environment(
-    env_path, python_version, create_anyway=False, library_to_check=None, docker=True
+    env_path,
+    python_version,
+    create_anyway=False,
+    library_to_check=None,
+    docker=True,
+    interpreter="copy",
 ):
-    """Create and return the path of a virtual environment."""
-    python_executable = (
-        f"/root/.pyenv/versions/{python_version}/bin/python" if docker else "python"
-    )
+    """
+    Create and return the path of a virtual environment.
+
+    With `interpreter="copy"` the environment gets its own copy of the interpreter
+    (`venv --copies`). With "shared", bin/python is a symlink to the read-only
+    pyenv interpreter (`venv --symlinks`), so all environments of a Python version
+    run the same binary; this is checked before the environment is used.
+    """
+    python_executable = base_python_executable(python_version, docker=docker)
     if not os.path.exists(python_executable):
         print(f"Python version {python_version} not found. Skipping {env_path}.")
         return
+    layout_flag = "--symlinks" if interpreter == "shared" else "--copies"
 
     if not os.path.exists(env_path):
         os.makedirs(env_path, exist_ok=True)
         subprocess.run(
-            [python_executable, "-m", "venv", "--copies", env_path], check=True
+            [python_executable, "-m", "venv", layout_flag, env_path], check=True
         )
         print(f"Virtual environment created: {env_path}")
     else:
@@ -79,19 +210,20 @@ def create_virtual_environment(
             subprocess.run(["rm", "-rf", env_path])
             os.makedirs(env_path, exist_ok=True)
             subprocess.run(
-                [python_executable, "-m", "venv", "--copies", "--clear", env_path],
+                [python_executable, "-m", "venv", layout_flag, "--clear", env_path],
                 check=True,
             )
             print(f"Virtual environment recreated: {env_path}")
 
+    if interpreter == "shared":
+        reason = validate_shared_interpreter(env_path, python_executable)
+        if reason is not None:
+            print(f"Shared interpreter check failed for {env_path}: {reason}")
+            subprocess.run(["rm", "-rf", env_path])
+            return
+
     if library_to_check:
-        python_exec = os.path.join(env_path, "bin", "python")
-        result = subprocess.run(
-            [python_exec, "-m", "pip", "show", library_to_check],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        )
-        if result.returncode == 0:
+        if normalize_name(library_to_check) in read_distributions(env_path):
             print(
                 f"Library '{library_to_check}' is installed in the virtual environment."
             )
@@ -103,13 +235,11 @@ def create_virtual_environment(
     return env_path
 
 
-def install_packages(
-    env_path, library, version, additional_dependencies, python_version
-):
-    """Install packages using the Python executable in the virtual environment."""
-    python_executable = Path(env_path, "bin", "python")
-
-    # Parse additional dependencies
+def parse_dependencies(additional_dependencies):
+    """
+    Split the additional_dependencies string of a row.
+    Returns all dependencies, the pinned pip version (or None) and the other dependencies.
+    """
     dependencies = additional_dependencies.split() if additional_dependencies else []
     pip_version = None
     other_dependencies = []
@@ -120,6 +250,36 @@ def install_packages(
             pip_version = dep.split("=")[1]
         elif dep.strip() and dep != "-":  # Filter out invalid entries
             other_dependencies.append(dep)
+    return dependencies, pip_version, other_dependencies
+
+
+def pinned_specs(sample):
+    """Specs of the pinned packages `install_packages` installs for a row, in install order."""
+    dependencies, _, _ = parse_dependencies(sample.get("additional_dependencies", ""))
+    deps_lower = [dep.lower() for dep in dependencies]
+    specs = []
+    for package_name, version_mapping in pinned_companions(sample["library"]):
+        package_spec = version_mapping.get(sample["python_version"])
+        if package_spec and all(package_name not in dep for dep in deps_lower):
+            specs.append(package_spec)
+    return specs
+
+
+def install_packages(
+    env_path, library, version, additional_dependencies, python_version, pip_env=None
+):
+    """Install packages using the Python executable in the virtual environment.
+
+    `pip_env` is the environment passed to every pip subprocess (see `pip_environment`).
+    Returns the pip return code and the pinned packages dropped because they
+    conflict with the requirements of the row. When the single resolver pass
+    fails, the pinned packages are added to the row's requirements one at a
+    time (pytest first), and only those that do not resolve are dropped.
+    """
+    python_executable = Path(env_path, "bin", "python")
+
+    # Parse additional dependencies
+    _, pip_version, _ = parse_dependencies(additional_dependencies)
 
     # Upgrade pip to the specified version or the latest version
     if pip_version:
@@ -142,26 +302,54 @@ def install_packages(
             "--quiet",
         ]
     subprocess.run(
-        pip_upgrade_cmd, text=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        pip_upgrade_cmd,
+        text=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        env=pip_env,
     )
     print(
         f"Pip upgraded in {env_path} to version {pip_version if pip_version else 'latest'}."
     )
 
-    # Install the main library and other dependencies
-    pip_install_cmd = [
-        python_executable,
-        "-m",
-        "pip",
-        "install",
-        f"{library}=={version}",
-        "--quiet",
-    ] + other_dependencies
+    # Install the main library, other dependencies and pinned packages in one resolver pass
+    sample = {
+        "python_version": python_version,
+        "library": library,
+        "version": version,
+        "additional_dependencies": additional_dependencies,
+    }
+    plan = install_plan(sample)
+    pins = pinned_specs(sample)
+    report = pip_supports_report(pip_version)
 
     print(f"Installing packages in {env_path}...")
-    result = subprocess.run(
-        pip_install_cmd, text=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    result, resolved = install_requirements(
+        python_executable, plan, pip_env=pip_env, report=report
     )
+    dropped = []
+    if result.returncode != 0 and pins:
+        # keep the row's own requirements, and each pinned package that resolves with them
+        print(
+            f"Pinned packages {' '.join(pins)} conflict with the requirements of "
+            f"{env_path}, adding them one at a time: {result.stderr}"
+        )
+        requirements = plan[: len(plan) - len(pins)]
+        result = None
+        for pin in pins:
+            attempt, attempt_resolved = install_requirements(
+                python_executable, requirements + [pin], pip_env=pip_env, report=report
+            )
+            if attempt.returncode == 0:
+                requirements.append(pin)
+                result, resolved = attempt, attempt_resolved
+            else:
+                dropped.append(pin)
+        if result is None:
+            result, resolved = install_requirements(
+                python_executable, requirements, pip_env=pip_env, report=report
+            )
+        print(f"Pinned packages dropped in {env_path}: {' '.join(dropped)}")
     if result.returncode != 0:
         print(f"Failed to install packages in {env_path}: {result.stderr}")
         subprocess.run(
@@ -169,148 +357,1330 @@ def install_packages(
         )  # Clean up the environment if installation fails
     else:
         print(f"Packages installed successfully in {env_path}")
+        if resolved is not None:
+            print(
+                f"Resolved {len(resolved)} packages in {env_path}: {' '.join(sorted(resolved))}"
+            )
 
-        deps_lower = [dep.lower() for dep in dependencies]
-        if library.lower() != "pytest":
-            pytest_versions = {
-                "3.7": "pytest==6.2.5",
-                "3.9": "pytest==7.1.2",
-                "3.10": "pytest==7.2.0",
-            }
-            install_pinpointed_package(
-                "pytest",
-                python_version,
-                python_executable,
-                deps_lower,
-                pytest_versions,
-                env_path,
+    return result.returncode, dropped
+
+
+def generate_env_id(row):
+    """Generate a unique ID based on library, version, and dependencies."""
+    unique_str = f"{row['library']}-{row['version']}-{row['additional_dependencies']}"
+    return hashlib.sha256(unique_str.encode()).hexdigest()[:8]
+
+
+def pip_environment(
+    cache_dir=None, tmp_dir=None, index_url=None, find_links=None, no_index=False
+):
+    """
+    Return the environment passed to pip subprocesses.
+
+    Concurrent builds must not share a pip cache or a temporary build directory,
+    so every worker passes its own `cache_dir` and `tmp_dir`.
+    `index_url`, `find_links` and `no_index` select where pip looks for packages,
+    e.g. only in a local wheelhouse with `find_links=<dir>, no_index=True`.
+    """
+    env = dict(os.environ)
+    env["PIP_DISABLE_PIP_VERSION_CHECK"] = "1"
+    env["PIP_NO_INPUT"] = "1"
+    if index_url:
+        env["PIP_INDEX_URL"] = index_url
+    if find_links:
+        env["PIP_FIND_LINKS"] = str(find_links)
+    if no_index:
+        env["PIP_NO_INDEX"] = "1"
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        env["PIP_CACHE_DIR"] = str(cache_dir)
+    if tmp_dir:
+        os.makedirs(tmp_dir, exist_ok=True)
+        env["TMPDIR"] = str(tmp_dir)
+    return env
+
+
+def load_samples(jsonl_file, start_id=0, end_id=sys.maxsize):
+    """Read the dataset rows whose example_id lies in [start_id, end_id]."""
+    samples = []
+    with open(jsonl_file, "r") as file:
+        for line in file:
+            if not line.strip():
+                continue
+            sample = json.loads(line)
+            example_id = sample.get("example_id")
+            if not example_id:
+                continue
+            if int(example_id) < start_id or int(example_id) > end_id:
+                continue
+            samples.append(sample)
+    return samples
+
+
+def env_key(row):
+    """Key of the shared environment of a dataset row: Python version plus `generate_env_id`."""
+    return f"py{row['python_version']}-{generate_env_id(row)}"
+
+
+def template_key(sample):
+    """Key of the template of a row: its Python version and the pinned packages it gets."""
+    specs = " ".join(pinned_specs(sample))
+    return (
+        f"py{sample['python_version']}-{hashlib.sha256(specs.encode()).hexdigest()[:8]}"
+    )
+
+
+def ensure_template(base_path, sample, pip_env=None, interpreter="copy"):
+    """
+    Return the template environment of a row, building it first if needed.
+
+    A template is a virtual environment with the latest pip and the pinned
+    packages of the row already installed. It is built once per `template_key`
+    (and `interpreter` layout, see `create_virtual_environment`) under
+    `<base_path>/templates` and marked complete with a `.template_complete` file.
+    Returns None if the template could not be built.
+    """
+    key = template_key(sample) + ("-shared" if interpreter == "shared" else "")
+    template_path = os.path.join(base_path, TEMPLATES_DIR, key)
+    marker = os.path.join(template_path, ".template_complete")
+    with _template_locks_lock:
+        template_lock = _template_locks.setdefault(key, threading.Lock())
+    with template_lock:
+        if os.path.exists(marker):
+            return template_path
+        subprocess.run(["rm", "-rf", template_path])
+        env_created = create_virtual_environment(
+            template_path,
+            python_versions[sample["python_version"]],
+            interpreter=interpreter,
+        )
+        if env_created is None:
+            return None
+        python_executable = Path(template_path, "bin", "python")
+        for requirements in [["--upgrade", "pip"], pinned_specs(sample)]:
+            if not requirements:
+                continue
+            result = subprocess.run(
+                [python_executable, "-m", "pip", "install", "--quiet"] + requirements,
+                text=True,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                env=pip_env,
             )
-            pytest_versions = {
-                "3.7": "pytest-cov==4.1.0",
-                "3.9": "pytest-cov==4.1.0",
-                "3.10": "pytest-cov==4.1.0",
-            }
-            install_pinpointed_package(
-                "pytest-cov",
-                python_version,
+            if result.returncode != 0:
+                print(f"Failed to build template {key}: {result.stderr}")
+                return None
+        precompile_environment(template_path, pip_env=pip_env)
+        open(marker, "w").close()
+        print(f"Template environment created: {template_path}")
+    return template_path
+
+
+def layer_key(sample):
+    """Key of the library layer of a row: its Python version, library and version."""
+    library = re.sub(r"[^a-z0-9.]+", "-", sample["library"].lower())
+    return f"py{sample['python_version']}-{library}-{sample['version']}"
+
+
+def ensure_library_layer(base_path, sample, pip_env=None, docker=True):
+    """
+    Return the library layer of a row, building it first if needed.
+
+    A layer holds only `library==version` (installed with `--no-deps --target`
+    by the pyenv interpreter of the row), byte-compiled and made read-only. It is
+    built once per `layer_key` under `<base_path>/layers` and shared by every
+    environment of that library version, whatever their additional dependencies.
+    Returns None if the layer could not be built.
+    """
+    key = layer_key(sample)
+    layer_path = os.path.join(base_path, LAYERS_DIR, key)
+    with _template_locks_lock:
+        layer_lock = _template_locks.setdefault(f"layer-{key}", threading.Lock())
+    with layer_lock:
+        if os.path.exists(layer_path):
+            return layer_path
+        python_executable = base_python_executable(
+            python_versions[sample["python_version"]], docker=docker
+        )
+        tmp_path = f"{layer_path}.tmp.{os.getpid()}"
+        subprocess.run(["rm", "-rf", tmp_path])
+        result = subprocess.run(
+            [
                 python_executable,
-                deps_lower,
-                pytest_versions,
-                env_path,
+                "-m",
+                "pip",
+                "install",
+                "--no-deps",
+                "--quiet",
+                "--target",
+                tmp_path,
+                f"{sample['library']}=={sample['version']}",
+            ],
+            text=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            env=pip_env,
+        )
+        if result.returncode != 0:
+            print(f"Failed to build layer {key}: {result.stderr}")
+            subprocess.run(["rm", "-rf", tmp_path])
+            return None
+        subprocess.run(
+            [python_executable, "-m", "compileall", "-q", "-j", "0", tmp_path],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        subprocess.run(["chmod", "-R", "a-w", tmp_path])
+        try:
+            os.replace(tmp_path, layer_path)
+        except OSError:
+            # built by another process in the meantime
+            subprocess.run(["chmod", "-R", "u+w", tmp_path])
+            subprocess.run(["rm", "-rf", tmp_path])
+        print(f"Library layer created: {layer_path}")
+    return layer_path
+
+
+def link_layers(env_path, layer_paths):
+    """
+    Add layers to the path of an environment, after its own site-packages (see
+    `env_store.layers_pth`). pip sees the distributions of the layers as
+    installed, so it installs only what they are missing; a different version
+    it installs in the environment shadows the layer.
+    """
+    for site_dir in site_packages(env_path):
+        with open(os.path.join(site_dir, LAYERS_PTH), "w") as f:
+            f.write(layers_pth(env_path, layer_paths))
+
+
+def clone_environment(template_path, env_path, mode="hardlink"):
+    """
+    Clone a template environment to `env_path`.
+
+    `mode` is "hardlink" (files share inodes with the template), "reflink"
+    (copy-on-write where the filesystem supports it, plain copy otherwise) or
+    "copy". pip replaces files rather than editing them in place, so installs in
+    a hardlinked clone never modify the template. The scripts in bin/ and
+    pyvenv.cfg, which embed the template path, are rewritten as new files, and
+    so are the RECORDs that list those scripts (see `update_records`).
+    """
+    subprocess.run(["rm", "-rf", env_path])
+    os.makedirs(os.path.dirname(os.path.abspath(env_path)), exist_ok=True)
+    subprocess.run(["cp"] + clone_flags[mode] + [template_path, env_path], check=True)
+    os.remove(os.path.join(env_path, ".template_complete"))
+
+    old_path = os.path.abspath(template_path).encode()
+    new_path = os.path.abspath(env_path).encode()
+    bin_dir = os.path.join(env_path, "bin")
+    rewritten = set()
+    for file_path in [os.path.join(bin_dir, name) for name in os.listdir(bin_dir)] + [
+        os.path.join(env_path, "pyvenv.cfg")
+    ]:
+        if os.path.islink(file_path) or not os.path.isfile(file_path):
+            continue
+        with open(file_path, "rb") as f:
+            content = f.read()
+        if old_path not in content:
+            continue
+        tmp_path = f"{file_path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(content.replace(old_path, new_path))
+        os.chmod(tmp_path, os.stat(file_path).st_mode)
+        os.replace(tmp_path, file_path)
+        rewritten.add(os.path.abspath(file_path))
+    update_records(env_path, rewritten)
+    print(f"Virtual environment cloned from {template_path}: {env_path}")
+    return env_path
+
+
+def update_records(env_path, file_paths):
+    """
+    Write the sizes and sha256 of `file_paths` (absolute paths) into the RECORDs
+    of the distributions of `env_path` that list them, so that `verify_environment`
+    accepts them. The RECORDs are replaced, not edited: they may be hardlinks
+    into a template.
+    """
+    if not file_paths:
+        return
+    for record_path in Path(env_path).glob(
+        "lib/python*/site-packages/*.dist-info/RECORD"
+    ):
+        site_dir = record_path.parent.parent
+        with open(record_path, "r", encoding="utf-8") as f:
+            lines = f.read().splitlines()
+        changed = False
+        for i, line in enumerate(lines):
+            # path,sha256=<urlsafe b64 digest>,size; paths may contain commas
+            parts = line.rsplit(",", 2)
+            if len(parts) != 3:
+                continue
+            rel_path = parts[0].strip('"')
+            file_path = os.path.abspath(os.path.join(site_dir, rel_path))
+            if file_path not in file_paths:
+                continue
+            lines[i] = (
+                f"{parts[0]},sha256={record_digest(file_path)},"
+                f"{os.path.getsize(file_path)}"
             )
-        if library.lower() != "numpy":
-            numpy_versions = {
-                "3.7": "numpy==1.21.6",
-                "3.9": "numpy==1.21.6",
-                "3.10": "numpy==1.23",
-            }
-            install_pinpointed_package(
-                "numpy",
-                python_version,
-                python_executable,
-                deps_lower,
-                numpy_versions,
-                env_path,
+            changed = True
+        if changed:
+            tmp_path = f"{record_path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write("\n".join(lines) + "\n")
+            os.replace(tmp_path, record_path)
+
+
+def spec_hash(sample):
+    """Hash of everything installed in the environment of a row, pip and pinned packages included."""
+    spec = json.dumps(
+        {"python_version": sample["python_version"], "steps": install_steps(sample)},
+        sort_keys=True,
+    )
+    return hashlib.sha256(spec.encode()).hexdigest()
+
+
+def freeze_environment(env_path, pip_env=None):
+    """Return the `pip freeze --all` lock of an environment, or None if pip failed."""
+    result = subprocess.run(
+        [Path(env_path, "bin", "python"), "-m", "pip", "freeze", "--all"],
+        text=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        env=pip_env,
+    )
+    if result.returncode != 0:
+        return None
+    return sorted(line for line in result.stdout.splitlines() if line.strip())
+
+
+def interpreter_version(env_path):
+    result = subprocess.run(
+        [
+            Path(env_path, "bin", "python"),
+            "-c",
+            "import platform; print(platform.python_version())",
+        ],
+        text=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    return result.stdout.strip() if result.returncode == 0 else None
+
+
+def unsatisfied_requirements(sample, lock):
+    """
+    Return the `name==version` requirements of a row (library, additional
+    dependencies and pinned packages) that the lock does not satisfy.
+    """
+
+    def normalize(name):
+        return name.lower().replace("_", "-").replace(".", "-")
+
+    def release(version):
+        parts = version.split(".")
+        while len(parts) > 1 and parts[-1] == "0":
+            parts.pop()
+        return parts
+
+    locked = {}
+    for line in lock:
+        if "==" in line:
+            name, version = line.split("==", 1)
+            locked[normalize(name)] = version.strip()
+    unsatisfied = []
+    for step in install_steps(sample):
+        for requirement in step:
+            if "==" not in requirement:
+                continue
+            name, version = requirement.split("==", 1)
+            name = normalize(name.split("[")[0])
+            if name not in locked or release(locked[name]) != release(version):
+                unsatisfied.append(requirement)
+    return unsatisfied
+
+
+def import_name(library):
+    """Name the library is imported under, e.g. scikit-learn -> sklearn."""
+    return import_names.get(library.lower(), library.lower().replace("-", "_"))
+
+
+def site_packages(env_path):
+    """site-packages directories of an environment."""
+    return sorted(
+        str(path) for path in Path(env_path).glob("lib/python*/site-packages")
+    )
+
+
+def precompile_environment(env_path, pip_env=None):
+    """
+    Byte-compile everything in the site-packages of an environment, so that
+    evaluations never compile (or race to write) `.pyc` files of their own.
+    Files that do not compile (e.g. Python 2 test data shipped by a package) are skipped.
+    """
+    python_executable = Path(env_path, "bin", "python")
+    start_time = time.time()
+    subprocess.run(
+        [python_executable, "-m", "compileall", "-q", "-j", "0"]
+        + site_packages(env_path),
+        text=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        env=pip_env,
+    )
+    return time.time() - start_time
+
+
+def parse_importtime(stderr):
+    """Parse `-X importtime` output into a list of (module, self_us, cumulative_us)."""
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, module = line[len("import time:") :].split("|", 2)
+        imports.append((module.strip(), int(self_us), int(cumulative_us)))
+    return imports
+
+
+def warm_up_environment(env_path, library, pip_env=None):
+    """
+    Import the library of an environment twice with `-X importtime`, the first
+    time right after the build (cold) and then again (warm).
+    Returns the import times in microseconds and the modules that take most of
+    the warm import, or the import error.
+    """
+    python_executable = Path(env_path, "bin", "python")
+    module = import_name(library)
+    times = {"module": module}
+    for run in ["cold", "warm"]:
+        result = subprocess.run(
+            [python_executable, "-X", "importtime", "-c", f"import {module}"],
+            text=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            env=pip_env,
+        )
+        if result.returncode != 0:
+            times["error"] = result.stderr.strip().splitlines()[-1:]
+            return times
+        imports = parse_importtime(result.stderr)
+        times[f"{run}_us"] = next(
+            (cumulative for name, _, cumulative in reversed(imports) if name == module),
+            None,
+        )
+    times["slowest"] = [
+        [name, self_us]
+        for name, self_us, _ in sorted(imports, key=lambda i: i[1], reverse=True)[:10]
+    ]
+    return times
+
+
+def data_assets(samples, test_dir=None):
+    """
+    Data assets (see src/sandbox.py) fetched at run time by the starting code,
+    solution and tests of `samples`, including their hidden tests
+    `<test_dir>/test_sample_<example_id>.py` if `test_dir` is given.
+    """
+    texts = []
+    for sample in samples:
+        texts += [sample.get(col) for col in ["starting_code", "solution", "test"]]
+        if test_dir:
+            try:
+                with open(
+                    os.path.join(test_dir, f"test_sample_{sample['example_id']}.py")
+                ) as f:
+                    texts.append(f.read())
+            except OSError:
+                pass
+    return find_data_assets(texts)
+
+
+# commands run in an environment to fetch one data asset into its data directory
+_fetch_commands = {
+    "nltk": lambda env_path, name: [
+        "-c",
+        "import sys, nltk; sys.exit(not nltk.download(sys.argv[1], download_dir=sys.argv[2], "
+        "quiet=True, raise_on_error=True))",
+        name,
+        data_dir(env_path, "nltk"),
+    ],
+    "librosa": lambda env_path, name: [
+        "-c",
+        "import sys, librosa; librosa.ex(sys.argv[1])",
+        name,
+    ],
+    "spacy": lambda env_path, name: ["-m", "spacy", "download", name],
+}
+
+
+def prefetch_data_assets(env_path, assets, pip_env=None):
+    """
+    Download the data `assets` of an environment (as returned by `data_assets`)
+    with its own interpreter: nltk and librosa data into its data directory,
+    spaCy pipelines into the environment as packages.
+    Returns the names fetched per kind, e.g. {"nltk": ["wordnet"]}.
+    """
+    python_executable = str(Path(env_path, "bin", "python"))
+    fetched = {}
+    for kind, names in assets.items():
+        if not names:
+            continue
+        if kind in data_dirs:
+            os.makedirs(data_dir(env_path, kind), exist_ok=True)
+        env = sandbox_env(env_path, pip_env)
+        fetched[kind] = []
+        for name in names:
+            result = subprocess.run(
+                [python_executable] + _fetch_commands[kind](env_path, name),
+                text=True,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                env=env,
             )
-        if library.lower() != "scipy":
-            scipy_versions = {
-                "3.7": "scipy==1.7.1",
-                "3.9": "scipy==1.9.1",
-                "3.10": "scipy==1.10.1",
-            }
-            install_pinpointed_package(
-                "scipy",
-                python_version,
-                python_executable,
-                deps_lower,
-                scipy_versions,
+            if result.returncode == 0:
+                fetched[kind].append(name)
+            else:
+                error = (result.stderr or result.stdout).strip().splitlines()[-1:]
+                print(f"Failed to fetch {kind} data {name} into {env_path}: {error}")
+    return fetched
+
+
+def missing_data_assets(manifest, assets):
+    """Data assets of `assets` that the manifest of an environment does not record."""
+    fetched = (manifest or {}).get("data_assets") or {}
+    return [
+        f"{kind}:{name}"
+        for kind, names in assets.items()
+        for name in names
+        if name not in fetched.get(kind, [])
+    ]
+
+
+def write_environment_manifest(
+    env_path,
+    sample,
+    build_seconds,
+    pip_env=None,
+    import_times=None,
+    data_assets=None,
+    dropped_pins=None,
+):
+    """
+    Record the spec hash, interpreter version, lock and build time of an environment,
+    the import times measured by `warm_up_environment`, the data assets
+    fetched by `prefetch_data_assets` and the pinned packages `install_packages`
+    dropped.
+    """
+    lock = freeze_environment(env_path, pip_env=pip_env) or []
+    manifest = {
+        "spec": {
+            col: sample.get(col, "")
+            for col in [
+                "python_version",
+                "library",
+                "version",
+                "additional_dependencies",
+            ]
+        },
+        "spec_hash": spec_hash(sample),
+        "python": interpreter_version(env_path),
+        "lock": lock,
+        "unsatisfied": unsatisfied_requirements(sample, lock),
+        "dropped_pins": dropped_pins or [],
+        "build_seconds": round(build_seconds, 2),
+        "built_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "interpreter": (
+            "shared"
+            if os.path.islink(os.path.join(env_path, "bin", "python"))
+            else "copy"
+        ),
+        "import_times": import_times,
+        "data_assets": data_assets or {},
+    }
+    write_manifest(env_path, manifest)
+    return manifest
+
+
+def stale_reason(env_path, sample, pip_env=None, assets=None):
+    """
+    Return why the environment of a row must be rebuilt, or None if it is up to date:
+    its spec or its installed packages no longer match its manifest, or it lacks
+    some of the data `assets` its rows need.
+    """
+    if not os.path.exists(Path(env_path, "bin", "python")):
+        return "missing environment"
+    manifest = read_manifest(env_path)
+    if manifest is None:
+        return "missing manifest"
+    if manifest["spec_hash"] != spec_hash(sample):
+        return "spec changed"
+    # pinned packages dropped at install time stay unsatisfied, a rebuild would drop them again
+    dropped = set(manifest.get("dropped_pins") or [])
+    unsatisfied = [r for r in manifest.get("unsatisfied") or [] if r not in dropped]
+    if unsatisfied:
+        return f"unsatisfied requirements {unsatisfied}"
+    lock = freeze_environment(env_path, pip_env=pip_env)
+    if lock != manifest["lock"]:
+        return "installed packages differ from the lock"
+    missing = missing_data_assets(manifest, assets or {})
+    if missing:
+        return f"missing data assets {missing}"
+    return None
+
+
+def build_environment(
+    sample,
+    base_path,
+    create_anyway=False,
+    install_pkgs=False,
+    pip_env=None,
+    env_path=None,
+    clone=None,
+    interpreter="copy",
+    layers=False,
+    assets=None,
+):
+    """
+    Create the environment of one dataset row and install its packages.
+
+    The environment is created at `env_path`, by default `<base_path>/gcham_venv_<example_id>`.
+    With `clone` ("hardlink", "reflink" or "copy"), it is cloned from the template
+    of the row (see `ensure_template`) instead of being created from scratch, so
+    only the row-specific packages are installed on top.
+    `interpreter` is "copy" or "shared" (see `create_virtual_environment`).
+    With `layers`, the library comes from the shared layer of its version (see
+    `ensure_library_layer`) and only the rest of the install plan goes into the
+    environment itself.
+    After every install, site-packages is byte-compiled, the library is imported
+    once to measure its import time (see `warm_up_environment`) and a manifest
+    (see `write_environment_manifest`) is written. The data `assets` the rows
+    of the environment fetch at run time are prefetched (see `prefetch_data_assets`).
+    Returns one of "built", "exists", "skipped" or "failed".
+    """
+    start_time = time.time()
+    python_version = sample.get("python_version")
+    example_id = sample.get("example_id")
+    library = sample.get("library")
+    version = sample.get("version")
+    additional_dependencies = sample.get("additional_dependencies", "")
+    if not (python_version and example_id):
+        return "skipped"
+    pyenv_version = python_versions.get(python_version)
+    if not pyenv_version:
+        print(f"Unsupported Python version {python_version} for example {example_id}.")
+        return "skipped"
+
+    if env_path is None:
+        env_path = Path(base_path, example_env_name(example_id))
+
+    python_exec = Path(env_path, "bin", "python")
+    if os.path.exists(python_exec):
+        print(f"Environment already exists for {example_id}.")
+        if not install_pkgs:
+            return "exists"
+    else:
+        print(f"Python executable not found for {example_id}. Creating environment...")
+        if clone:
+            template_path = ensure_template(
+                base_path, sample, pip_env=pip_env, interpreter=interpreter
+            )
+            if template_path is None:
+                return "failed"
+            env_created = clone_environment(template_path, env_path, mode=clone)
+            if interpreter == "shared":
+                reason = validate_shared_interpreter(
+                    env_path, base_python_executable(pyenv_version)
+                )
+                if reason is not None:
+                    print(f"Shared interpreter check failed for {env_path}: {reason}")
+                    return "failed"
+        else:
+            env_created = create_virtual_environment(
                 env_path,
+                pyenv_version,
+                create_anyway=create_anyway,
+                library_to_check=library,
+                interpreter=interpreter,
             )
+        if env_created is None:
+            return "failed"
 
-    return result.returncode
+    if layers:
+        layer_path = ensure_library_layer(base_path, sample, pip_env=pip_env)
+        if layer_path is not None:
+            link_layers(env_path, [layer_path])
 
+    returncode, dropped_pins = install_packages(
+        env_path,
+        library,
+        version,
+        additional_dependencies,
+        python_version,
+        pip_env=pip_env,
+    )
+    if returncode != 0:
+        return "failed"
+    precompile_environment(env_path, pip_env=pip_env)
+    import_times = warm_up_environment(env_path, library, pip_env=pip_env)
+    fetched = prefetch_data_assets(env_path, assets or {}, pip_env=pip_env)
+    write_environment_manifest(
+        env_path,
+        sample,
+        time.time() - start_time,
+        pip_env=pip_env,
+        import_times=import_times,
+        data_assets=fetched,
+        dropped_pins=dropped_pins,
+    )
+    return "built"
+
+
+def build_environments(
+    samples,
+    base_path,
+    jobs=1,
+    create_anyway=False,
+    install_pkgs=False,
+    pip_cache_dir=None,
+    shared=True,
+    wheelhouse=None,
+    clone=None,
+    rebuild=False,
+    interpreter="copy",
+    layers=False,
+    on_built=None,
+    test_dir=None,
+):
+    """
+    Build the environments of `samples` with a pool of `jobs` workers.
+
+    With `rebuild`, existing environments are checked against their manifest
+    (see `stale_reason`) and only the stale ones are deleted and built again.
+
+    With `shared`, rows with the same `env_key` are built once in the store and
+    their `gcham_venv_<example_id>` names are linked to it (see src/env_store.py).
+    With `wheelhouse`, packages are installed only from the wheelhouse filled by
+    `prefetch_wheelhouse`, without contacting any index.
+    With `clone`, environments are cloned from per-Python-version templates (see
+    `build_environment`).
+    With `interpreter="shared"`, environments symlink the pyenv interpreter
+    instead of copying it (see `create_virtual_environment`).
+    With `layers`, environments share one read-only layer per library version
+    (see `ensure_library_layer`).
+    The data assets fetched by the rows of each environment and by their hidden
+    tests in `test_dir` are prefetched into it (see `data_assets`).
+    Each worker holds a slot with its own pip cache and temporary directory for
+    the whole duration of a build. Builds start in the order of `samples`.
+    `on_built(key, status, example_ids)` is called as soon as each environment is done.
+    Returns a dict mapping example_id to the status returned by `build_environment`.
+    """
+    jobs = max(jobs, 1)
+    pip_cache_dir = pip_cache_dir or os.path.join(base_path, ".pip_cache")
+    free_slots = list(range(jobs))
+    slots_lock = threading.Lock()
+
+    # one build per shared environment, or one per example
+    groups = {}
+    shared_keys = set()
+    for sample in samples:
+        if shared and sample.get("python_version") in python_versions:
+            shared_keys.add(env_key(sample))
+            groups.setdefault(env_key(sample), []).append(sample)
+        else:
+            groups.setdefault(example_env_name(sample["example_id"]), []).append(sample)
+
+    def build(key, sample, assets):
+        with slots_lock:
+            slot = free_slots.pop()
+        try:
+            pip_env = pip_environment(
+                cache_dir=os.path.join(pip_cache_dir, f"worker_{slot}"),
+                tmp_dir=os.path.join(base_path, ".tmp", f"worker_{slot}"),
+                find_links=(
+                    wheelhouse_dir(wheelhouse, sample["python_version"])
+                    if wheelhouse
+                    else None
+                ),
+                no_index=bool(wheelhouse),
+            )
+            if key in shared_keys:
+                env_path = store_env_path(base_path, key)
+            else:
+                env_path = os.path.join(base_path, key)
+            if rebuild:
+                reason = stale_reason(env_path, sample, pip_env=pip_env, assets=assets)
+                if reason is None:
+                    return "exists"
+                print(f"Rebuilding {key}: {reason}")
+                subprocess.run(["rm", "-rf", env_path])
+            return build_environment(
+                sample,
+                base_path,
+                create_anyway=create_anyway,
+                install_pkgs=install_pkgs,
+                pip_env=pip_env,
+                env_path=env_path,
+                clone=clone,
+                interpreter=interpreter,
+                layers=layers,
+                assets=assets,
+            )
+        except Exception as e:
+            print(f"Error building environment {key}: {e}")
+            return "failed"
+        finally:
+            with slots_lock:
+                free_slots.append(slot)
+
+    statuses = {}
+    with ThreadPoolExecutor(max_workers=jobs) as exe:
+        futures = {
+            exe.submit(build, key, group[0], data_assets(group, test_dir)): key
+            for key, group in groups.items()
+        }
+        progress = tqdm(as_completed(futures), total=len(futures), desc="Building envs")
+        for fut in progress:
+            key = futures[fut]
+            status = fut.result()
+            example_ids = [sample["example_id"] for sample in groups[key]]
+            for example_id in example_ids:
+                statuses[example_id] = status
+            progress.write(f"[{status}] {key}: examples {', '.join(example_ids)}")
+            if key in shared_keys and status in ("built", "exists"):
+                sample = groups[key][0]
+                spec = {
+                    col: sample.get(col, "")
+                    for col in [
+                        "python_version",
+                        "library",
+                        "version",
+                        "additional_dependencies",
+                    ]
+                }
+                for example_id in example_ids:
+                    link_example(base_path, example_id, key)
+                update_index(
+                    base_path,
+                    envs={key: spec},
+                    examples={example_env_name(i): key for i in example_ids},
+                )
+            if on_built is not None:
+                on_built(key, status, example_ids)
+    return statuses
+
+
+def prefetch_environment_assets(
+    samples, base_path, jobs=1, test_dir=None, pip_cache_dir=None
+):
+    """
+    Fetch the data assets that existing environments lack (see `data_assets`),
+    without rebuilding them, and record them in their manifests.
+    Returns the environments whose assets could not all be fetched.
+    """
+    pip_cache_dir = pip_cache_dir or os.path.join(base_path, ".pip_cache")
+    groups = {}
+    for sample in samples:
+        env_path = resolve_env_path(base_path, example_env_name(sample["example_id"]))
+        if os.path.exists(os.path.join(env_path, "bin", "python")):
+            groups.setdefault(os.path.realpath(env_path), []).append(sample)
+
+    def fetch(env_path, group):
+        manifest = read_manifest(env_path)
+        assets = data_assets(group, test_dir)
+        missing = missing_data_assets(manifest, assets)
+        if not missing or manifest is None:
+            return missing
+        pip_env = pip_environment(
+            cache_dir=pip_cache_dir,
+            tmp_dir=os.path.join(base_path, ".tmp", os.path.basename(env_path)),
+        )
+        todo = {
+            kind: [name for name in names if f"{kind}:{name}" in missing]
+            for kind, names in assets.items()
+        }
+        fetched = manifest.get("data_assets") or {}
+        for kind, names in prefetch_data_assets(env_path, todo, pip_env).items():
+            fetched[kind] = sorted(set(fetched.get(kind, [])) | set(names))
+        manifest["data_assets"] = fetched
+        write_manifest(env_path, manifest)
+        return missing_data_assets(manifest, assets)
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as exe:
+        futures = {
+            exe.submit(fetch, env_path, group): env_path
+            for env_path, group in groups.items()
+        }
+        for fut in tqdm(
+            as_completed(futures), total=len(futures), desc="Fetching data"
+        ):
+            missing = fut.result()
+            if missing:
+                failed.append(futures[fut])
+                print(f"Missing data assets in {futures[fut]}: {', '.join(missing)}")
+    return failed
+
+
+def write_build_summary(base_path, statuses):
+    """Write the build status of every example and the failed IDs to a JSON file."""
+    example_ids = sorted(statuses, key=int)
+    summary = {
+        "total": len(example_ids),
+        "failed": [i for i in example_ids if statuses[i] == "failed"],
+        "statuses": {i: statuses[i] for i in example_ids},
+    }
+    summary_path = os.path.join(base_path, "build_summary.json")
+    with open(summary_path, "w") as f:
+        json.dump(summary, f, indent=4)
+    return summary_path
+
+
+def wheelhouse_dir(wheelhouse, python_version):
+    """Directory of the wheelhouse holding the distributions for one Python version."""
+    return os.path.join(wheelhouse, f"py{python_version}")
+
+
+def install_plan(sample):
+    """
+    Requirements `install_packages` installs for a row in a single resolver pass:
+    the library at its version, the additional dependencies, then the pinned packages.
+    """
+    _, _, other_dependencies = parse_dependencies(
+        sample.get("additional_dependencies", "")
+    )
+    return (
+        [f"{sample['library']}=={sample['version']}"]
+        + other_dependencies
+        + pinned_specs(sample)
+    )
+
+
+def install_steps(sample):
+    """
+    Requirements of the successive pip installs that `install_packages` runs for a row:
+    pip itself, then the install plan of the row.
+    """
+    _, pip_version, _ = parse_dependencies(sample.get("additional_dependencies", ""))
+    return [[f"pip=={pip_version}" if pip_version else "pip"], install_plan(sample)]
+
+
+def prefetch_wheelhouse(
+    samples,
+    wheelhouse,
+    jobs=1,
+    pip_cache_dir=None,
+    index_url=None,
+    find_links=None,
+    docker=True,
+):
+    """
+    Download every wheel and sdist needed to build the environments of `samples`
+    into `<wheelhouse>/py<python_version>`.
+
+    Each install step of each row is resolved with `pip download` by the pyenv
+    interpreter of the row, so the downloaded wheels match its tags. setuptools
+    and wheel are added so that sdists can be built without an index. Workers
+    download into private directories and move the files into the wheelhouse
+    once pip is done. Packages are fetched from `index_url` and `find_links`
+    (e.g. a local directory or a local index server) when given, else from PyPI.
+    Returns the list of (python_version, requirements) that could not be downloaded.
+    """
+    jobs = max(jobs, 1)
+    pip_cache_dir = pip_cache_dir or os.path.join(wheelhouse, ".pip_cache")
+    free_slots = list(range(jobs))
+    slots_lock = threading.Lock()
+
+    tasks = []
+    for sample in samples:
+        python_version = sample.get("python_version")
+        if python_version not in python_versions:
+            continue
+        for step in [["setuptools", "wheel"]] + install_steps(sample):
+            if (python_version, step) not in tasks:
+                tasks.append((python_version, step))
+
+    def download(python_version, requirements):
+        with slots_lock:
+            slot = free_slots.pop()
+        try:
+            incoming = os.path.join(wheelhouse, ".incoming", f"worker_{slot}")
+            os.makedirs(incoming, exist_ok=True)
+            pip_env = pip_environment(
+                cache_dir=os.path.join(pip_cache_dir, f"worker_{slot}"),
+                tmp_dir=os.path.join(wheelhouse, ".tmp", f"worker_{slot}"),
+                index_url=index_url,
+                find_links=find_links,
+            )
+            result = subprocess.run(
+                [
+                    base_python_executable(
+                        python_versions[python_version], docker=docker
+                    ),
+                    "-m",
+                    "pip",
+                    "download",
+                    "--dest",
+                    incoming,
+                    "--quiet",
+                ]
+                + requirements,
+                text=True,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                env=pip_env,
+            )
+            destination = wheelhouse_dir(wheelhouse, python_version)
+            os.makedirs(destination, exist_ok=True)
+            for file_name in os.listdir(incoming):
+                os.replace(
+                    os.path.join(incoming, file_name),
+                    os.path.join(destination, file_name),
+                )
+            if result.returncode != 0:
+                print(f"Failed to download {requirements}: {result.stderr}")
+            return result.returncode
+        except Exception as e:
+            print(f"Error downloading {requirements}: {e}")
+            return 1
+        finally:
+            with slots_lock:
+                free_slots.append(slot)
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=jobs) as exe:
+        futures = {
+            exe.submit(download, python_version, step): (python_version, step)
+            for python_version, step in tasks
+        }
+        progress = tqdm(as_completed(futures), total=len(futures), desc="Prefetching")
+        for fut in progress:
+            python_version, step = futures[fut]
+            if fut.result() != 0:
+                failed.append((python_version, step))
+                progress.write(f"[failed] py{python_version}: {' '.join(step)}")
+    return failed
 
-def generate_env_id(row):
-    """Generate a unique ID based on library, version, and dependencies."""
-    unique_str = f"{row['library']}-{row['version']}-{row['additional_dependencies']}"
-    return hashlib.sha256(unique_str.encode()).hexdigest()[:8]
+
+def download_size(url):
+    """Size in bytes of a distribution pip would download, or None if unknown."""
+    url = url.split("#", 1)[0]
+    if url.startswith("file://"):
+        try:
+            return os.path.getsize(urllib.request.url2pathname(url[len("file://") :]))
+        except OSError:
+            return None
+    try:
+        request = urllib.request.Request(url, method="HEAD")
+        with urllib.request.urlopen(request, timeout=30) as response:
+            length = response.headers.get("Content-Length")
+        return int(length) if length is not None else None
+    except (OSError, ValueError):
+        return None
+
+
+def preflight_environment(sample, pip_env=None, docker=True):
+    """
+    Resolve the install plan of a row with `pip install --dry-run` run by the
+    pyenv interpreter of the row, without installing anything.
+    Returns the resolution status, time, resolved distributions and their URLs.
+    """
+    plan = install_plan(sample)
+    start_time = time.time()
+    with tempfile.TemporaryDirectory(dir=(pip_env or {}).get("TMPDIR")) as tmp_dir:
+        report_path = os.path.join(tmp_dir, "report.json")
+        result = subprocess.run(
+            [
+                base_python_executable(
+                    python_versions[sample["python_version"]], docker=docker
+                ),
+                "-m",
+                "pip",
+                "install",
+                "--dry-run",
+                "--ignore-installed",
+                "--quiet",
+                "--report",
+                report_path,
+            ]
+            + plan,
+            text=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            env=pip_env,
+        )
+        report = {}
+        if result.returncode == 0 and os.path.exists(report_path):
+            with open(report_path, "r") as f:
+                report = json.load(f)
+    items = report.get("install", [])
+    return {
+        "python_version": sample["python_version"],
+        "plan": plan,
+        "status": "ok" if result.returncode == 0 else "unsatisfiable",
+        "seconds": round(time.time() - start_time, 2),
+        "resolved": [
+            f"{item['metadata']['name']}=={item['metadata']['version']}"
+            for item in items
+        ],
+        "urls": [item["download_info"]["url"] for item in items],
+        "error": result.stderr.strip()[-2000:] if result.returncode != 0 else "",
+    }
+
+
+def preflight(
+    samples,
+    base_path,
+    jobs=1,
+    pip_cache_dir=None,
+    index_url=None,
+    find_links=None,
+    wheelhouse=None,
+    slow_seconds=60,
+    docker=True,
+):
+    """
+    Resolve the install plan of every distinct spec of `samples` in parallel,
+    without building anything, and report the unsatisfiable specs, the specs
+    slower than `slow_seconds` to resolve, and the download volume of a full build.
+
+    Results are cached by `spec_hash` in `<base_path>/preflight.json`; specs that
+    resolved before are not resolved again. Workers keep their pip caches (with
+    the package metadata pip fetched) between runs, like `build_environments`.
+    Returns the results, keyed by `env_key`.
+    """
+    jobs = max(jobs, 1)
+    pip_cache_dir = pip_cache_dir or os.path.join(base_path, ".pip_cache")
+    free_slots = list(range(jobs))
+    slots_lock = threading.Lock()
+    preflight_path = os.path.join(base_path, "preflight.json")
+    try:
+        with open(preflight_path, "r") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+
+    groups = {}
+    for sample in samples:
+        if sample.get("python_version") in python_versions:
+            groups.setdefault(env_key(sample), []).append(sample)
+
+    def resolve(sample):
+        with slots_lock:
+            slot = free_slots.pop()
+        try:
+            pip_env = pip_environment(
+                cache_dir=os.path.join(pip_cache_dir, f"worker_{slot}"),
+                tmp_dir=os.path.join(base_path, ".tmp", f"worker_{slot}"),
+                index_url=index_url,
+                find_links=(
+                    wheelhouse_dir(wheelhouse, sample["python_version"])
+                    if wheelhouse
+                    else find_links
+                ),
+                no_index=bool(wheelhouse),
+            )
+            return preflight_environment(sample, pip_env=pip_env, docker=docker)
+        finally:
+            with slots_lock:
+                free_slots.append(slot)
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=jobs) as exe:
+        futures = {}
+        for key, group in groups.items():
+            cached = cache.get(spec_hash(group[0]))
+            if cached is not None and cached["status"] == "ok":
+                results[key] = cached
+            else:
+                futures[exe.submit(resolve, group[0])] = key
+        progress = tqdm(as_completed(futures), total=len(futures), desc="Preflight")
+        for fut in progress:
+            key = futures[fut]
+            try:
+                results[key] = fut.result()
+            except Exception as e:
+                results[key] = {"status": "unsatisfiable", "error": str(e)}
+            if results[key]["status"] != "ok":
+                progress.write(f"[unsatisfiable] {key}")
+
+    # download volume: every distinct distribution once per Python version
+    urls = set()
+    for result in results.values():
+        if result["status"] == "ok":
+            urls.update(url.split("#", 1)[0] for url in result["urls"])
+    with ThreadPoolExecutor(max_workers=16) as exe:
+        sizes = dict(zip(urls, exe.map(download_size, urls)))
+
+    for key, result in results.items():
+        result["examples"] = [sample["example_id"] for sample in groups[key]]
+        cache[spec_hash(groups[key][0])] = result
+    tmp_path = f"{preflight_path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(cache, f, indent=4)
+    os.replace(tmp_path, preflight_path)
+
+    unsatisfiable = [key for key in results if results[key]["status"] != "ok"]
+    slow = [
+        key
+        for key in results
+        if results[key]["status"] == "ok" and results[key]["seconds"] > slow_seconds
+    ]
+    known = [size for size in sizes.values() if size is not None]
+    print(
+        f"Specs: {len(results)}, unsatisfiable: {len(unsatisfiable)}, slow: {len(slow)}"
+    )
+    for key in unsatisfiable:
+        examples = ", ".join(results[key].get("examples", []))
+        error = results[key]["error"].splitlines()[-1:] or [""]
+        print(f"Unsatisfiable {key} (examples {examples}): {error[0]}")
+    for key in slow:
+        print(f"Slow to resolve {key}: {results[key]['seconds']}s")
+    print(
+        f"Expected download volume: {sum(known) / (1 << 20):.1f} MiB in {len(sizes)} "
+        f"distributions ({len(sizes) - len(known)} of unknown size)"
+    )
+    return results
 
 
 def main(args):
-    jsonl_file = args.dataset
+    # imported here, src.env_cache builds missing environments with this module
+    from src.env_cache import evict_environments, parse_size
+
     base_path = args.base_path
-    create_anyway = args.create_anyway
-    start_id = args.start
-    end_id = args.end
 
     # Ensure the base path exists
     os.makedirs(base_path, exist_ok=True)
-    failed_count = []
 
     # Read the JSONL file and process only lines between start_id and end_id (inclusive)
-    with open(jsonl_file, "r") as file:
-        for line_number, line in enumerate(file, start=1):
-            sample = json.loads(line)
-            python_version = sample.get("python_version")
-            example_id = sample.get("example_id")
-            library = sample.get("library")
-            version = sample.get("version")
-            additional_dependencies = sample.get("additional_dependencies", "")
-            if int(example_id) < start_id or int(example_id) > end_id:
-                continue
-            if python_version and example_id:
-                pyenv_version = python_versions.get(python_version)
-                if not pyenv_version:
-                    print(
-                        f"Unsupported Python version {python_version} for example {example_id}."
-                    )
-                    continue
-
-                env_name = f"gcham_venv_{example_id}"
-                env_path = Path(base_path, env_name)
-
-                python_exec = Path(env_path, "bin", "python")
-                if not os.path.exists(python_exec):
-                    print(
-                        f"Python executable not found for {example_id}. Creating environment..."
-                    )
-                    create_virtual_environment(
-                        env_path,
-                        pyenv_version,
-                        create_anyway=create_anyway,
-                        library_to_check=library,
-                    )
-                    returncode = install_packages(
-                        env_path,
-                        library,
-                        version,
-                        additional_dependencies,
-                        python_version,
-                    )
-                    if returncode != 0:
-                        failed_count.append(example_id)
-                else:
-                    print(f"Environment already exists for {example_id}.")
-                    if args.install_pkgs:
-                        returncode = install_packages(
-                            env_path,
-                            library,
-                            version,
-                            additional_dependencies,
-                            python_version,
-                        )
-                        if returncode != 0:
-                            failed_count.append(example_id)
+    samples = load_samples(args.dataset, args.start, args.end)
+
+    if args.command in ("export", "import"):
+        assert args.bundle_dir, f"{args.command} needs --bundle_dir."
+        example_ids = [sample["example_id"] for sample in samples]
+        if args.command == "export":
+            failed = export_bundles(base_path, args.bundle_dir, example_ids, args.jobs)
+            print(f"Failed exports: {len(failed)}")
+            for name in failed:
+                print(f"Failed to export environment: {name}")
+        else:
+            failed = import_bundles(args.bundle_dir, base_path, example_ids, args.jobs)
+            print(f"Failed imports: {len(failed)}")
+            for example_id in failed:
+                print(f"Failed to import environment for example ID: {example_id}")
+        return
+
+    if args.command == "verify":
+        ok = verification_gate(
+            base_path,
+            [example_env_name(sample["example_id"]) for sample in samples],
+            jobs=args.jobs,
+            full=args.full_hashes,
+        )
+        if not ok:
+            sys.exit(1)
+        return
+
+    if args.command == "evict":
+        assert args.budget, "evict needs --budget."
+        evicted = evict_environments(base_path, parse_size(args.budget))
+        print(f"Evicted: {len(evicted)}")
+        return
+
+    if args.command == "preflight":
+        preflight(
+            samples,
+            base_path,
+            jobs=args.jobs,
+            pip_cache_dir=args.pip_cache_dir,
+            index_url=args.index_url,
+            find_links=args.find_links,
+            wheelhouse=args.wheelhouse,
+            slow_seconds=args.slow_seconds,
+        )
+        return
+
+    if args.command == "assets":
+        failed = prefetch_environment_assets(
+            samples,
+            base_path,
+            jobs=args.jobs,
+            test_dir=args.test_dir,
+            pip_cache_dir=args.pip_cache_dir,
+        )
+        print(f"Environments with missing data assets: {len(failed)}")
+        return
+
+    if args.command == "prefetch":
+        assert args.wheelhouse, "prefetch needs --wheelhouse."
+        failed = prefetch_wheelhouse(
+            samples,
+            args.wheelhouse,
+            jobs=args.jobs,
+            pip_cache_dir=args.pip_cache_dir,
+            index_url=args.index_url,
+            find_links=args.find_links,
+        )
+        print(f"Failed downloads: {len(failed)}")
+        for python_version, step in failed:
+            print(f"Failed to download for Python {python_version}: {' '.join(step)}")
+        return
+
+    statuses = build_environments(
+        samples,
+        base_path,
+        jobs=args.jobs,
+        create_anyway=args.create_anyway,
+        install_pkgs=args.install_pkgs,
+        pip_cache_dir=args.pip_cache_dir,
+        shared=args.layout == "shared",
+        wheelhouse=args.wheelhouse,
+        clone=None if args.clone == "none" else args.clone,
+        rebuild=args.command == "rebuild",
+        interpreter=args.interpreter,
+        layers=args.layers,
+        test_dir=args.test_dir,
+    )
+    failed_count = [i for i in sorted(statuses, key=int) if statuses[i] == "failed"]
 
     print(f"Failed: {len(failed_count)}")
     for example_id in failed_count:
         print(f"Failed to create environment for example ID: {example_id}")
+    print(f"Build summary written to {write_build_summary(base_path, statuses)}")
+    if args.budget:
+        evict_environments(base_path, parse_size(args.budget))
 
 
 if __name__ == "__main__":
     import argparse
 
     parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "command",
+        nargs="?",
+        choices=[
+            "build",
+            "rebuild",
+            "preflight",
+            "prefetch",
+            "assets",
+            "export",
+            "import",
+            "evict",
+            "verify",
+        ],
+        default="build",
+        help="build: create the missing environments (default). "
+        "rebuild: also rebuild the environments whose spec or lock no longer matches their manifest. "
+        "preflight: resolve every spec without installing it and report the unsatisfiable "
+        "ones and the download volume. "
+        "prefetch: download all distributions the dataset needs into --wheelhouse. "
+        "assets: fetch the data (nltk corpora, librosa examples, spaCy pipelines) "
+        "the examples download at run time into their existing environments. "
+        "export: pack the environments of --base_path into bundles in --bundle_dir. "
+        "import: unpack the bundles the selected examples need into --base_path. "
+        "evict: delete the least recently used environments until they fit in --budget. "
+        "verify: check the installed files and packages of the environments against "
+        "their RECORDs and manifest locks.",
+    )
     parser.add_argument(
         "--dataset", type=str, required=True, help="Path to the JSONL dataset file."
     )
@@ -344,5 +1714,101 @@ if __name__ == "__main__":
         default=sys.maxsize,
         help="End line number (inclusive) until which to create the environments.",
     )
+    parser.add_argument(
+        "--layout",
+        type=str,
+        choices=["shared", "per_example"],
+        default="shared",
+        help="Build one environment per distinct spec in <base_path>/store and link "
+        "gcham_venv_<id> to it (shared), or one environment per example (per_example).",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of environments to build in parallel.",
+    )
+    parser.add_argument(
+        "--clone",
+        type=str,
+        choices=["none", "hardlink", "reflink", "copy"],
+        default="none",
+        help="Clone new environments from per-Python-version templates with the pinned "
+        "packages pre-installed, using hardlinks, reflinks or plain copies.",
+    )
+    parser.add_argument(
+        "--slow_seconds",
+        type=float,
+        default=60,
+        help="preflight reports the specs that take longer than this to resolve.",
+    )
+    parser.add_argument(
+        "--budget",
+        type=str,
+        default=None,
+        help="Disk budget of the environments (e.g. 200G). After a build, and with "
+        "the evict command, the least recently used environments are deleted until "
+        "they fit in it.",
+    )
+    parser.add_argument(
+        "--interpreter",
+        type=str,
+        choices=["copy", "shared"],
+        default="copy",
+        help="Copy the interpreter into every environment (venv --copies), or share "
+        "the read-only pyenv interpreter of each Python version through symlinks "
+        "(venv --symlinks).",
+    )
+    parser.add_argument(
+        "--layers",
+        action="store_true",
+        default=False,
+        help="Install each library version once in a read-only layer under "
+        "<base_path>/layers, shared by the environments that use it, and install "
+        "only the remaining requirements in each environment.",
+    )
+    parser.add_argument(
+        "--full_hashes",
+        action="store_true",
+        default=False,
+        help="verify also checks the sha256 of every installed file, not only its size.",
+    )
+    parser.add_argument(
+        "--test_dir",
+        type=str,
+        default=None,
+        help="Directory of the hidden tests (test_sample_<id>.py), also scanned for "
+        "the data assets to prefetch.",
+    )
+    parser.add_argument(
+        "--bundle_dir",
+        type=str,
+        default=None,
+        help="Directory of the environment bundles used by export and import.",
+    )
+    parser.add_argument(
+        "--wheelhouse",
+        type=str,
+        default=None,
+        help="Local wheelhouse. prefetch fills it; build installs only from it (--no-index).",
+    )
+    parser.add_argument(
+        "--index_url",
+        type=str,
+        default=None,
+        help="Package index used by prefetch instead of PyPI (e.g. a local index server).",
+    )
+    parser.add_argument(
+        "--find_links",
+        type=str,
+        default=None,
+        help="Extra local directory or URL of distributions used by prefetch.",
+    )
+    parser.add_argument(
+        "--pip_cache_dir",
+        type=str,
+        default=None,
+        help="Root of the per-worker pip caches (default: <base_path>/.pip_cache).",
+    )
     args = parser.parse_args()
     main(args)
@@ -0,0 +1,325 @@
+"""
+Portable bundles of built environments.
+
+`export_bundles` packs every environment (a shared store entry or a standalone
+gcham_venv_<example_id>) into its own `<name>.tar.gz` and records the bundles in
+`bundles.json`:
+    {
+        "py3.7-1a2b3c4d": {
+            "file": "py3.7-1a2b3c4d.tar.gz",
+            "path": "store/py3.7-1a2b3c4d",    # location relative to the base path
+            "sha256": ..., "size": ...,
+            "examples": ["0", "1", ...],
+            "spec_hash": ...                    # from the environment manifest
+        },
+        ...
+    }
+Bundles of environments built with library layers also hold those layers.
+`import_bundles` unpacks only the bundles needed by a set of examples into
+another base path (e.g. node-local scratch), checking their checksum, and
+restores the links and the lookup table of the store.
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import socket
+import subprocess
+import tarfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from tqdm import tqdm
+
+from src.env_store import (
+    LAYERS_DIR,
+    example_env_name,
+    link_example,
+    linked_layers,
+    load_index,
+    read_manifest,
+    update_index,
+)
+
+BUNDLE_INDEX = "bundles.json"
+
+
+class _HashingFile:
+    """File wrapper that computes the sha256 of everything read or written through it."""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.size += len(data)
+        return self.fileobj.write(data)
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.sha256.update(data)
+        self.size += len(data)
+        return data
+
+    def close(self):
+        pass
+
+
+def load_bundle_index(bundle_dir):
+    try:
+        with open(os.path.join(bundle_dir, BUNDLE_INDEX), "r") as f:
+            return json.load(f)
+    except OSError:
+        return {}
+
+
+def update_bundle_index(bundle_dir, entries):
+    """
+    Merge `entries` into the bundle index of `bundle_dir`.
+    The index is locked while it is updated, so several jobs can export to the same directory.
+    """
+    index_path = os.path.join(bundle_dir, BUNDLE_INDEX)
+    with open(f"{index_path}.lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        bundle_index = load_bundle_index(bundle_dir)
+        for name, entry in entries.items():
+            examples = set(bundle_index.get(name, {}).get("examples", []))
+            entry["examples"] = sorted(examples | set(entry["examples"]), key=int)
+            bundle_index[name] = entry
+        tmp_path = f"{index_path}.tmp.{os.getpid()}"
+        with open(tmp_path, "w") as f:
+            json.dump(bundle_index, f, indent=4, sort_keys=True)
+        os.replace(tmp_path, index_path)
+
+
+def environments_of(base_path, example_ids):
+    """
+    Group examples by the environment they use.
+    Returns {name: (path relative to base_path, [example_ids])}.
+    """
+    index = load_index(base_path)
+    environments = {}
+    for example_id in example_ids:
+        env_key = index["examples"].get(example_env_name(example_id))
+        if env_key is not None:
+            name, rel_path = env_key, os.path.join("store", env_key)
+        else:
+            name = rel_path = example_env_name(example_id)
+        environments.setdefault(name, (rel_path, []))[1].append(example_id)
+    return environments
+
+
+def export_bundle(base_path, rel_path, bundle_path):
+    """
+    Pack `<base_path>/<rel_path>` and the library layers it links into `bundle_path`.
+    Returns (sha256, size).
+    """
+    env_path = os.path.join(base_path, rel_path)
+    # unique per writer: jobs on several nodes may export to the same directory
+    tmp_path = f"{bundle_path}.tmp.{socket.gethostname()}.{os.getpid()}.{threading.get_ident()}"
+    try:
+        with open(tmp_path, "wb") as f:
+            hashing_file = _HashingFile(f)
+            with tarfile.open(
+                fileobj=hashing_file, mode="w:gz", compresslevel=6
+            ) as tar:
+                tar.add(env_path, arcname=rel_path)
+                for layer_path in linked_layers(env_path):
+                    tar.add(layer_path, arcname=os.path.relpath(layer_path, base_path))
+        os.replace(tmp_path, bundle_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return hashing_file.sha256.hexdigest(), hashing_file.size
+
+
+def export_bundles(base_path, bundle_dir, example_ids, jobs=1):
+    """
+    Export the environments used by `example_ids` to `bundle_dir`.
+    Bundles whose environment manifest did not change since the last export are kept.
+    A bundle is written by one job at a time (other jobs sharing `bundle_dir`
+    wait and reuse it), and recorded in the index before the next one may
+    replace it, so the index always holds the checksum of the file in place.
+    Returns the names of the environments that could not be exported.
+    """
+    os.makedirs(bundle_dir, exist_ok=True)
+    bundle_index = load_bundle_index(bundle_dir)
+    environments = environments_of(base_path, example_ids)
+    # bundles exported here, already in the index
+    recorded = set()
+
+    def up_to_date(entry, bundle_path, manifest):
+        return (
+            entry is not None
+            and os.path.exists(bundle_path)
+            and manifest.get("spec_hash") is not None
+            and entry.get("spec_hash") == manifest.get("spec_hash")
+            and entry.get("built_at") == manifest.get("built_at")
+        )
+
+    def export(name, rel_path):
+        env_path = os.path.join(base_path, rel_path)
+        if not os.path.exists(os.path.join(env_path, "bin", "python")):
+            print(f"Environment {env_path} not found, not exporting it.")
+            return None
+        manifest = read_manifest(env_path) or {}
+        bundle_path = os.path.join(bundle_dir, f"{name}.tar.gz")
+        if up_to_date(bundle_index.get(name), bundle_path, manifest):
+            return bundle_index[name]
+        with open(f"{bundle_path}.lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            # another job may have exported it while this one waited
+            entry = load_bundle_index(bundle_dir).get(name)
+            if up_to_date(entry, bundle_path, manifest):
+                return entry
+            sha256, size = export_bundle(base_path, rel_path, bundle_path)
+            entry = {
+                "file": os.path.basename(bundle_path),
+                "path": rel_path,
+                "sha256": sha256,
+                "size": size,
+                "spec_hash": manifest.get("spec_hash"),
+                "built_at": manifest.get("built_at"),
+                "spec": manifest.get("spec"),
+            }
+            update_bundle_index(
+                bundle_dir, {name: dict(entry, examples=environments[name][1])}
+            )
+            recorded.add(name)
+        return entry
+
+    failed = []
+    entries = {}
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as exe:
+        futures = {
+            exe.submit(export, name, rel_path): name
+            for name, (rel_path, _) in environments.items()
+        }
+        for fut in tqdm(as_completed(futures), total=len(futures), desc="Exporting"):
+            name = futures[fut]
+            try:
+                entry = fut.result()
+            except Exception as e:
+                print(f"Error exporting {name}: {e}")
+                entry = None
+            if entry is None:
+                failed.append(name)
+                continue
+            if name not in recorded:
+                entries[name] = dict(entry, examples=environments[name][1])
+    update_bundle_index(bundle_dir, entries)
+    return failed
+
+
+def _safe_members(tar, rel_path):
+    for member in tar:
+        if os.path.isabs(member.name) or ".." in member.name.split("/"):
+            raise ValueError(f"Unsafe path in bundle: {member.name}")
+        if not any(
+            member.name == prefix or member.name.startswith(prefix + "/")
+            for prefix in [rel_path, LAYERS_DIR]
+        ):
+            raise ValueError(f"Unexpected path in bundle: {member.name}")
+        yield member
+
+
+def import_bundle(bundle_path, base_path, entry):
+    """
+    Unpack one bundle into `base_path`, reading it sequentially once.
+    The environment is discarded if the checksum of the bundle does not match.
+    """
+    env_path = os.path.join(base_path, entry["path"])
+    staging_dir = os.path.join(base_path, ".importing", entry["file"])
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    os.makedirs(staging_dir)
+    with open(bundle_path, "rb") as f:
+        hashing_file = _HashingFile(f)
+        with tarfile.open(fileobj=hashing_file, mode="r|gz") as tar:
+            extract_kwargs = {"filter": "tar"} if hasattr(tarfile, "tar_filter") else {}
+            tar.extractall(
+                staging_dir, members=_safe_members(tar, entry["path"]), **extract_kwargs
+            )
+        # consume the end of the stream so that the checksum covers the whole file
+        while hashing_file.read(1 << 20):
+            pass
+    if hashing_file.sha256.hexdigest() != entry["sha256"]:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        raise ValueError(f"Checksum mismatch for {bundle_path}")
+    shutil.rmtree(env_path, ignore_errors=True)
+    os.makedirs(os.path.dirname(env_path), exist_ok=True)
+    os.replace(os.path.join(staging_dir, entry["path"]), env_path)
+    staged_layers = os.path.join(staging_dir, LAYERS_DIR)
+    if os.path.isdir(staged_layers):
+        os.makedirs(os.path.join(base_path, LAYERS_DIR), exist_ok=True)
+        for name in os.listdir(staged_layers):
+            layer_path = os.path.join(base_path, LAYERS_DIR, name)
+            if not os.path.exists(layer_path):
+                # layers are shared, keep the copy that is already in place
+                try:
+                    os.replace(os.path.join(staged_layers, name), layer_path)
+                except OSError:
+                    pass
+    subprocess.run(["chmod", "-R", "u+w", staging_dir])
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    return env_path
+
+
+def import_bundles(bundle_dir, base_path, example_ids, jobs=1):
+    """
+    Unpack the bundles needed by `example_ids` from `bundle_dir` into `base_path`
+    and register the shared environments in the store of `base_path`.
+    Environments that are already present with the same manifest are not unpacked again.
+    Returns the example IDs whose environment could not be imported.
+    """
+    os.makedirs(base_path, exist_ok=True)
+    bundle_index = load_bundle_index(bundle_dir)
+    needed = {}
+    missing = []
+    wanted = set(str(example_id) for example_id in example_ids)
+    for name, entry in bundle_index.items():
+        examples = wanted.intersection(entry["examples"])
+        if examples:
+            needed[name] = (entry, sorted(examples, key=int))
+            wanted -= examples
+    missing.extend(sorted(wanted, key=int))
+
+    def unpack(name, entry):
+        env_path = os.path.join(base_path, entry["path"])
+        manifest = read_manifest(env_path)
+        if (
+            manifest is not None
+            and entry.get("spec_hash") is not None
+            and manifest.get("spec_hash") == entry.get("spec_hash")
+            and manifest.get("built_at") == entry.get("built_at")
+        ):
+            return env_path
+        return import_bundle(os.path.join(bundle_dir, entry["file"]), base_path, entry)
+
+    envs, links = {}, {}
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as exe:
+        futures = {
+            exe.submit(unpack, name, entry): name for name, (entry, _) in needed.items()
+        }
+        for fut in tqdm(as_completed(futures), total=len(futures), desc="Importing"):
+            name = futures[fut]
+            entry, examples = needed[name]
+            try:
+                fut.result()
+            except Exception as e:
+                print(f"Error importing {name}: {e}")
+                missing.extend(examples)
+                continue
+            if entry["path"].startswith("store/"):
+                if entry.get("spec"):
+                    envs[name] = entry["spec"]
+                for example_id in examples:
+                    link_example(base_path, example_id, name)
+                    links[example_env_name(example_id)] = name
+    update_index(base_path, envs=envs, examples=links)
+    shutil.rmtree(os.path.join(base_path, ".importing"), ignore_errors=True)
+    return missing
@@ -0,0 +1,271 @@
+"""
+Disk-quota-aware use of the environment store.
+
+Evaluation code holds the environment of an example with `use_environment`
+while it runs candidates in it. This records when the environment was last used
+(`<env>/.last_used`), restores it first if it is missing (by importing its bundle
+or rebuilding it from its spec), and, given a byte budget, evicts the least
+recently used environments until the store fits in the budget again.
+
+Environments in use by any thread or process are never evicted: users hold a
+shared lock on `<base_path>/.locks/<name>.lock` and eviction needs an exclusive one.
+Evicted store entries keep their spec in env_index.json, so they can be rebuilt.
+The templates (<base_path>/templates) and library layers (<base_path>/layers)
+are neither counted in the budget nor evicted: environments are cloned from
+templates and link layers, so deleting them would break or slow down every
+environment built from them. Delete them by hand to reclaim their space.
+"""
+
+import fcntl
+import math
+import os
+import re
+import shutil
+from contextlib import contextmanager
+
+from src.create_venvs import (
+    build_environments,
+    env_key,
+    python_version_key,
+    python_versions,
+)
+from src.env_bundles import import_bundles
+from src.env_store import (
+    MANIFEST_FILE,
+    STORE_DIR,
+    load_index,
+    resolve_env_path,
+)
+
+LOCKS_DIR = ".locks"
+LAST_USED_FILE = ".last_used"
+SPEC_COLUMNS = ["python_version", "library", "version", "additional_dependencies"]
+
+_size_units = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+
+
+def parse_size(size):
+    """Parse a byte budget such as 500M, 200G or 1.5T. None stays None."""
+    if size is None:
+        return None
+    match = re.fullmatch(r"\s*([\d.]+)\s*([KMGT]?)i?B?\s*", str(size), re.IGNORECASE)
+    if match is None:
+        raise ValueError(f"Invalid size: {size}")
+    return int(float(match.group(1)) * _size_units[match.group(2).upper()])
+
+
+def _open_lock(base_path, name):
+    lock_dir = os.path.join(base_path, LOCKS_DIR)
+    os.makedirs(lock_dir, exist_ok=True)
+    return open(os.path.join(lock_dir, f"{name}.lock"), "a")
+
+
+def touch_environment(env_path):
+    """Record that the environment in `env_path` was used now."""
+    last_used_path = os.path.join(env_path, LAST_USED_FILE)
+    with open(last_used_path, "a"):
+        pass
+    os.utime(last_used_path, None)
+
+
+def last_used(env_path):
+    """Time the environment was last used, or built if it was never used."""
+    for file_name in [LAST_USED_FILE, MANIFEST_FILE]:
+        try:
+            return os.path.getmtime(os.path.join(env_path, file_name))
+        except OSError:
+            continue
+    try:
+        return os.path.getmtime(env_path)
+    except OSError:
+        return 0
+
+
+def environment_size(env_path):
+    """Disk usage of an environment in bytes, counting hardlinked files once."""
+    seen = set()
+    total = 0
+    for root, dirs, files in os.walk(env_path):
+        for name in dirs + files:
+            try:
+                st = os.lstat(os.path.join(root, name))
+            except OSError:
+                continue
+            if (st.st_dev, st.st_ino) in seen:
+                continue
+            seen.add((st.st_dev, st.st_ino))
+            total += st.st_blocks * 512
+    return total
+
+
+def stored_environments(base_path):
+    """
+    Return {name: env_path} for the shared environments in the store and the
+    standalone gcham_venv_<example_id> environments of `base_path`.
+    """
+    environments = {}
+    store_dir = os.path.join(base_path, STORE_DIR)
+    if os.path.isdir(store_dir):
+        for name in os.listdir(store_dir):
+            env_path = os.path.join(store_dir, name)
+            if os.path.isdir(env_path):
+                environments[name] = env_path
+    for name in os.listdir(base_path):
+        env_path = os.path.join(base_path, name)
+        if (
+            name.startswith("gcham_venv_")
+            and os.path.isdir(env_path)
+            and not os.path.islink(env_path)
+        ):
+            environments[name] = env_path
+    return environments
+
+
+def evict_environments(base_path, budget):
+    """
+    Delete the least recently used environments of `base_path` until they take
+    at most `budget` bytes. Environments in use are skipped; templates and
+    layers are not counted (see the module docstring).
+    Returns the names of the evicted environments.
+    """
+    environments = stored_environments(base_path)
+    sizes = {name: environment_size(path) for name, path in environments.items()}
+    total = sum(sizes.values())
+    evicted = []
+    for name in sorted(environments, key=lambda name: last_used(environments[name])):
+        if total <= budget:
+            break
+        with _open_lock(base_path, name) as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue
+            shutil.rmtree(environments[name], ignore_errors=True)
+        total -= sizes[name]
+        evicted.append(name)
+        print(f"Evicted environment {name} ({sizes[name] / (1 << 30):.2f} GiB)")
+    if total > budget:
+        print(
+            f"Environments still take {total / (1 << 30):.2f} GiB, "
+            f"over the budget of {budget / (1 << 30):.2f} GiB."
+        )
+    return evicted
+
+
+def spec_of(row):
+    """
+    Spec columns of a dataset row, with missing values (NaN, None) as empty strings
+    and python_version as a key of `python_versions` (pandas reads "3.10" as 3.1).
+    Raises ValueError for an unknown python_version.
+    """
+    spec = {}
+    for col in SPEC_COLUMNS:
+        value = row.get(col, "")
+        if value is None or (isinstance(value, float) and math.isnan(value)):
+            value = ""
+        spec[col] = str(value)
+    spec["python_version"] = python_version_key(row.get("python_version", ""))
+    return spec
+
+
+def _environment_name(base_path, venv_name, spec=None):
+    """Name the environment of `venv_name` has (or will have once restored) in the store."""
+    name = load_index(base_path)["examples"].get(venv_name)
+    if name is not None:
+        return name
+    venv_path = os.path.join(base_path, venv_name)
+    if os.path.isdir(venv_path) and not os.path.islink(venv_path):
+        return venv_name
+    if spec is not None and spec["python_version"] in python_versions:
+        return env_key(spec)
+    return venv_name
+
+
+def build_options(args):
+    """
+    `build_environments` keyword arguments of the --env-wheelhouse, --env-clone,
+    --env-interpreter and --env-layers flags of an evaluation script, so that
+    environments rebuilt during an evaluation are built like the store was.
+    """
+    clone = getattr(args, "env_clone", "none")
+    return {
+        "wheelhouse": getattr(args, "env_wheelhouse", None),
+        "clone": None if clone == "none" else clone,
+        "interpreter": getattr(args, "env_interpreter", "copy"),
+        "layers": getattr(args, "env_layers", False),
+    }
+
+
+def restore_environment(
+    base_path, venv_name, spec=None, bundle_dir=None, build_options=None
+):
+    """
+    Bring back the missing environment `venv_name`: import it from `bundle_dir`
+    if it has a bundle of it, else rebuild it from `spec` in the shared store
+    (`build_options` go to `build_environments`).
+    Returns True if the environment was restored.
+    """
+    example_id = venv_name[len("gcham_venv_") :]
+    if bundle_dir and not import_bundles(bundle_dir, base_path, [example_id]):
+        print(f"Re-imported environment {venv_name} from {bundle_dir}.")
+        return True
+    if spec is None:
+        return False
+    print(f"Rebuilding evicted environment {venv_name}...")
+    statuses = build_environments(
+        [dict(spec, example_id=example_id)],
+        base_path,
+        install_pkgs=True,
+        **(build_options or {}),
+    )
+    return statuses.get(example_id) == "built"
+
+
+@contextmanager
+def use_environment(
+    base_path, venv_name, spec=None, bundle_dir=None, budget=None, build_options=None
+):
+    """
+    Hold the environment `venv_name` (e.g. gcham_venv_12) and yield its path.
+
+    The environment cannot be evicted while it is held. If it is missing, it is
+    re-imported from `bundle_dir` or rebuilt from `spec` (a dataset row) with
+    `build_options` when they are given, and the store is then brought back
+    under `budget` bytes.
+    """
+    spec = spec_of(spec) if spec is not None else None
+    name = _environment_name(base_path, venv_name, spec)
+    try:
+        lock_file = _open_lock(base_path, name)
+    except OSError:
+        # read-only store, nothing can be evicted or restored
+        lock_file = None
+    try:
+        restored = False
+        while True:
+            if lock_file is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_SH)
+            env_path = resolve_env_path(base_path, venv_name)
+            if os.path.exists(os.path.join(env_path, "bin", "python")):
+                break
+            if lock_file is None or restored or (spec is None and not bundle_dir):
+                break
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            env_path = resolve_env_path(base_path, venv_name)
+            if not os.path.exists(os.path.join(env_path, "bin", "python")):
+                if not restore_environment(
+                    base_path, venv_name, spec, bundle_dir, build_options
+                ):
+                    break
+                restored = True
+        if os.path.isdir(env_path):
+            try:
+                touch_environment(env_path)
+            except OSError:
+                pass
+        if restored and budget is not None:
+            evict_environments(base_path, budget)
+        yield env_path
+    finally:
+        if lock_file is not None:
+            lock_file.close()
@@ -0,0 +1,130 @@
+"""
+Overlap environment builds with evaluation.
+
+`pipelined_map` evaluates the rows whose environment is ready right away and
+builds the missing environments in the background, cheapest first, so that the
+rows of each environment start running as soon as it is built instead of after
+the whole store. Build costs are estimated from the manifests of the
+environments already built (see `estimate_build_seconds`).
+"""
+
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from src.create_venvs import build_environments, install_plan
+from src.env_cache import spec_of, stored_environments
+from src.env_store import example_env_name, read_manifest, resolve_env_path
+
+# build time assumed per requirement when nothing similar was built before
+DEFAULT_SECONDS_PER_REQUIREMENT = 60
+
+
+def known_build_seconds(base_path):
+    """
+    Build times of the environments of `base_path`, from their manifests:
+    {(library, version): seconds} and {library: mean seconds}.
+    """
+    by_version, by_library = {}, {}
+    if not os.path.isdir(base_path):
+        return by_version, by_library
+    for env_path in stored_environments(base_path).values():
+        manifest = read_manifest(env_path)
+        if not manifest or "build_seconds" not in manifest:
+            continue
+        library, version = manifest["spec"]["library"], manifest["spec"]["version"]
+        by_version[(library, version)] = manifest["build_seconds"]
+        by_library.setdefault(library, []).append(manifest["build_seconds"])
+    return by_version, {
+        library: sum(seconds) / len(seconds) for library, seconds in by_library.items()
+    }
+
+
+def estimate_build_seconds(sample, known):
+    """Expected build time of the environment of a row, given `known_build_seconds`."""
+    by_version, by_library = known
+    if (sample["library"], sample["version"]) in by_version:
+        return by_version[(sample["library"], sample["version"])]
+    if sample["library"] in by_library:
+        return by_library[sample["library"]]
+    return DEFAULT_SECONDS_PER_REQUIREMENT * len(install_plan(sample))
+
+
+def pipelined_map(fn, tasks, base_path, build_jobs=1, eval_jobs=1, **build_kwargs):
+    """
+    Call `fn(*args)` for every `(row, args)` of `tasks` with up to `eval_jobs`
+    threads, building the missing environments of the rows with `build_jobs`
+    workers meanwhile (`build_kwargs` go to `build_environments`).
+
+    A task starts as soon as the environment of its row exists; rows whose
+    environment fails to build are still evaluated (and skipped by `fn`).
+    Yields `(position in tasks, result)` in completion order. The first error
+    raised by `fn` is raised again; no task is started after it (the builds
+    in progress finish in the background).
+    """
+    results = queue.Queue()
+    waiting = {}
+    missing = {}
+    ready = []
+    for position, (row, _) in enumerate(tasks):
+        example_id = str(row["example_id"])
+        env_path = resolve_env_path(base_path, example_env_name(example_id))
+        if os.path.exists(os.path.join(env_path, "bin", "python")):
+            ready.append(position)
+        else:
+            waiting.setdefault(example_id, []).append(position)
+            missing.setdefault(example_id, dict(spec_of(row), example_id=example_id))
+
+    known = known_build_seconds(base_path)
+    samples = sorted(
+        missing.values(), key=lambda sample: estimate_build_seconds(sample, known)
+    )
+    waiting_lock = threading.Lock()
+    stop = threading.Event()
+
+    def run(position):
+        try:
+            results.put((position, fn(*tasks[position][1]), None))
+        except Exception as e:
+            results.put((position, None, e))
+
+    with ThreadPoolExecutor(max_workers=max(eval_jobs, 1)) as exe:
+
+        def release(example_ids):
+            for example_id in example_ids:
+                with waiting_lock:
+                    if stop.is_set():
+                        return
+                    positions = waiting.pop(example_id, [])
+                    for position in positions:
+                        exe.submit(run, position)
+
+        def build():
+            try:
+                build_environments(
+                    samples,
+                    base_path,
+                    jobs=build_jobs,
+                    on_built=lambda key, status, example_ids: release(example_ids),
+                    **build_kwargs,
+                )
+            finally:
+                # whatever could not be built is evaluated anyway
+                release(list(waiting))
+
+        for position in ready:
+            exe.submit(run, position)
+        builder = threading.Thread(target=build, daemon=True)
+        builder.start()
+        try:
+            for _ in range(len(tasks)):
+                position, result, error = results.get()
+                if error is not None:
+                    raise error
+                yield position, result
+        finally:
+            # no task is submitted once the executor shuts down
+            with waiting_lock:
+                stop.set()
+        builder.join()
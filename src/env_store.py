@@ -0,0 +1,176 @@
+"""
+Layout of the shared environment store.
+
+Rows with the same Python version, library, version and additional dependencies
+share one environment, built once under `<base_path>/store/<env_key>`. Every
+example keeps its usual name `gcham_venv_<example_id>`, which is a relative
+symlink to the shared environment. The lookup table `<base_path>/env_index.json`
+maps the example environment names to their store keys, so the environments can
+be resolved even when the symlinks were not copied along with the store.
+
+Each built environment also holds a manifest, `gcham_manifest.json`, with the
+hash of its spec, the interpreter version, the `pip freeze --all` lock and the
+build time. With layered builds, the library of a row is installed once per
+Python version in a read-only layer under `<base_path>/layers` and linked into
+the environment by a relative path in `gcham_layers.pth`.
+
+env_index.json:
+    {
+        "examples": {"gcham_venv_0": "py3.7-1a2b3c4d", ...},
+        "envs": {"py3.7-1a2b3c4d": {"python_version": ..., "library": ..., ...}, ...}
+    }
+"""
+
+import fcntl
+import json
+import os
+import re
+import threading
+from pathlib import Path
+
+STORE_DIR = "store"
+INDEX_FILE = "env_index.json"
+
+_index_cache = {}
+_index_lock = threading.Lock()
+
+
+def example_env_name(example_id):
+    return f"gcham_venv_{example_id}"
+
+
+def store_env_path(base_path, env_key):
+    """Path of the shared environment `env_key` inside the store."""
+    return os.path.join(base_path, STORE_DIR, env_key)
+
+
+def load_index(base_path):
+    """
+    Load the lookup table of the store in `base_path`.
+    Returns an empty table if the store has no index yet.
+    """
+    index_path = os.path.join(base_path, INDEX_FILE)
+    try:
+        mtime = os.path.getmtime(index_path)
+    except OSError:
+        return {"examples": {}, "envs": {}}
+    with _index_lock:
+        cached = _index_cache.get(index_path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+    with open(index_path, "r") as f:
+        index = json.load(f)
+    index.setdefault("examples", {})
+    index.setdefault("envs", {})
+    with _index_lock:
+        _index_cache[index_path] = (mtime, index)
+    return index
+
+
+def update_index(base_path, envs=None, examples=None):
+    """
+    Add shared environments (`envs`: {env_key: spec}) and example links
+    (`examples`: {gcham_venv_<example_id>: env_key}) to the lookup table of the
+    store in `base_path`. The table is locked while it is rewritten, so several
+    threads or processes can register environments at the same time.
+    """
+    index_path = os.path.join(base_path, INDEX_FILE)
+    with open(f"{index_path}.lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        index = dict(load_index(base_path))
+        index["envs"] = dict(index["envs"], **(envs or {}))
+        index["examples"] = dict(index["examples"], **(examples or {}))
+        tmp_path = f"{index_path}.tmp.{os.getpid()}.{threading.get_ident()}"
+        with open(tmp_path, "w") as f:
+            json.dump(index, f, indent=4, sort_keys=True)
+        os.replace(tmp_path, index_path)
+    return index
+
+
+def link_example(base_path, example_id, env_key):
+    """
+    Point `gcham_venv_<example_id>` to the shared environment `env_key`.
+    An existing symlink is replaced, a real environment directory is left alone.
+    """
+    link_path = os.path.join(base_path, example_env_name(example_id))
+    target = os.path.join(STORE_DIR, env_key)
+    if os.path.islink(link_path):
+        if os.readlink(link_path) == target:
+            return link_path
+        os.remove(link_path)
+    elif os.path.exists(link_path):
+        print(f"{link_path} is a standalone environment, not linking it to {env_key}.")
+        return link_path
+    os.symlink(target, link_path)
+    return link_path
+
+
+def resolve_env_path(base_path, venv_name):
+    """
+    Return the path of the environment `venv_name` (e.g. gcham_venv_12).
+
+    Environments registered in the store index resolve to their shared
+    environment, everything else to `<base_path>/<venv_name>`.
+    """
+    env_key = load_index(base_path)["examples"].get(venv_name)
+    if env_key is not None:
+        env_path = store_env_path(base_path, env_key)
+        if os.path.exists(env_path):
+            return env_path
+    return os.path.join(base_path, venv_name)
+
+
+MANIFEST_FILE = "gcham_manifest.json"
+
+# read-only site-packages layers shared by environments, see create_venvs.ensure_library_layer
+LAYERS_DIR = "layers"
+LAYERS_PTH = "gcham_layers.pth"
+
+
+_LAYER_LINE = (
+    "import os, sys; sys.path.append(os.path.normpath("
+    "os.path.join(os.path.realpath(sys.prefix), {!r})))\n"
+)
+
+
+def layers_pth(env_path, layer_paths):
+    """
+    Content of the `gcham_layers.pth` that links `layer_paths` into an environment.
+    Layers are located relative to the real environment directory, so they are
+    found whether the environment runs through a gcham_venv_<example_id> symlink
+    or was moved along with its base path.
+    """
+    env_root = os.path.realpath(env_path)
+    return "".join(
+        _LAYER_LINE.format(os.path.relpath(os.path.realpath(layer_path), env_root))
+        for layer_path in layer_paths
+    )
+
+
+def linked_layers(env_path):
+    """Absolute paths of the layers an environment links through its `gcham_layers.pth`."""
+    env_root = os.path.realpath(env_path)
+    layers = []
+    for pth_path in Path(env_root).glob(f"lib/python*/site-packages/{LAYERS_PTH}"):
+        with open(pth_path, "r") as f:
+            for match in re.finditer(r"realpath\(sys\.prefix\), '([^']*)'", f.read()):
+                layers.append(os.path.normpath(os.path.join(env_root, match.group(1))))
+    return layers
+
+
+def read_manifest(env_path):
+    """Return the build manifest of an environment, or None if it has none."""
+    try:
+        with open(os.path.join(env_path, MANIFEST_FILE), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_manifest(env_path, manifest):
+    """Atomically write the build manifest of an environment."""
+    manifest_path = os.path.join(env_path, MANIFEST_FILE)
+    tmp_path = f"{manifest_path}.tmp.{os.getpid()}"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(tmp_path, manifest_path)
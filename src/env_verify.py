@@ -0,0 +1,209 @@
+"""
+In-process integrity checks of built environments.
+
+`verify_environment` reads the installed-distribution metadata (`*.dist-info`)
+of an environment and of the library layers it links, without running pip, and
+reports:
+    missing:   files listed in a RECORD that are gone, or locked distributions
+               that are not installed
+    corrupted: files whose size (or, with `full`, sha256) differs from their RECORD
+    drifted:   installed distributions whose version differs from the manifest
+               lock, or that are not in the lock
+`verification_gate` runs it over all the environments of an evaluation in parallel.
+"""
+
+import base64
+import hashlib
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from src.env_store import linked_layers, read_manifest, resolve_env_path
+
+
+def normalize_name(name):
+    """Canonical form of a distribution name (PEP 503)."""
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def site_dirs(env_path):
+    """site-packages directories of an environment followed by its linked layers."""
+    env_root = os.path.realpath(env_path)
+    dirs = sorted(
+        str(path) for path in Path(env_root).glob("lib/python*/site-packages")
+    )
+    return dirs + linked_layers(env_root)
+
+
+def _read_metadata(metadata_path):
+    name = version = None
+    with open(metadata_path, "r", encoding="utf-8", errors="replace") as f:
+        for line in f:
+            if not line.strip():
+                break
+            if line.startswith("Name:"):
+                name = line[len("Name:") :].strip()
+            elif line.startswith("Version:"):
+                version = line[len("Version:") :].strip()
+    return name, version
+
+
+def read_distributions(env_path):
+    """
+    Return {normalized name: (name, version, metadata dir, site dir)} of the
+    distributions installed in an environment. The environment wins over its layers.
+    """
+    distributions = {}
+    for site_dir in site_dirs(env_path):
+        try:
+            entries = os.listdir(site_dir)
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.endswith(".dist-info"):
+                metadata_path = os.path.join(site_dir, entry, "METADATA")
+            elif entry.endswith(".egg-info"):
+                metadata_path = os.path.join(site_dir, entry)
+                if os.path.isdir(metadata_path):
+                    metadata_path = os.path.join(metadata_path, "PKG-INFO")
+            else:
+                continue
+            try:
+                name, version = _read_metadata(metadata_path)
+            except OSError:
+                continue
+            if name and normalize_name(name) not in distributions:
+                distributions[normalize_name(name)] = (
+                    name,
+                    version,
+                    os.path.join(site_dir, entry),
+                    site_dir,
+                )
+    return distributions
+
+
+def record_digest(file_path, algorithm="sha256"):
+    """Digest of a file as written in a RECORD: urlsafe base64 without padding."""
+    h = hashlib.new(algorithm)
+    with open(file_path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(1 << 20), b""):
+            h.update(chunk)
+    return base64.urlsafe_b64encode(h.digest()).rstrip(b"=").decode()
+
+
+def _check_record(dist_dir, site_dir, full=False):
+    """Check the files listed in the RECORD of a distribution. Returns (missing, corrupted)."""
+    missing, corrupted = [], []
+    record_path = os.path.join(dist_dir, "RECORD")
+    if not os.path.isfile(record_path):
+        return missing, corrupted
+    with open(record_path, "r", encoding="utf-8", errors="replace") as f:
+        lines = f.read().splitlines()
+    for line in lines:
+        # path,sha256=<urlsafe b64 digest>,size; paths may contain commas
+        parts = line.rsplit(",", 2)
+        if len(parts) != 3 or not parts[1]:
+            continue
+        rel_path, file_hash, size = parts
+        file_path = os.path.normpath(os.path.join(site_dir, rel_path.strip('"')))
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            missing.append(file_path)
+            continue
+        if size and st.st_size != int(size):
+            corrupted.append(file_path)
+            continue
+        if full:
+            algorithm, _, digest = file_hash.partition("=")
+            if record_digest(file_path, algorithm) != digest:
+                corrupted.append(file_path)
+    return missing, corrupted
+
+
+def verify_environment(env_path, full=False):
+    """
+    Check an environment against the RECORDs of its distributions and its manifest lock.
+    Sizes are checked by default; with `full`, sha256 hashes too.
+    Returns {"missing": [...], "corrupted": [...], "drifted": [...]}.
+    """
+    problems = {"missing": [], "corrupted": [], "drifted": []}
+    distributions = read_distributions(env_path)
+    for name, version, dist_dir, site_dir in distributions.values():
+        missing, corrupted = _check_record(dist_dir, site_dir, full=full)
+        problems["missing"].extend(missing)
+        problems["corrupted"].extend(corrupted)
+
+    manifest = read_manifest(env_path)
+    if manifest is None:
+        problems["drifted"].append("no manifest")
+        return problems
+    locked = {}
+    for line in manifest.get("lock", []):
+        if "==" in line:
+            name, version = line.split("==", 1)
+            locked[normalize_name(name)] = version.strip()
+    for key, version in locked.items():
+        if key not in distributions:
+            problems["missing"].append(f"{key}=={version}")
+        elif distributions[key][1] != version:
+            problems["drifted"].append(
+                f"{key}: {distributions[key][1]} installed, {version} locked"
+            )
+    for key, (name, version, _, _) in distributions.items():
+        if key not in locked:
+            problems["drifted"].append(f"{name}=={version} not in the lock")
+    return problems
+
+
+def verify_environments(base_path, venv_names, jobs=8, full=False):
+    """
+    Verify the environments of `venv_names` (e.g. gcham_venv_12) in parallel,
+    each shared environment once.
+    Returns {env_path: problems} for the environments that exist, and the
+    names whose environment does not exist.
+    """
+    env_paths = {}
+    not_built = []
+    for venv_name in venv_names:
+        env_path = resolve_env_path(base_path, venv_name)
+        if os.path.exists(os.path.join(env_path, "bin", "python")):
+            env_paths.setdefault(os.path.realpath(env_path), env_path)
+        else:
+            not_built.append(venv_name)
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as exe:
+        results = dict(
+            zip(
+                env_paths.values(),
+                exe.map(
+                    lambda path: verify_environment(path, full=full), env_paths.values()
+                ),
+            )
+        )
+    return results, not_built
+
+
+def verification_gate(base_path, venv_names, jobs=8, full=False):
+    """
+    Verify the environments an evaluation will use and print what is wrong.
+    Returns False if any existing environment is broken.
+    """
+    results, not_built = verify_environments(
+        base_path, venv_names, jobs=jobs, full=full
+    )
+    broken = {
+        path: problems for path, problems in results.items() if any(problems.values())
+    }
+    for env_path, problems in sorted(broken.items()):
+        for kind, items in problems.items():
+            if items:
+                print(
+                    f"[{kind}] {env_path}: {', '.join(items[:5])}"
+                    + (f" (+{len(items) - 5} more)" if len(items) > 5 else "")
+                )
+    print(
+        f"Verified {len(results)} environments: {len(broken)} broken, "
+        f"{len(not_built)} examples without an environment."
+    )
+    return not broken
@@ -0,0 +1,217 @@
+"""
+Batched pytest evaluation of the candidates of one example.
+
+`eval_sample` runs a new pytest process per candidate. With `batch=True`, it
+calls `eval_batch`, which runs all the candidates of the example in one pytest
+session instead: each candidate is collected from its own directory with its
+own copy of the test file, and src/batch_conftest.py runs each candidate in a
+fork of the session and reports the outcome of every test as it happens. The
+candidates share the start of pytest, not their state: nothing a candidate
+changes is seen by the next ones.
+
+Each candidate has the timeout of the example, enforced in the session by the
+conftest; the session itself is killed after the timeouts of all its
+candidates. A candidate that runs out of time is reported as timed out. A
+candidate whose process dies, or that was running when the session was
+killed, is left to `eval_sample` to run on its own; the candidates the session
+did not reach are batched again. Sessions that cannot run at all leave all their
+candidates to `eval_sample`.
+"""
+
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+
+from src.sandbox import sandbox_env
+from src.scratch import scratch_dir
+from src.zygote import run_python
+
+CONFTEST_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "batch_conftest.py"
+)
+
+REPORT_FILE = "gcham_batch_report.jsonl"
+
+
+def read_batch_report(report_path):
+    """Events written by src/batch_conftest.py, in order."""
+    events = []
+    try:
+        with open(report_path, "r") as f:
+            for line in f:
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    # last line of a killed session
+                    break
+    except OSError:
+        pass
+    return events
+
+
+def candidate_outcomes(events, candidates):
+    """
+    Outcomes of the candidates (directory names) that completed or timed out,
+    from the events of a session, and the candidates that started but did not
+    complete (their process died, or the session was killed while they ran).
+    Returns ({candidate: sample result}, [candidates]).
+    """
+    started, counts, errors, reports, timeouts = set(), {}, {}, {}, {}
+    for event in events:
+        candidate = event.get("candidate")
+        if event["event"] == "start":
+            started.add(candidate)
+        elif event["event"] == "timeout":
+            timeouts[candidate] = event["seconds"]
+        elif event["event"] == "collecterror":
+            errors[candidate] = event["error"]
+        elif event["event"] == "collected":
+            counts[candidate] = event["items"]
+        elif event["event"] == "report":
+            reports.setdefault(candidate, []).append(event)
+
+    outcomes, unfinished = {}, []
+    for candidate in candidates:
+        if candidate not in started:
+            continue
+        if candidate in timeouts:
+            outcomes[candidate] = {
+                "output": f"Timeout: the tests did not finish within {timeouts[candidate]} seconds",
+                "pass": False,
+                "timeout": True,
+            }
+            continue
+        candidate_reports = reports.get(candidate, [])
+        items = counts.get(candidate)
+        if (
+            items is None
+            or len([r for r in candidate_reports if r["when"] == "teardown"]) < items
+        ):
+            unfinished.append(candidate)
+            continue
+        failures = [
+            r["longrepr"] for r in candidate_reports if r["outcome"] == "failed"
+        ]
+        passed = len(
+            [
+                r
+                for r in candidate_reports
+                if r["when"] == "call" and r["outcome"] == "passed"
+            ]
+        )
+        if candidate in errors:
+            failures.insert(0, errors[candidate])
+        summary = (
+            f"{len(failures)} failed, {passed} passed" if items else "no tests ran"
+        )
+        outcomes[candidate] = {
+            "output": "\n".join(failures + [summary]),
+            "pass": items > 0 and not failures,
+            "timeout": False,
+        }
+    return outcomes, unfinished
+
+
+def _run_batch(
+    example_id, env_path, test_file_content, codes, timeout, backend, scratch
+):
+    """
+    Run one pytest session over `codes` ({code_id: code}).
+    Returns ({code_id: sample result}, [code_ids of the candidates that did not
+    complete]), or None if the session did not run any candidate.
+    """
+    code_ids = list(codes)
+    module = f"sample_{example_id}"
+    root = tempfile.mkdtemp(dir=scratch_dir(scratch))
+    try:
+        shutil.copy(CONFTEST_FILE, os.path.join(root, "conftest.py"))
+        for i, code_id in enumerate(code_ids):
+            candidate_dir = os.path.join(root, str(i))
+            os.makedirs(candidate_dir)
+            with open(os.path.join(candidate_dir, f"{module}.py"), "w") as f_code:
+                f_code.write(codes[code_id])
+            with open(os.path.join(candidate_dir, "test_sample.py"), "w") as f_test:
+                f_test.write(test_file_content)
+        report_path = os.path.join(root, REPORT_FILE)
+        args = [
+            "-m",
+            "pytest",
+            "--disable-warnings",
+            "-q",
+            "-p",
+            "no:cacheprovider",
+            "--continue-on-collection-errors",
+            f"--rootdir={root}",
+            f"--gcham-report={report_path}",
+            f"--gcham-timeout={timeout}",
+            root,
+        ]
+        try:
+            run_python(
+                os.path.join(env_path, "bin", "python"),
+                args,
+                # every candidate has `timeout`, and one more for the start of the session
+                timeout=timeout * (len(code_ids) + 1),
+                env=sandbox_env(env_path),
+                backend=backend,
+            )
+        except subprocess.TimeoutExpired:
+            pass
+        events = read_batch_report(report_path)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    if not events:
+        return None
+    outcomes, unfinished = candidate_outcomes(
+        events, [str(i) for i in range(len(code_ids))]
+    )
+    return (
+        {code_ids[int(candidate)]: result for candidate, result in outcomes.items()},
+        [code_ids[int(candidate)] for candidate in unfinished],
+    )
+
+
+def eval_batch(
+    example_id,
+    env_path,
+    test_file_content,
+    codes,
+    timeout=120,
+    backend="subprocess",
+    scratch="disk",
+):
+    """
+    Run the candidates `codes` ({code_id: code}) of an example against its test
+    file in as few pytest sessions as possible, in directories created where the
+    scratch backend `scratch` puts them (see src/scratch.py). Each candidate
+    has `timeout` seconds.
+    Returns ({code_id: {"output": ..., "pass": ..., "timeout": ...}}, [code_ids left to run on their own]).
+    """
+    results = {}
+    pending = list(codes)
+    isolated = []
+    while len(pending) > 1:
+        batch = _run_batch(
+            example_id,
+            env_path,
+            test_file_content,
+            {code_id: codes[code_id] for code_id in pending},
+            timeout,
+            backend,
+            scratch,
+        )
+        if batch is None:
+            break
+        outcomes, unfinished = batch
+        results.update(outcomes)
+        if not outcomes and not unfinished:
+            break
+        isolated.extend(unfinished)
+        pending = [
+            code_id
+            for code_id in pending
+            if code_id not in outcomes and code_id not in unfinished
+        ]
+    return results, isolated + pending
@@ -15,7 +15,6 @@ TODO:
 
 import os
 import pdb
-import py_compile
 import re
 import time
 from collections import defaultdict
@@ -26,6 +25,17 @@ from joblib import Parallel, delayed
 from tqdm import tqdm
 from transformers import AutoTokenizer
 
+from src.capture import compress_log, set_output_limit
+from src.env_cache import build_options, parse_size, use_environment
+from src.env_pipeline import pipelined_map
+from src.env_store import resolve_env_path
+from src.result_cache import cached_run, print_session_stats
+from src.sandbox import sandbox_env, set_thread_budget
+from src.scratch import ScratchFile
+from src.syntax_check import check_syntax
+from src.timeouts import Timeouts
+from src.zygote import run_python
+
 
 def extract_first_python_code_block(text):
     try:
@@ -185,6 +195,17 @@ def get_ranks(model_name, row):
     ]
 
 
+def resolve_ranks(values, ranks):
+    """
+    Append the values of the ranked candidates to the values of the n candidates.
+    The ranked outputs are copies of candidates (see get_ranks), so their results
+    are looked up by index instead of running them again.
+    values: list, one value per candidate
+    ranks: list of int, indices of the ranked candidates
+    """
+    return list(values) + [values[int(rank)] for rank in ranks]
+
+
 def add_ranking_index(df, model_name, n, regen=False):
     # Generate column names
     regen_str = "regen_" if regen else ""
@@ -261,7 +282,7 @@ def get_python_executable(base_path, venv_name):
     venv_name: str, name of the virtual environment.
     return: str, path to the Python executable in the virtual environment.
     """
-    venv_path = os.path.join(base_path, venv_name)
+    venv_path = resolve_env_path(base_path, venv_name)
     bin_path = os.path.join(venv_path, "bin")
     python_executable = os.path.join(bin_path, "python")
     return python_executable
@@ -291,49 +312,83 @@ def concat_testcase(
 
 
 # Function to run a Python script and return the result
-def run_script(python_executable, py_file="temp.py"):
+def run_script(
+    python_executable, py_file="temp.py", backend="subprocess", cache=None, timeout=60
+):
+    """
+    Compile and run `py_file` in the environment of `python_executable`.
+    `py_file` is the path of the script or a ScratchFile (see src/scratch.py).
+    With `cache` (the path of a result cache, see src/result_cache.py), a script
+    that already ran in the same environment is not run again.
+    `timeout` is in seconds (see src/timeouts.py).
+    return: pass, compile, the code of the script, error log, timeout
+    """
     if py_file is None:
-        return 0, 0, "", ""
+        return 0, 0, "", "", False
 
-    parsed_code = ""
-    try:
-        with open(py_file, "r") as file:
-            parsed_code = file.read()
-    except Exception as e:
-        print(py_file, type(py_file))
-        print("Error at py_file open:", e)
-
-    error_log = ""
-    try:
-        # Try to compile the temporary file
-        py_compile.compile(py_file, doraise=True)
-        compile_code = 0  # Compilation successful
-    except py_compile.PyCompileError as e:
-        compile_code = 1  # Compilation failed due to a syntax error
-        error_log = str(e)
-    if compile_code == 0:
-        # Run the Python script within the virtual environment
-        command = [python_executable, py_file]
+    if not isinstance(py_file, ScratchFile):
+        parsed_code = ""
         try:
-            result = subprocess.run(command, capture_output=True, text=True, timeout=60)
-            exit_code = result.returncode
-            error_log = result.stderr
-            # print("error_log: ", error_log)
-            # if "ModuleNotFoundError" in error_log:
-            #     print("ModuleNotFoundError")
-            # else:
-            #     print("No ModuleNotFoundError")
-        except subprocess.TimeoutExpired as e:
-            print(e)
-            exit_code = 1
-            error_log = "TimeoutError"
-    else:
-        exit_code = 1  # since Compilation failed, the script will not run
-    try:
-        os.remove(py_file)
-    except Exception as e:
-        print(e)
-    return 1 - exit_code, 1 - compile_code, parsed_code, error_log  # 1 = pass, 0 = fail
+            with open(py_file, "r") as file:
+                parsed_code = file.read()
+        except Exception as e:
+            print(py_file, type(py_file))
+            print("Error at py_file open:", e)
+        py_file = ScratchFile.on_disk(parsed_code, py_file)
+    parsed_code = py_file.source
+
+    def execute():
+        timed_out = False
+        # Compile in memory with the Python version of the environment
+        error_log = check_syntax(python_executable, parsed_code, py_file.name)
+        compile_code = 0 if error_log is None else 1  # 1: syntax error
+        error_log = error_log or ""
+        if compile_code == 0:
+            # Run the Python script within the virtual environment
+            try:
+                result = run_python(
+                    python_executable,
+                    py_file.args(),
+                    timeout=timeout,
+                    env=sandbox_env(env_path),
+                    backend=backend,
+                    input=py_file.input,
+                    pass_fds=py_file.pass_fds,
+                )
+                exit_code = result.returncode
+                error_log = result.stderr
+                # print("error_log: ", error_log)
+                # if "ModuleNotFoundError" in error_log:
+                #     print("ModuleNotFoundError")
+                # else:
+                #     print("No ModuleNotFoundError")
+            except subprocess.TimeoutExpired as e:
+                print(e)
+                exit_code = 1
+                error_log = "TimeoutError"
+                timed_out = True
+        else:
+            exit_code = 1  # since Compilation failed, the script will not run
+        return {
+            "passed": exit_code == 0,
+            "compiled": compile_code == 0,
+            "output": error_log,
+            "timeout": timed_out,
+        }
+
+    env_path = os.path.dirname(os.path.dirname(python_executable))
+    result = cached_run(
+        cache if parsed_code else None, "script", env_path, [parsed_code], execute
+    )
+    py_file.close()
+    # 1 = pass, 0 = fail
+    return (
+        int(result["passed"]),
+        int(result["compiled"]),
+        parsed_code,
+        result["output"],
+        result.get("timeout", False),
+    )
 
 
 def extract_code_cot(text):
@@ -396,20 +451,25 @@ def extract_columns(row, columns):
     return (row[column] for column in columns)
 
 
-def write_py_file(code, py_file):
+def py_file_source(code):
+    """
+    The content of the file write_py_file writes for `code`.
+    """
     if has_triple_quotes(code):
-        with open(py_file, "w") as file:
-            file.write(code)
+        return code
     elif "\n" in code:
         # If the code has multiple lines, write it to a temporary file
         code = code.replace("\\n", "\n")
         code_lines = code.split("\n")
         # write line by line
-        with open(py_file, "w") as file:
-            file.writelines([f"\n{line}" for line in code_lines])
+        return "".join([f"\n{line}" for line in code_lines])
     else:
-        with open(py_file, "w") as file:
-            file.write(code)  # Run the script as is
+        return code  # Run the script as is
+
+
+def write_py_file(code, py_file):
+    with open(py_file, "w") as file:
+        file.write(py_file_source(code))
 
 
 def make_py_file(
@@ -420,6 +480,7 @@ def make_py_file(
     py_file="temp.py",
     add_starter=True,
     verbose_mode=False,
+    scratch="disk",
 ):
     if model_out is None or pd.isna(model_out) or model_out == "":
         return None
@@ -438,8 +499,11 @@ def make_py_file(
 
     """
     code: str, Python code to run.
-    return: python file.
+    scratch: str, scratch backend, see src/scratch.py
+    return: python file, or a ScratchFile with other scratch backends than "disk".
     """
+    if scratch != "disk":
+        return ScratchFile(py_file_source(code_wo_starter), py_file_wo_starter, scratch)
     write_py_file(code_wo_starter, py_file_wo_starter)
     return py_file_wo_starter
 
@@ -457,22 +521,34 @@ def eval_strategy(strategy: str):
         raise ValueError(f"Unknown strategy: {strategy}")
 
 
-def run_pytest(pytest_exec, py_file, test_file):
+def run_pytest(pytest_exec, py_file, test_file, backend="subprocess", timeout=120):
     """
     Function to run pytest on a given file
     pytest_exec: str, path to the pytest executable
     py_file: str, path to the python file to test
     test_file: str, path to the test file
-    return: result of the test, 1 if pass, 0 if fail
+    `backend` and `timeout` (in seconds) are those of run_script.
+    return: pass, compile, the code of the script, error log, timeout
     """
+    if py_file is None:
+        return 0, 0, "", "", False
+
     # concat the py_file into the test_file
     with open(test_file, "a") as file:
         with open(py_file, "r") as py_file:
             code = py_file.read()
             file.write(code)
-    command = [pytest_exec, test_file]
+    # the interpreter of the environment pytest_exec belongs to
+    bin_dir = os.path.dirname(os.path.realpath(pytest_exec))
+    timed_out = False
     try:
-        result = subprocess.run(command, capture_output=True, text=True)
+        result = run_python(
+            os.path.join(bin_dir, "python"),
+            ["-m", "pytest", test_file],
+            timeout=timeout,
+            env=sandbox_env(os.path.dirname(bin_dir)),
+            backend=backend,
+        )
         exit_code = result.returncode
         error_log = result.stderr
         # print("error_log: ", error_log)
@@ -484,7 +560,37 @@ def run_pytest(pytest_exec, py_file, test_file):
         print(e)
         exit_code = 1
         error_log = "TimeoutError"
-    return 1 - exit_code, 1 - exit_code, "", error_log
+        timed_out = True
+    # pytest exits with 2 and more on collection errors and interruptions
+    passed = int(exit_code == 0)
+    return passed, passed, "", error_log, timed_out
+
+
+def best_of_both(model_outputs, run):
+    """
+    Run the candidates with and without the starter code and keep the better of both
+    model_outputs: list, the candidates
+    run: function, run(i, add_starter) runs candidate i and returns (pass, compile, parsed code, error log, timeout)
+    A candidate that passes with the starter code is not run without it, and
+    byte-identical candidates run once and share their results.
+    return: passes, compiles, parsed_codes, error_logs, timeouts, one value per candidate
+    """
+    first = {}
+    results = []
+    for i, model_out in enumerate(model_outputs):
+        key = model_out if isinstance(model_out, str) else i
+        if key in first:
+            results.append(results[first[key]])
+            continue
+        first[key] = i
+        result = run(i, True)
+        if not result[0]:
+            # second round w/out starter code, it only wins if it passes
+            result_wo_starter = run(i, False)
+            if result_wo_starter[0] > result[0]:
+                result = result_wo_starter
+        results.append(result)
+    return tuple(list(values) for values in zip(*results))
 
 
 def pytest_eval_sample_k(
@@ -499,98 +605,65 @@ def pytest_eval_sample_k(
     k: int, number of k to evaluate
     return: results_dict, containing eval results for each model and for each of the k then sample ranking heuristics (sum_logp, mean_logp, random)
     """
+    starting_code, test = row["starting_code"], row["test"]
+    regen_str = "regen_" if regen else ""
     pytest_exec = os.path.join(base_path, "venv/bin/pytest")
     if not os.path.exists(pytest_exec):
         print(f"Error: pytest executable not found, skipping sample {idx}...")
-        return None, None, None, None, None
+        return None, None, None, None, None, None
     # pytest tests will be in a separate folder and file. make the structure
     test_dir = os.path.join(base_path, "tests", model_name, str(seed), str(temperature))
+    os.makedirs(test_dir, exist_ok=True)
     # extract the columns with test_ in the name
     test_cols = [col for col in row.index if "test_" in col]
     # extract the test codes
-    test_codes = extract_columns(row, test_cols)
+    test_codes = list(extract_columns(row, test_cols))
 
     assert len(test_codes) > 0, "No test keys found in the row."
-    for test_key, test_code in enumerate(test_codes):
-        test_file = os.path.join(test_dir, f"{test_key}_{idx}.py")
-        os.makedirs(os.path.dirname(test_file), exist_ok=True)
-        # write the test file
-        with open(test_file, "w") as file:
-            file.write(test_code)
 
     # concat k's + sample ranking heuristics
+    ranks = get_ranks(model_name, row)
     outputs_cols = [f"{regen_str}output_{i}" for i in range(n)] + [
-        f"{regen_str}output_{rank}" for rank in get_ranks(model_name, row)
+        f"{regen_str}output_{rank}" for rank in ranks
     ]  # [k:] is ranking heuristics
-    model_outputs = extract_columns(row, outputs_cols)
-    # make the py files for each model output
-    py_files = [
-        make_py_file(
-            starting_code,
-            model_out,
-            test,
-            options.instruct,
-            py_file=os.path.join(test_dir, f"temp_{idx}_{k}.py"),
-            add_starter=True,
-            verbose_mode=options.verbose_mode,
-        )
-        for k, model_out in enumerate(model_outputs)
-    ]
+    # only the n candidates run, the ranking heuristics reuse their results
+    model_outputs = list(extract_columns(row, outputs_cols[:n]))
+
+    # calibrated from the reference solution of the example, see src/timeouts.py
+    timeout = options.timeouts.get(row["example_id"], "hidden", 120)
+
     # run the tests
-    passes, compiles, parsed_codes, error_logs = zip(
-        *[
-            run_pytest(pytest_exec, py_file, test_file)
-            for py_file, test_file in zip(py_files, test_files)
-        ]
-    )
-    # second round w/out starter code
-    py_files_wo_starter = [
-        make_py_file(
+    def run(i, add_starter):
+        suffix = "" if add_starter else "_wo_starter"
+        py_file = make_py_file(
             starting_code,
-            model_out,
+            model_outputs[i],
             test,
             options.instruct,
-            py_file=os.path.join(test_dir, f"temp_{idx}_{k}_wo_starter.py"),
-            add_starter=False,
+            py_file=os.path.join(test_dir, f"temp_{idx}_{i}{suffix}.py"),
+            add_starter=add_starter,
             verbose_mode=options.verbose_mode,
         )
-        for k, model_out in enumerate(model_outputs)
-    ]
-    # run the tests
-    (
-        passes_wo_starter,
-        compiles_wo_starter,
-        parsed_codes_wo_starter,
-        error_logs_wo_starter,
-    ) = zip(
-        *[
-            run_pytest(pytest_exec, py_file, test_file)
-            for py_file, test_file in zip(py_files_wo_starter, test_files)
-        ]
+        # run_pytest appends the candidate to the test file, so each run gets its own
+        test_file = os.path.join(test_dir, f"test_{idx}_{i}{suffix}.py")
+        with open(test_file, "w") as file:
+            file.write("\n\n".join(test_codes))
+        return run_pytest(
+            pytest_exec,
+            py_file,
+            test_file,
+            backend=options.exec_backend,
+            timeout=timeout,
+        )
+
+    passes, compiles, parsed_codes, error_logs, timeouts = best_of_both(
+        model_outputs, run
     )
-    # take the best of both. get the indices first
-    best_indices = [
-        np.argmax(np.array([passes[i], passes_wo_starter[i]]))
-        for i in range(len(passes))
-    ]
-    # now take the best of both
-    passes = [
-        passes[i] if best_indices[i] == 0 else passes_wo_starter[i]
-        for i in range(len(passes))
-    ]
-    compiles = [
-        compiles[i] if best_indices[i] == 0 else compiles_wo_starter[i]
-        for i in range(len(compiles))
-    ]
-    parsed_codes = [
-        parsed_codes[i] if best_indices[i] == 0 else parsed_codes_wo_starter[i]
-        for i in range(len(parsed_codes))
-    ]
-    error_logs = [
-        error_logs[i] if best_indices[i] == 0 else error_logs_wo_starter[i]
-        for i in range(len(error_logs))
-    ]
-    return passes, compiles, parsed_codes, error_logs, outputs_cols
+    passes, compiles, parsed_codes, error_logs, timeouts = (
+        resolve_ranks(values, ranks)
+        for values in (passes, compiles, parsed_codes, error_logs, timeouts)
+    )
+    return passes, compiles, parsed_codes, error_logs, timeouts, outputs_cols
 
 
 def eval_sample_k(
@@ -617,77 +690,94 @@ def eval_sample_k(
         assert os.path.exists(py_exec)
     except Exception as e:
         print(f"Error: venv not found, skipping sample {idx}...", e)
-        return None, None, None, None, None
+        return None, None, None, None, None, None
 
     # concat k's + sample ranking heuristics
+    ranks = get_ranks(model_name, row)
     outputs_cols = [f"{regen_str}output_{i}" for i in range(n)] + [
-        f"{regen_str}output_{rank}" for rank in get_ranks(model_name, row)
+        f"{regen_str}output_{rank}" for rank in ranks
     ]  # [k:] is ranking heuristics
-    model_outputs = extract_columns(row, outputs_cols)
+    # only the n candidates run, the ranking heuristics reuse their results
+    model_outputs = list(extract_columns(row, outputs_cols[:n]))
+
+    # calibrated from the reference solution of the example, see src/timeouts.py
+    timeout = options.timeouts.get(row["example_id"], "visible", 60)
 
     tmp_path = f"{options.scratch}/tmp_files/{model_name}/{seed}/{temperature}"
     # if not os.path.exists(tmp_path):
     os.makedirs(tmp_path, exist_ok=True)
-    py_files = [
-        make_py_file(
+
+    def run(i, add_starter):
+        suffix = "" if add_starter else "_wo_starter"
+        py_file = make_py_file(
             starting_code,
-            model_out,
+            model_outputs[i],
             test,
             options.instruct,
-            py_file=os.path.join(tmp_path, f"temp_{idx}_{k}.py"),
-            add_starter=True,
+            py_file=os.path.join(tmp_path, f"temp_{idx}_{i}{suffix}.py"),
+            add_starter=add_starter,
             verbose_mode=options.verbose_mode,
+            scratch=options.scratch_backend,
+        )
+        return run_script(
+            py_exec,
+            py_file,
+            backend=options.exec_backend,
+            cache=options.result_cache,
+            timeout=timeout,
         )
-        for k, model_out in enumerate(model_outputs)
-    ]
 
-    passes, compiles, parsed_codes, error_logs = zip(
-        *[run_script(py_exec, py_file) for py_file in py_files]
+    passes, compiles, parsed_codes, error_logs, timeouts = best_of_both(
+        model_outputs, run
+    )
+    passes, compiles, parsed_codes, error_logs, timeouts = (
+        resolve_ranks(values, ranks)
+        for values in (passes, compiles, parsed_codes, error_logs, timeouts)
     )
 
-    # second round w/out starter code
-    py_files_wo_starter = [
-        make_py_file(
-            starting_code,
-            model_out,
-            test,
-            options.instruct,
-            py_file=os.path.join(tmp_path, f"temp_{idx}_{k}_wo_starter.py"),
-            add_starter=False,
-            verbose_mode=options.verbose_mode,
+    return passes, compiles, parsed_codes, error_logs, timeouts, outputs_cols
+
+
+def eval_in_environment(
+    eval_strategy,
+    base_path,
+    model_name,
+    row,
+    n,
+    k,
+    idx,
+    seed,
+    temperature,
+    options,
+    regen=False,
+):
+    """
+    Run `eval_strategy` on `row` while holding its environment, so that it is not
+    evicted from the store meanwhile (see src/env_cache.py).
+    A missing environment is re-imported from --env-bundle-dir or, with
+    --restore-envs, rebuilt from the row (with the --env-* build flags) before
+    the evaluation.
+    """
+    with use_environment(
+        base_path,
+        f'gcham_venv_{row["example_id"]}',
+        spec=row if options.restore_envs else None,
+        bundle_dir=options.env_bundle_dir,
+        budget=parse_size(options.env_budget),
+        build_options=build_options(options),
+    ):
+        return eval_strategy(
+            base_path,
+            model_name,
+            row,
+            n,
+            k,
+            idx,
+            seed,
+            temperature,
+            options,
+            regen=regen,
         )
-        for k, model_out in enumerate(model_outputs)
-    ]
-    (
-        passes_wo_starter,
-        compiles_wo_starter,
-        parsed_codes_wo_starter,
-        error_logs_wo_starter,
-    ) = zip(*[run_script(py_exec, py_file) for py_file in py_files_wo_starter])
-    # take the best of both. get the indices first
-    best_indices = [
-        np.argmax(np.array([passes[i], passes_wo_starter[i]]))
-        for i in range(len(passes))
-    ]
-    # now take the best of both
-    passes = [
-        passes[i] if best_indices[i] == 0 else passes_wo_starter[i]
-        for i in range(len(passes))
-    ]
-    compiles = [
-        compiles[i] if best_indices[i] == 0 else compiles_wo_starter[i]
-        for i in range(len(compiles))
-    ]
-    parsed_codes = [
-        parsed_codes[i] if best_indices[i] == 0 else parsed_codes_wo_starter[i]
-        for i in range(len(parsed_codes))
-    ]
-    error_logs = [
-        error_logs[i] if best_indices[i] == 0 else error_logs_wo_starter[i]
-        for i in range(len(error_logs))
-    ]
-
-    return passes, compiles, parsed_codes, error_logs, outputs_cols
 
 
 def make_result_df(results, options, regen=False):
@@ -696,7 +786,7 @@ def make_result_df(results, options, regen=False):
     n = options.n_generate
     k = options.k
     results_dict = {}
-    passes, compiles, parsed_codes, error_logs, outputs_cols = results
+    passes, compiles, parsed_codes, error_logs, timeouts, outputs_cols = results
 
     if passes is None:
         # make empty df with one row of nothing
@@ -737,8 +827,13 @@ def make_result_df(results, options, regen=False):
             {
                 f"{outputs_cols[i]}_pass": passes[i],
                 f"{outputs_cols[i]}_compile": compiles[i],
+                f"{outputs_cols[i]}_timeout": timeouts[i],
                 f"{regen_str}parsed_code_{i}": parsed_codes[i],
-                f"{regen_str}error_log_{i}": error_logs[i],
+                f"{regen_str}error_log_{i}": (
+                    compress_log(error_logs[i])
+                    if options.compress_logs
+                    else error_logs[i]
+                ),
             }
         )
     # add sample ranking heuristics
@@ -772,11 +867,12 @@ def sample_eval_parallel(
     n: int, number of generations from the model
     k: pass @ k evaluation
     """
-    eval_strategy = get_eval_strategy(options.eval_strategy)
+    strategy = eval_strategy(options.eval_strategy)
     start, end = list(idxs)[0], list(idxs)[-1] + 1
     rows = df_with_outputs.iloc[start:end].iterrows()
     batch_results = Parallel(n_jobs=n_jobs, verbose=0)(
-        delayed(eval_strategy)(
+        delayed(eval_in_environment)(
+            strategy,
             base_path,
             model_name,
             row,
@@ -799,6 +895,89 @@ def sample_eval_parallel(
     return df_results
 
 
+def log_progress(options, df_updated, eval_path_csv):
+    if options.enable_wandb:
+        wandb.log(
+            {
+                col: df_updated[col].mean()
+                for col in df_updated.columns
+                if "pass" in col or "compile" in col
+            }
+        )
+        # log samples processed
+        wandb.log({"samples_processed": df_updated.dropna().shape[0]})
+    df_updated.to_csv(eval_path_csv, index=False)
+
+
+def evaluate_pipelined(
+    options, df_with_outputs, eval_path_csv, start, bs, regen=False, df_updated=None
+):
+    """
+    Evaluate the rows from `start` on while their missing environments are built
+    (see src/env_pipeline.py): the rows of an environment run as soon as it is
+    ready, and the results are appended to `df_updated` in row order, saved every
+    `bs` rows.
+    """
+    model_name = options.model_name.split("/")[-1]
+    strategy = eval_strategy(options.eval_strategy)
+    tasks = [
+        (
+            row,
+            (
+                strategy,
+                options.base_path,
+                model_name,
+                row,
+                options.n_generate,
+                options.k,
+                idx,
+                options.seed,
+                options.temperature,
+                options,
+                regen,
+            ),
+        )
+        for idx, (_, row) in enumerate(df_with_outputs.iterrows())
+        if idx >= start
+    ]
+
+    def evaluate_row(*args):
+        return make_result_df(eval_in_environment(*args), options)
+
+    done = {}
+    next_position, saved = 0, 0
+    for position, df_result in tqdm(
+        pipelined_map(
+            evaluate_row,
+            tasks,
+            options.base_path,
+            build_jobs=options.build_jobs,
+            eval_jobs=options.n_jobs if options.n_jobs > 0 else os.cpu_count(),
+            **build_options(options),
+        ),
+        total=len(tasks),
+    ):
+        done[position] = df_result
+        flushed = []
+        while next_position in done:
+            flushed.append(done.pop(next_position))
+            next_position += 1
+        if not flushed:
+            continue
+        df_updated = pd.concat(
+            ([df_updated] if df_updated is not None else []) + flushed,
+            axis=0,
+            ignore_index=True,
+        )
+        if next_position - saved >= bs or next_position == len(tasks):
+            saved = next_position
+            log_progress(options, df_updated, eval_path_csv)
+            if options.debug_mode:
+                print("Done first iteration, exiting debug successfully.")
+                exit(0)
+    return df_updated
+
+
 def evaluate_model(
     options, df_with_outputs, eval_path_csv, bs=8, regen=False, df_updated=None
 ):
@@ -811,6 +990,23 @@ def evaluate_model(
     model_name = options.model_name.split("/")[-1]
     base_path = options.base_path
     empty_count = 0
+    n_jobs = (
+        options.n_jobs
+        if options.n_jobs > 0
+        else (os.cpu_count() or 1) + 1 + options.n_jobs
+    )
+    threads = set_thread_budget(
+        max(1, n_jobs), options.sandbox_threads, options.pin_cpus
+    )
+    if threads is not None:
+        print(f"Running candidates with {threads} thread(s) each")
+    set_output_limit(parse_size(options.output_limit))
+    # per-example timeouts from the reference runtimes (fixed ones without them)
+    options.timeouts = (
+        Timeouts.load(base_path, options.timeout_multiplier, options.timeout_floor)
+        if options.adaptive_timeouts
+        else Timeouts()
+    )
     # print(df_with_outputs.columns)
 
     if df_updated is not None:
@@ -818,50 +1014,46 @@ def evaluate_model(
     else:
         start = 0
 
-    for i in tqdm(range(start, len(df_with_outputs), bs)):
-        end = min(i + bs, len(df_with_outputs))
-        # assert len(list(rows)) == end-i, "Row length does not match."
-        idxs = range(i, end)
-        # evaluate the model outputs
-        batch_df_results = sample_eval_parallel(
-            base_path,
-            model_name,
-            idxs,
-            df_with_outputs,
-            options.n_generate,
-            options.k,
-            options.n_jobs,
-            options,
-            regen=regen,
+    if options.build_envs:
+        df_updated = evaluate_pipelined(
+            options, df_with_outputs, eval_path_csv, start, bs, regen, df_updated
         )
-        # update main df with the results (adding the cols to right indices)
-        if df_updated is None:
-            df_updated = batch_df_results
-        else:
-            df_updated = pd.concat(
-                [df_updated, batch_df_results], axis=0, ignore_index=True
-            )
-
-        if options.enable_wandb:
-            wandb.log(
-                {
-                    col: df_updated[col].mean()
-                    for col in df_updated.columns
-                    if "pass" in col or "compile" in col
-                }
+    else:
+        for i in tqdm(range(start, len(df_with_outputs), bs)):
+            end = min(i + bs, len(df_with_outputs))
+            # assert len(list(rows)) == end-i, "Row length does not match."
+            idxs = range(i, end)
+            # evaluate the model outputs
+            batch_df_results = sample_eval_parallel(
+                base_path,
+                model_name,
+                idxs,
+                df_with_outputs,
+                options.n_generate,
+                options.k,
+                options.n_jobs,
+                options,
+                regen=regen,
             )
-            # log samples processed
-            wandb.log({"samples_processed": df_updated.dropna().shape[0]})
-        df_updated.to_csv(eval_path_csv, index=False)
-
-        if options.debug_mode:
-            print("Done first iteration, exiting debug successfully.")
-            exit(0)
+            # update main df with the results (adding the cols to right indices)
+            if df_updated is None:
+                df_updated = batch_df_results
+            else:
+                df_updated = pd.concat(
+                    [df_updated, batch_df_results], axis=0, ignore_index=True
+                )
+
+            log_progress(options, df_updated, eval_path_csv)
+
+            if options.debug_mode:
+                print("Done first iteration, exiting debug successfully.")
+                exit(0)
     # concat df_with_outputs and df_updated col axis
     df_with_outputs = pd.concat([df_with_outputs, df_updated], axis=1)
     df_with_outputs.to_csv(eval_path_csv, index=False)
     df_with_outputs["model_name"] = model_name
     if options.enable_wandb:
         wandb.log({"eval_df": wandb.Table(data=df_with_outputs)})
+    print_session_stats(options.result_cache)
     print("Evaluation complete!")
     return df_with_outputs
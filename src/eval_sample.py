@@ -2,9 +2,24 @@ import os
 import subprocess
 import tempfile
 
+from src.eval_batch import eval_batch
+from src.result_cache import environment_fingerprint, open_cache, result_key
+from src.sandbox import sandbox_env
+from src.scratch import scratch_dir
+from src.zygote import run_python
+
 
 def eval_sample(
-    example_id: int, env_path, code_dict: dict, strategy="pytest", coverage=False
+    example_id: int,
+    env_path,
+    code_dict: dict,
+    strategy="pytest",
+    coverage=False,
+    backend="subprocess",
+    batch=False,
+    cache=None,
+    scratch="disk",
+    timeout=120,
 ) -> dict:
     """
     Evaluate sample code using the specified strategy in the provided virtual environment.
@@ -28,6 +43,15 @@ def eval_sample(
         env_path (str): Path to the virtual environment to use for evaluation.
         code_dict (dict): A dictionary containing both the test file content and the code samples.
         strategy (str): Evaluation strategy to use (default is 'pytest'). Currently, only 'pytest' is supported.
+        backend (str): How the tests are run: 'subprocess' (a new interpreter per sample) or
+            'zygote' (a fork of a warm interpreter of the environment, see src/zygote.py).
+        batch (bool): Run all the samples in one pytest session (see src/eval_batch.py) instead of
+            one session per sample. Samples the batch cannot decide are run on their own.
+        cache (str): Path of a result cache (see src/result_cache.py). Samples that already ran
+            against the same test file in the same environment are not run again.
+        scratch (str): Scratch backend (see src/scratch.py): with any other than 'disk', the
+            temporary directories of the samples are created in tmpfs.
+        timeout (float): Timeout in seconds of each pytest run (see src/timeouts.py).
 
     Returns:
         dict: A dictionary containing the evaluation results with the following structure:
@@ -38,7 +62,8 @@ def eval_sample(
                         "code": <str>,
                         "output": <str>,   # Combined stdout and stderr from running the tests.
                         "pass": <bool>,    # True if tests passed (zero return code), otherwise False.
-                        "compile": <bool>  # True if the code compiled successfully; default is True.
+                        "compile": <bool>, # True if the code compiled successfully; default is True.
+                        "timeout": <bool>  # True if the tests did not finish within `timeout`.
                     },
                     "code_id2": { ... },
                     ...
@@ -63,14 +88,76 @@ def eval_sample(
     results = {"test_file": code_dict.get("test_file", ""), "codes": {}}
     test_file_content = code_dict.get("test_file", "")
     codes = code_dict.get("codes", {})
+    # point the libraries at the data prefetched into the environment
+    env = sandbox_env(env_path)
+
+    # reuse the results of the samples that already ran against this test file
+    result_cache = open_cache(cache) if not coverage else None
+    fingerprint = environment_fingerprint(env_path) if result_cache else None
+    batched = batch and strategy.lower() == "pytest" and not coverage
+    # batch outcomes have a shorter output than a pytest log: they are stored
+    # apart, and batched runs read both
+    keys, batch_keys = {}, {}
+    if fingerprint is not None and strategy.lower() == "pytest":
+        for code_id, content in codes.items():
+            parts = (str(example_id), content.get("code", ""), test_file_content)
+            keys[code_id] = result_key("pytest", fingerprint, *parts)
+            if batched:
+                batch_keys[code_id] = result_key("pytest-batch", fingerprint, *parts)
+                hit = result_cache.get(keys[code_id], batch_keys[code_id])
+            else:
+                hit = result_cache.get(keys[code_id])
+            if hit is not None:
+                results["codes"][code_id] = {
+                    "code": content.get("code", ""),
+                    "output": hit["output"],
+                    "pass": hit["passed"],
+                    "compile": hit["compiled"],
+                    "timeout": False,
+                }
+        keys = {
+            code_id: key
+            for code_id, key in keys.items()
+            if code_id not in results["codes"]
+        }
+        codes = {code_id: codes[code_id] for code_id in keys}
+    not_cacheable = set()
+    batch_results = {}
+
+    if batched and len(codes) > 1:
+        batch_results, left = eval_batch(
+            example_id,
+            env_path,
+            test_file_content,
+            {code_id: content.get("code", "") for code_id, content in codes.items()},
+            timeout=timeout,
+            backend=backend,
+            scratch=scratch,
+        )
+        for code_id, batch_result in batch_results.items():
+            results["codes"][code_id] = dict(
+                batch_result,
+                code=codes[code_id].get("code", ""),
+                compile=True,
+                timeout=batch_result.get("timeout", False),
+            )
+            if results["codes"][code_id]["timeout"]:
+                not_cacheable.add(code_id)
+        codes = {code_id: codes[code_id] for code_id in left}
 
     for code_id, content in codes.items():
         code = content.get("code", "")
-        sample_result = {"code": code, "output": "", "pass": False, "compile": True}
+        sample_result = {
+            "code": code,
+            "output": "",
+            "pass": False,
+            "compile": True,
+            "timeout": False,
+        }
 
         if strategy.lower() == "pytest":
             # Create a temporary directory to host the sample code and the test file
-            with tempfile.TemporaryDirectory() as temp_dir:
+            with tempfile.TemporaryDirectory(dir=scratch_dir(scratch)) as temp_dir:
                 # Write the sample code to a file
                 code_filepath = os.path.join(temp_dir, f"sample_{example_id}.py")
                 with open(code_filepath, "w") as f_code:
@@ -84,8 +171,7 @@ def eval_sample(
                 # Construct the python executable path from the virtual environment
                 python_executable = os.path.join(env_path, "bin", "python")
                 # Build the pytest command; using -q for quiet output, stopping at the first failure
-                cmd = [
-                    python_executable,
+                args = [
                     "-m",
                     "pytest",
                     "--disable-warnings",
@@ -94,12 +180,12 @@ def eval_sample(
                 ]
 
                 try:
-                    proc = subprocess.run(
-                        cmd,
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE,
-                        text=True,
-                        timeout=120,
+                    proc = run_python(
+                        python_executable,
+                        args,
+                        timeout=timeout,
+                        env=env,
+                        backend=backend,
                     )
                     sample_result["output"] = proc.stdout + proc.stderr
                     # A return code of 0 indicates that the tests passed.
@@ -108,9 +194,12 @@ def eval_sample(
                     print(f"Timeout expired: {e}")
                     sample_result["output"] = f"Timeout: {str(e)}"
                     sample_result["pass"] = False
+                    sample_result["timeout"] = True
+                    not_cacheable.add(code_id)
                 except Exception as e:
                     sample_result["output"] = f"Error: {str(e)}"
                     sample_result["pass"] = False
+                    not_cacheable.add(code_id)
 
                 # get coverage optionally
                 if coverage:
@@ -119,8 +208,7 @@ def eval_sample(
                     try:
                         # os.chdir(temp_dir)
                         # Run pytest with coverage
-                        cmd = [
-                            python_executable,
+                        args = [
                             "-m",
                             "pytest",
                             f"--cov=sample_{example_id}",
@@ -128,12 +216,12 @@ def eval_sample(
                             test_filepath,
                         ]
 
-                        proc = subprocess.run(
-                            cmd,
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE,
-                            text=True,
-                            timeout=120,
+                        proc = run_python(
+                            python_executable,
+                            args,
+                            timeout=timeout,
+                            env=env,
+                            backend=backend,
                         )
                         # print(proc.stdout)
                         # print(proc.stderr)
@@ -157,6 +245,25 @@ def eval_sample(
             sample_result["pass"] = False
 
         results["codes"][code_id] = sample_result
+    for code_id, key in keys.items():
+        if code_id in results["codes"] and code_id not in not_cacheable:
+            sample_result = results["codes"][code_id]
+            kind = "pytest-batch" if code_id in batch_results else "pytest"
+            result_cache.put(
+                batch_keys[code_id] if code_id in batch_results else key,
+                kind,
+                fingerprint,
+                sample_result["pass"],
+                sample_result["compile"],
+                sample_result["output"],
+            )
+
+    # keep the order of the input samples
+    results["codes"] = {
+        code_id: results["codes"][code_id]
+        for code_id in code_dict.get("codes", {})
+        if code_id in results["codes"]
+    }
     return results
 
 
@@ -0,0 +1,330 @@
+"""
+Persistent cache of execution results.
+
+Running the same candidate script against the same tests in the same
+environment always gives the same verdict, so re-running an evaluation
+(resuming a crashed run, re-scoring the same generations, greedy outputs
+repeated across CoT/RAG/self-debug runs) only needs to execute what it has
+not executed before. `ResultCache` stores pass/compile/output in SQLite,
+keyed by a hash of what was executed (see `result_key`) and of the lock of
+the environment (see `environment_fingerprint`), so rebuilding an
+environment with other packages invalidates its results by itself.
+Environments without a manifest are fingerprinted from the RECORDs of their
+installed distributions instead.
+
+Hit and miss counts are kept in memory and written once per process (by
+`print_session_stats`, or at exit), so lookups never write to the database.
+
+Timeouts are not cached: they depend on the load of the machine.
+
+    python -m src.result_cache stats --cache results.sqlite
+    python -m src.result_cache clear --cache results.sqlite [--env eval_venvs/gcham_venv_12] [--kind pytest]
+"""
+
+import atexit
+import glob
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from src.env_store import MANIFEST_FILE, read_manifest
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    key TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    passed INTEGER NOT NULL,
+    compiled INTEGER NOT NULL,
+    output TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS results_fingerprint ON results (fingerprint);
+CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL);
+"""
+
+_fingerprints = {}
+_local = threading.local()
+# caches opened by all the threads, for the statistics of the session
+_opened = []
+_opened_lock = threading.Lock()
+
+
+def installed_fingerprint(env_path):
+    """
+    Hash of the interpreter version (pyvenv.cfg) and of the RECORDs of the
+    distributions installed in an environment, or None if it has no site-packages.
+    """
+    site_dirs = sorted(
+        glob.glob(os.path.join(env_path, "lib", "python*", "site-packages"))
+    )
+    if not site_dirs:
+        return None
+    h = hashlib.sha256()
+    try:
+        with open(os.path.join(env_path, "pyvenv.cfg"), "rb") as f:
+            h.update(f.read())
+    except OSError:
+        pass
+    for site_dir in site_dirs:
+        for name in sorted(os.listdir(site_dir)):
+            if not name.endswith((".dist-info", ".egg-info")):
+                continue
+            h.update(b"\0" + name.encode("utf-8", errors="surrogateescape"))
+            try:
+                with open(os.path.join(site_dir, name, "RECORD"), "rb") as f:
+                    h.update(f.read())
+            except OSError:
+                pass
+    return h.hexdigest()
+
+
+def environment_fingerprint(env_path):
+    """
+    Hash of the interpreter version and `pip freeze` lock recorded in the
+    manifest of an environment, or of its installed distributions if it has
+    no manifest (see `installed_fingerprint`). None if it is neither.
+    """
+    env_path = os.path.realpath(env_path)
+    try:
+        mtime = os.path.getmtime(os.path.join(env_path, MANIFEST_FILE))
+    except OSError:
+        # installs and uninstalls add and remove dist-info directories
+        site_dirs = glob.glob(os.path.join(env_path, "lib", "python*", "site-packages"))
+        mtime = ("installed",) + tuple(sorted(os.path.getmtime(d) for d in site_dirs))
+        cached = _fingerprints.get(env_path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        fingerprint = installed_fingerprint(env_path)
+        _fingerprints[env_path] = (mtime, fingerprint)
+        return fingerprint
+    cached = _fingerprints.get(env_path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    manifest = read_manifest(env_path)
+    if manifest is None:
+        return None
+    fingerprint = hashlib.sha256(
+        json.dumps([manifest.get("python"), manifest.get("lock")]).encode("utf-8")
+    ).hexdigest()
+    _fingerprints[env_path] = (mtime, fingerprint)
+    return fingerprint
+
+
+def result_key(kind, fingerprint, *parts):
+    """Cache key of running `parts` (script, test file, ...) as `kind` in an environment."""
+    h = hashlib.sha256(f"{kind}\0{fingerprint}".encode("utf-8"))
+    for part in parts:
+        data = (part or "").encode("utf-8", errors="surrogatepass")
+        h.update(b"\0" + str(len(data)).encode() + b"\0" + data)
+    return h.hexdigest()
+
+
+class ResultCache:
+    """Execution results in the SQLite database `path`, safe to share between processes."""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(_SCHEMA)
+        # counts of this process, the database keeps the totals (see flush_counters)
+        self.hits = 0
+        self.misses = 0
+        self._flushed = {"hits": 0, "misses": 0}
+        self._key_hits = {}
+        self._lock = threading.Lock()
+
+    def flush_counters(self):
+        """Add the hits and misses counted since the last flush to the database."""
+        with self._lock:
+            counts = {
+                "hits": self.hits - self._flushed["hits"],
+                "misses": self.misses - self._flushed["misses"],
+            }
+            key_hits, self._key_hits = self._key_hits, {}
+            self._flushed = {"hits": self.hits, "misses": self.misses}
+        if not any(counts.values()) and not key_hits:
+            return
+        # its own connection: the one of the cache belongs to the thread that opened it
+        conn = sqlite3.connect(self.path, timeout=60)
+        try:
+            with conn:
+                conn.executemany(
+                    "INSERT INTO counters VALUES (?, ?) "
+                    "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+                    [(name, count) for name, count in counts.items() if count],
+                )
+                conn.executemany(
+                    "UPDATE results SET hits = hits + ? WHERE key = ?",
+                    [(count, key) for key, count in key_hits.items()],
+                )
+        finally:
+            conn.close()
+
+    def get(self, key, *fallback_keys):
+        """
+        The cached result of `key` (else of the first of `fallback_keys` that is
+        cached) as {"passed", "compiled", "output"}, or None. Counts one hit or miss.
+        """
+        for key in (key,) + fallback_keys:
+            row = self.conn.execute(
+                "SELECT passed, compiled, output FROM results WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None:
+                break
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._key_hits[key] = self._key_hits.get(key, 0) + 1
+        return {"passed": bool(row[0]), "compiled": bool(row[1]), "output": row[2]}
+
+    def put(self, key, kind, fingerprint, passed, compiled, output):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO results "
+            "(key, kind, fingerprint, passed, compiled, output, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (key, kind, fingerprint, int(passed), int(compiled), output, time.time()),
+        )
+
+    def stats(self):
+        """Number of cached results per kind, and the total hits and misses."""
+        kinds = dict(
+            self.conn.execute("SELECT kind, COUNT(*) FROM results GROUP BY kind")
+        )
+        counters = dict(self.conn.execute("SELECT name, value FROM counters"))
+        return {
+            "results": kinds,
+            "hits": counters.get("hits", 0),
+            "misses": counters.get("misses", 0),
+        }
+
+    def clear(self, fingerprint=None, kind=None):
+        """Delete the cached results (of one environment fingerprint and/or kind). Returns the count."""
+        conditions, params = [], []
+        if fingerprint is not None:
+            conditions.append("fingerprint = ?")
+            params.append(fingerprint)
+        if kind is not None:
+            conditions.append("kind = ?")
+            params.append(kind)
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        deleted = self.conn.execute(f"DELETE FROM results{where}", params).rowcount
+        if not conditions:
+            self.conn.execute("DELETE FROM counters")
+        return deleted
+
+
+def open_cache(path):
+    """The cache at `path` for this thread (SQLite connections are per thread), or None without a path."""
+    if not path:
+        return None
+    caches = getattr(_local, "caches", None)
+    if caches is None:
+        caches = _local.caches = {}
+    if path not in caches:
+        caches[path] = ResultCache(path)
+        with _opened_lock:
+            _opened.append(caches[path])
+    return caches[path]
+
+
+def cached_run(cache_path, kind, env_path, parts, run):
+    """
+    Return the result of `run()` ({"passed", "compiled", "output", ...}) for
+    executing `parts` as `kind` in `env_path`, from the cache at `cache_path` if
+    it has it. Results of runs that timed out (`"timeout": True`) are not stored.
+    """
+    cache = open_cache(cache_path)
+    fingerprint = environment_fingerprint(env_path) if cache is not None else None
+    if fingerprint is None:
+        return run()
+    key = result_key(kind, fingerprint, *parts)
+    result = cache.get(key)
+    if result is not None:
+        return result
+    result = run()
+    if not result.get("timeout"):
+        cache.put(
+            key,
+            kind,
+            fingerprint,
+            result["passed"],
+            result["compiled"],
+            result["output"],
+        )
+    return result
+
+
+def flush_counters():
+    """Write the hit and miss counts of all the caches of this process."""
+    with _opened_lock:
+        caches = list(_opened)
+    for cache in caches:
+        try:
+            cache.flush_counters()
+        except sqlite3.Error as e:
+            print(f"Could not write the counters of {cache.path}: {e}")
+
+
+atexit.register(flush_counters)
+
+
+def print_session_stats(cache_path):
+    """
+    Print the hit rate of the cache at `cache_path` in this process (all
+    threads), and write its counts to the database.
+    """
+    flush_counters()
+    with _opened_lock:
+        caches = [cache for cache in _opened if cache.path == cache_path]
+    hits = sum(cache.hits for cache in caches)
+    total = hits + sum(cache.misses for cache in caches)
+    if total:
+        print(f"Result cache: {hits}/{total} runs reused ({100 * hits / total:.1f}%)")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Inspect or clear the result cache.")
+    parser.add_argument("command", choices=["stats", "clear"])
+    parser.add_argument("--cache", required=True, help="Path of the SQLite cache.")
+    parser.add_argument(
+        "--env",
+        default=None,
+        help="clear only the results of this environment (e.g. eval_venvs/gcham_venv_12).",
+    )
+    parser.add_argument(
+        "--kind",
+        choices=["script", "pytest"],
+        default=None,
+        help="clear only the results of this kind of run.",
+    )
+    args = parser.parse_args()
+
+    cache = ResultCache(args.cache)
+    if args.command == "stats":
+        stats = cache.stats()
+        total = stats["hits"] + stats["misses"]
+        print(f"Cached results: {sum(stats['results'].values())}")
+        for kind, count in sorted(stats["results"].items()):
+            print(f"  {kind}: {count}")
+        print(
+            f"Lookups: {total}, hits: {stats['hits']}"
+            + (f" ({100 * stats['hits'] / total:.1f}%)" if total else "")
+        )
+    else:
+        fingerprint = None
+        if args.env:
+            fingerprint = environment_fingerprint(args.env)
+            assert fingerprint is not None, f"{args.env} is not an environment."
+        print(f"Deleted {cache.clear(fingerprint=fingerprint, kind=args.kind)} results")
@@ -0,0 +1,182 @@
+"""
+Process environment of the candidates run in an evaluation environment.
+
+Some examples fetch data at run time: nltk corpora (`nltk.download`,
+`nltk.data.find`), librosa example recordings (`librosa.ex`) and spaCy
+pipelines (`spacy.load`). `find_data_assets` lists the assets a row needs, the
+environment builder prefetches them into `<env>/gcham_data` (spaCy pipelines
+are pip packages and are installed into the environment itself), and
+`sandbox_env` points the libraries at that directory, so these examples run
+from local disk without network access.
+
+Candidates using torch, numpy/scipy, scikit-learn or lightgbm start BLAS and
+OpenMP thread pools as wide as the machine, in every one of the concurrent
+runs. `set_thread_budget` gives each run a budget of threads instead, which
+`sandbox_env` passes to the libraries, and can pin every run to CPUs of its
+own (`cpu_slot`). There is no budget unless one is asked for: the runs keep the
+defaults of the libraries, as they did before budgets existed.
+"""
+
+import atexit
+import contextlib
+import fcntl
+import os
+import re
+import shutil
+import tempfile
+
+DATA_DIR = "gcham_data"
+
+# asset kind -> (environment variable read by the library, subdirectory of DATA_DIR)
+data_dirs = {
+    "nltk": ("NLTK_DATA", "nltk_data"),
+    "librosa": ("LIBROSA_DATA_DIR", "librosa"),
+}
+
+_quoted = r"""['"]([^'"]+)['"]"""
+_nltk_download = re.compile(r"nltk\.download\(\s*" + _quoted)
+_nltk_download_list = re.compile(r"nltk\.download\(\s*[\[(]([^\])]*)[\])]")
+_nltk_resource = re.compile(r"nltk\.data\.(?:find|load)\(\s*" + _quoted)
+_librosa_example = re.compile(r"librosa\.(?:ex|example)\(\s*" + _quoted)
+_spacy_model = re.compile(r"spacy\.load\(\s*" + _quoted)
+_spacy_import = re.compile(r"^\s*import\s+([a-z]{2}_core_\w+)", re.MULTILINE)
+
+
+def _nltk_package(resource):
+    """nltk package of a resource path, e.g. tokenizers/punkt/english.pickle -> punkt."""
+    parts = resource.strip("/").split("/")
+    name = parts[1] if len(parts) > 1 else parts[0]
+    return re.sub(r"\.(zip|pickle)$", "", name)
+
+
+def find_data_assets(texts):
+    """
+    Data assets fetched at run time by the given sources (solutions, tests, ...).
+    Returns {"nltk": [...], "librosa": [...], "spacy": [...]} with sorted names.
+    """
+    assets = {"nltk": set(), "librosa": set(), "spacy": set()}
+    for text in texts:
+        if not isinstance(text, str):
+            continue
+        assets["nltk"].update(_nltk_download.findall(text))
+        for names in _nltk_download_list.findall(text):
+            assets["nltk"].update(re.findall(_quoted, names))
+        assets["nltk"].update(_nltk_package(r) for r in _nltk_resource.findall(text))
+        assets["librosa"].update(_librosa_example.findall(text))
+        assets["spacy"].update(
+            name
+            for name in _spacy_model.findall(text)
+            if re.fullmatch(r"[a-z]{2}_\w+", name)
+        )
+        assets["spacy"].update(_spacy_import.findall(text))
+    return {kind: sorted(names) for kind, names in assets.items()}
+
+
+def data_dir(env_path, kind=None):
+    """Data directory of an environment (of one asset kind if given)."""
+    path = os.path.join(os.path.realpath(env_path), DATA_DIR)
+    return os.path.join(path, data_dirs[kind][1]) if kind else path
+
+
+# environment variables sizing the thread pools of the libraries
+THREAD_VARS = [
+    "OMP_NUM_THREADS",  # OpenMP: torch, scikit-learn, lightgbm, ...
+    "MKL_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "BLIS_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+    "NUMBA_NUM_THREADS",
+    "TF_NUM_INTRAOP_THREADS",
+    "TF_NUM_INTEROP_THREADS",
+    "RAYON_NUM_THREADS",
+]
+
+# set by set_thread_budget in the environment of this process, so that the
+# worker processes of the evaluation (joblib) get them too
+THREADS_VAR = "GCHAM_SANDBOX_THREADS"
+CPU_SLOTS_VAR = "GCHAM_CPU_SLOTS"
+
+
+def available_cpus():
+    """CPUs this process may run on."""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def set_thread_budget(workers, threads=-1, pin=False):
+    """
+    Give every run of `workers` concurrent ones a budget of `threads` threads
+    (0: the CPUs of this process divided among the workers, -1: no budget).
+    With `pin`, every run is also pinned to `threads` CPUs of its own while it
+    runs (see cpu_slot); if more runs than that are running, the others are not pinned.
+    Pinning without a budget pins to the CPUs divided among the workers.
+    Returns the budget, None without one.
+    """
+    os.environ.pop(CPU_SLOTS_VAR, None)
+    if threads < 0 and pin:
+        threads = 0
+    if threads < 0:
+        os.environ.pop(THREADS_VAR, None)
+        return None
+    cpus = available_cpus()
+    if threads == 0:
+        threads = max(1, len(cpus) // max(1, workers))
+    os.environ[THREADS_VAR] = str(threads)
+    if pin:
+        # one lock file per slot, named after its CPUs
+        slots_dir = tempfile.mkdtemp(prefix="gcham_cpus_")
+        atexit.register(shutil.rmtree, slots_dir, ignore_errors=True)
+        for i in range(max(1, len(cpus) // threads)):
+            slot = cpus[i * threads : (i + 1) * threads]
+            open(os.path.join(slots_dir, ",".join(map(str, slot))), "w").close()
+        os.environ[CPU_SLOTS_VAR] = slots_dir
+    return threads
+
+
+@contextlib.contextmanager
+def cpu_slot():
+    """
+    Reserve free CPUs of the budget for one run, across the threads and the
+    processes of the evaluation (see set_thread_budget). Yields the list of
+    CPUs, or None without pinning or if all of them are taken.
+    """
+    slots_dir = os.environ.get(CPU_SLOTS_VAR)
+    try:
+        slots = sorted(os.listdir(slots_dir)) if slots_dir else []
+    except OSError:
+        slots = []
+    for slot in slots:
+        try:
+            f = open(os.path.join(slots_dir, slot), "r")
+        except OSError:
+            continue
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            continue
+        with f:
+            yield [int(cpu) for cpu in slot.split(",")]
+        return
+    yield None
+
+
+def sandbox_env(env_path, env=None):
+    """
+    Environment variables of a process run in the environment `env_path`:
+    `env` (by default this process's environment), with the libraries pointed
+    at the prefetched data of the environment, and their thread pools limited
+    to the budget of set_thread_budget.
+    """
+    env = dict(os.environ if env is None else env)
+    for kind, (variable, _) in data_dirs.items():
+        path = data_dir(env_path, kind)
+        if os.path.isdir(path):
+            env[variable] = path
+    threads = os.environ.get(THREADS_VAR)
+    if threads:
+        for variable in THREAD_VARS:
+            env[variable] = threads
+    return env
@@ -0,0 +1,154 @@
+"""
+Where candidate scripts live while they run.
+
+The "disk" backend writes every candidate to a file under --scratch and
+deletes it after the run, which on network filesystems (e.g. Compute Canada
+scratch) costs more metadata round trips than the run itself. The other
+backends keep the source off that filesystem:
+
+- "tmpfs": the file is written to a RAM-backed directory (/dev/shm) instead,
+  in a directory of its own so that it keeps its name.
+- "memfd": the source is held in an anonymous in-memory file
+  (os.memfd_create) that the interpreter inherits (`pass_fds`) and reads
+  through /proc/self/fd. A fork of a zygote (src/zygote.py) cannot inherit
+  it, so with the zygote exec backend these runs start new interpreters;
+  use "stdin" with zygotes.
+- "stdin": the source is piped to the interpreter on its stdin.
+
+For "memfd" and "stdin", the interpreter runs a small loader (`LOADER`) that
+compiles the source under the name the file would have had, so tracebacks
+still show that file name, the line numbers and the error; uncaught exceptions
+are printed without the source lines, which only the traceback module (through
+`__loader__`) can find. The script sees `__file__` set to that name, and the
+current directory instead of the script's directory as sys.path[0].
+
+Pytest runs (src/eval_sample.py, src/eval_batch.py) need real files to import;
+with any backend but "disk" their directories are created in tmpfs.
+"""
+
+import os
+import tempfile
+
+SCRATCH_BACKENDS = ["disk", "tmpfs", "memfd", "stdin"]
+
+TMPFS_DIRS = ["/dev/shm", "/run/shm"]
+
+LOADER = """
+import os, sys
+name, path = sys.argv[1], sys.argv[2]
+if path == "-":
+    source = sys.stdin.buffer.read().decode("utf-8")
+    sys.stdin = open(os.devnull)
+else:
+    with open(path, encoding="utf-8") as source_file:
+        source = source_file.read()
+sys.argv = [name] + sys.argv[3:]
+
+
+class Loader:
+    # linecache gets the source lines of tracebacks from here
+    def get_source(self, fullname):
+        return source
+
+
+try:
+    code = compile(source, name, "exec")
+    exec(code, {"__name__": "__main__", "__file__": name, "__loader__": Loader(),
+                "__builtins__": __builtins__})
+except SystemExit:
+    raise
+except BaseException as e:
+    # print it like a plain `python <file>` would, without the frame of this loader
+    # (the traceback module takes longer to import than most candidates take to run)
+    e.__traceback__ = e.__traceback__.tb_next
+    sys.__excepthook__(type(e), e, e.__traceback__)
+    sys.exit(1)
+"""
+
+
+def tmpfs_dir():
+    """A RAM-backed directory for scratch files, or the default temporary directory."""
+    for path in TMPFS_DIRS:
+        if os.path.isdir(path) and os.access(path, os.W_OK | os.X_OK):
+            return path
+    return tempfile.gettempdir()
+
+
+def scratch_dir(backend):
+    """Directory for the temporary directories of pytest runs (None: the default one)."""
+    return None if backend == "disk" else tmpfs_dir()
+
+
+class ScratchFile:
+    """
+    The source of a script stored by a scratch backend.
+    source: str, the code of the script
+    py_file: str, path of the script with the "disk" backend; its name is used by all the backends
+    """
+
+    def __init__(self, source, py_file, backend="disk"):
+        assert backend in SCRATCH_BACKENDS, f"Unknown scratch backend: {backend}"
+        if backend == "memfd" and not hasattr(os, "memfd_create"):
+            backend = "stdin"
+        self.source = source
+        self.backend = backend
+        self.name = py_file
+        self.path = None
+        self.dir = None
+        self.fd = None
+        if backend in ("disk", "tmpfs"):
+            self.path = py_file
+            if backend == "tmpfs":
+                # same file name as on disk, in tracebacks, logs and cached results
+                self.dir = tempfile.mkdtemp(prefix="gcham_", dir=tmpfs_dir())
+                self.path = os.path.join(self.dir, os.path.basename(py_file))
+            with open(self.path, "w") as f:
+                f.write(source)
+        elif backend == "memfd":
+            self.fd = os.memfd_create(os.path.basename(py_file))
+            os.write(self.fd, source.encode("utf-8"))
+
+    @classmethod
+    def on_disk(cls, source, py_file):
+        """The script `py_file`, already written with `source`."""
+        scratch_file = cls.__new__(cls)
+        scratch_file.source = source
+        scratch_file.backend = "disk"
+        scratch_file.name = scratch_file.path = py_file
+        scratch_file.dir = scratch_file.fd = None
+        return scratch_file
+
+    def args(self):
+        """Arguments of the interpreter to run the script."""
+        if self.path is not None:
+            return [self.path]
+        source_path = "-" if self.fd is None else f"/proc/self/fd/{self.fd}"
+        return ["-c", LOADER, self.name, source_path]
+
+    @property
+    def pass_fds(self):
+        """File descriptors the interpreter must inherit (see run_python)."""
+        return () if self.fd is None else (self.fd,)
+
+    @property
+    def input(self):
+        """What to write to the interpreter's stdin."""
+        return self.source if self.backend == "stdin" else None
+
+    def close(self):
+        try:
+            if self.path is not None:
+                os.remove(self.path)
+                if self.dir is not None:
+                    os.rmdir(self.dir)
+            elif self.fd is not None:
+                os.close(self.fd)
+        except OSError as e:
+            print(e)
+        self.path = self.dir = self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
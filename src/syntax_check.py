@@ -0,0 +1,169 @@
+"""
+In-memory syntax checks with the grammar of the target Python version.
+
+`run_script` used to call `py_compile.compile` on every candidate, which
+checked it with the grammar of the evaluation process's Python rather than
+the 3.7/3.9/3.10 of its environment, and wrote a .pyc next to it.
+`check_syntax` instead sends the source to a checker (src/syntax_server.py):
+one long-lived process per Python version, started with the interpreter of
+the first environment of that version, that compiles sources in memory.
+Requests that arrive while the checker is busy are sent to it together as
+one batch. The errors are worded like py_compile.PyCompileError.
+
+If a checker cannot be started or dies, sources are compiled in this process,
+as py_compile did.
+"""
+
+import atexit
+import json
+import os
+import subprocess
+import threading
+
+from src.syntax_server import check_source
+
+SERVER_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "syntax_server.py"
+)
+
+_checkers = {}
+_checkers_lock = threading.Lock()
+_failed = set()
+
+
+def python_version(python_executable):
+    """
+    "major.minor" of the environment of `python_executable` from its pyvenv.cfg,
+    or the real path of the interpreter if it is not a virtual environment.
+    """
+    env_path = os.path.dirname(os.path.dirname(python_executable))
+    try:
+        with open(os.path.join(env_path, "pyvenv.cfg"), "r") as f:
+            for line in f:
+                key, _, value = line.partition("=")
+                if key.strip() in ("version", "version_info"):
+                    return ".".join(value.strip().split(".")[:2])
+    except OSError:
+        pass
+    return os.path.realpath(python_executable)
+
+
+class SyntaxChecker:
+    """A checker process compiling sources with the interpreter `python_executable`."""
+
+    def __init__(self, python_executable):
+        with open(SERVER_FILE, "r") as f:
+            source = f.read()
+        self.process = subprocess.Popen(
+            [python_executable, "-I", "-c", source],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+            encoding="utf-8",
+        )
+        self.cond = threading.Condition()
+        # [request, error, done] of the requests waiting for the next batch
+        self.pending = []
+        self.closed = False
+        self.thread = threading.Thread(target=self._serve, daemon=True)
+        self.thread.start()
+
+    def alive(self):
+        return not self.closed and self.process.poll() is None
+
+    def _serve(self):
+        alive = True
+        while alive:
+            with self.cond:
+                while not self.pending and not self.closed:
+                    self.cond.wait()
+                batch, self.pending = self.pending, []
+                alive = not self.closed
+            errors = None
+            if alive:
+                try:
+                    self.process.stdin.write(
+                        json.dumps([entry[0] for entry in batch]) + "\n"
+                    )
+                    self.process.stdin.flush()
+                    errors = json.loads(self.process.stdout.readline())
+                except (OSError, ValueError):
+                    alive = False
+                    with self.cond:
+                        self.closed = True
+                        batch += self.pending
+                        self.pending = []
+            if errors is None:
+                # the checker is stopped or died, check here
+                errors = [check_source(**entry[0]) for entry in batch]
+            with self.cond:
+                for entry, error in zip(batch, errors):
+                    entry[1] = error
+                    entry[2] = True
+                self.cond.notify_all()
+
+    def check(self, source, filename):
+        """Error message of compiling `source` as `filename`, or None if it compiles."""
+        entry = [{"source": source, "filename": filename}, None, False]
+        with self.cond:
+            if self.closed:
+                return check_source(source, filename)
+            self.pending.append(entry)
+            self.cond.notify_all()
+            while not entry[2]:
+                self.cond.wait()
+        return entry[1]
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=10)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+
+
+def get_checker(python_executable):
+    """Checker of the Python version of `python_executable`, started if needed; None if it cannot start."""
+    version = python_version(python_executable)
+    with _checkers_lock:
+        if version in _failed:
+            return None
+        checker = _checkers.get(version)
+        if checker is not None and checker.alive():
+            return checker
+        try:
+            checker = SyntaxChecker(python_executable)
+        except OSError as e:
+            print(f"Checking the syntax of Python {version} in-process: {e}")
+            _failed.add(version)
+            return None
+        _checkers[version] = checker
+    return checker
+
+
+def close_checkers():
+    """Stop all the checkers of this process."""
+    with _checkers_lock:
+        checkers = list(_checkers.values())
+        _checkers.clear()
+    for checker in checkers:
+        checker.close()
+
+
+atexit.register(close_checkers)
+
+
+def check_syntax(python_executable, source, filename):
+    """
+    Check that `source` compiles with the Python version of `python_executable`.
+    Returns None if it does, else the error worded like py_compile.PyCompileError,
+    with `filename` as the name of the file.
+    """
+    checker = get_checker(python_executable)
+    if checker is None:
+        return check_source(source, filename)
+    return checker.check(source, filename)
@@ -0,0 +1,50 @@
+"""
+Syntax checker of one Python version (see src/syntax_check.py).
+
+Run with an interpreter of that version as
+    python -I -c <source of this file>
+It reads batches of sources from stdin, one JSON list per line:
+    [{"source": ..., "filename": ...}, ...]
+compiles them in memory, without writing .pyc files, and answers every batch
+with one JSON list on stdout: the error of each source (null if it compiles),
+worded like the message of py_compile.PyCompileError. It exits when its stdin
+is closed.
+
+This file is sent to interpreters from Python 3.7 on and only uses the standard library.
+"""
+
+import json
+import sys
+import traceback
+
+
+def check_source(source, filename):
+    """
+    Compile `source` like py_compile.compile(filename) would.
+    Returns None if it compiles, else the message of the PyCompileError.
+    """
+    try:
+        compile(
+            source.encode("utf-8", "surrogateescape"),
+            filename,
+            "exec",
+            dont_inherit=True,
+        )
+    except Exception as err:
+        if type(err) is SyntaxError:
+            message = "".join(traceback.format_exception_only(SyntaxError, err))
+            return message.replace('File "<string>"', 'File "%s"' % filename)
+        return "Sorry: %s: %s" % (type(err).__name__, err)
+    return None
+
+
+def main():
+    for line in sys.stdin:
+        batch = json.loads(line)
+        errors = [check_source(req["source"], req["filename"]) for req in batch]
+        sys.stdout.write(json.dumps(errors) + "\n")
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,275 @@
+"""
+Per-example timeouts calibrated from the reference solutions.
+
+Candidates used to run under fixed timeouts (60 s for the visible tests in
+src/eval_code.py, 120 s elsewhere): an infinite loop in a candidate of a fast
+sympy example held a core for two minutes, while a slow librosa example got no
+more headroom than the others. The calibration pass times the ground-truth
+solution of every example against its hidden tests (pytest, as eval_sample
+runs them) and its visible test (a script, as run_script runs it), and stores
+these reference runtimes in `<base_path>/reference_runtimes.json`:
+
+    {
+        "12": {
+            "hidden": {"seconds": 2.31, "passed": true},
+            "visible": {"seconds": 0.84, "passed": true},
+            "measured_at": "2025-06-01T12:00:00"
+        },
+        ...
+    }
+
+`Timeouts` turns them into the timeout of each run: `multiplier` times the
+reference runtime, and at least `floor` seconds. Examples whose reference
+solution was not measured, or did not pass, keep the fixed timeout.
+
+    python -m src.timeouts calibrate dataset/final_fix_dataset.jsonl eval_venvs dataset/solutions/tests --jobs 4
+    python -m src.timeouts show eval_venvs
+"""
+
+import fcntl
+import json
+import os
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from tqdm import tqdm
+
+from src.env_cache import use_environment
+from src.eval_sample import eval_sample
+from src.sandbox import sandbox_env
+from src.zygote import run_python
+
+REFERENCE_FILE = "reference_runtimes.json"
+
+DEFAULT_MULTIPLIER = 5.0
+DEFAULT_FLOOR = 10.0
+
+# timeout of the reference solutions themselves
+CALIBRATION_TIMEOUT = 600
+
+
+def load_reference_runtimes(base_path):
+    """Reference runtimes of the examples of `base_path` ({example_id: ...}), empty if never calibrated."""
+    try:
+        with open(os.path.join(base_path, REFERENCE_FILE), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def update_reference_runtimes(base_path, runtimes):
+    """
+    Add the reference runtimes `runtimes` ({example_id: ...}) to the file of
+    `base_path`. The file is locked while it is rewritten, like the store index.
+    """
+    path = os.path.join(base_path, REFERENCE_FILE)
+    with open(f"{path}.lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        stored = load_reference_runtimes(base_path)
+        stored.update({str(example_id): r for example_id, r in runtimes.items()})
+        tmp_path = f"{path}.tmp.{os.getpid()}.{threading.get_ident()}"
+        with open(tmp_path, "w") as f:
+            json.dump(stored, f, indent=4, sort_keys=True)
+        os.replace(tmp_path, path)
+    return stored
+
+
+class Timeouts:
+    """
+    Timeouts of the runs of each example: `multiplier` times the reference
+    runtime of the example (see the module docstring), at least `floor` seconds.
+    """
+
+    def __init__(
+        self, runtimes=None, multiplier=DEFAULT_MULTIPLIER, floor=DEFAULT_FLOOR
+    ):
+        self.runtimes = runtimes or {}
+        self.multiplier = multiplier
+        self.floor = floor
+
+    @classmethod
+    def load(cls, base_path, multiplier=DEFAULT_MULTIPLIER, floor=DEFAULT_FLOOR):
+        runtimes = load_reference_runtimes(base_path)
+        print(f"Reference runtimes of {len(runtimes)} examples from {base_path}")
+        return cls(runtimes, multiplier, floor)
+
+    def get(self, example_id, kind, default):
+        """
+        Timeout in seconds of a run of `kind` ("hidden" or "visible") of an
+        example, `default` if its reference solution has no passing runtime.
+        """
+        reference = self.runtimes.get(str(example_id), {}).get(kind)
+        if not reference or not reference.get("passed"):
+            return default
+        return round(max(self.floor, self.multiplier * reference["seconds"]), 2)
+
+
+def time_hidden(example_id, env_path, code, test_file_content, backend, repeats):
+    """Slowest of `repeats` runs of the hidden tests against `code`, and whether they all passed."""
+    code_dict = {"test_file": test_file_content, "codes": {"reference": {"code": code}}}
+    seconds, passed = 0.0, True
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = eval_sample(
+            example_id,
+            env_path,
+            code_dict,
+            backend=backend,
+            timeout=CALIBRATION_TIMEOUT,
+        )["codes"]["reference"]
+        seconds = max(seconds, time.perf_counter() - start)
+        passed = passed and result["pass"]
+    return {"seconds": round(seconds, 3), "passed": passed}
+
+
+def time_visible(env_path, code, backend, repeats):
+    """Slowest of `repeats` runs of the script `code`, and whether they all passed."""
+    python_executable = os.path.join(env_path, "bin", "python")
+    seconds, passed = 0.0, True
+    with tempfile.TemporaryDirectory() as temp_dir:
+        py_file = os.path.join(temp_dir, "reference.py")
+        with open(py_file, "w") as f:
+            f.write(code)
+        for _ in range(repeats):
+            start = time.perf_counter()
+            try:
+                result = run_python(
+                    python_executable,
+                    [py_file],
+                    timeout=CALIBRATION_TIMEOUT,
+                    env=sandbox_env(env_path),
+                    backend=backend,
+                )
+                passed = passed and result.returncode == 0
+            except subprocess.TimeoutExpired:
+                passed = False
+            seconds = max(seconds, time.perf_counter() - start)
+    return {"seconds": round(seconds, 3), "passed": passed}
+
+
+def calibrate_example(row, base_path, test_dir, backend="subprocess", repeats=1):
+    """
+    Time the reference solution of a dataset row against its hidden tests
+    (`<test_dir>/test_sample_<example_id>.py`) and its visible test.
+    Returns its reference runtimes, None if its environment is missing.
+    """
+    example_id = int(row["example_id"])
+    code = row.get("starting_code", "") + row.get("solution", "")
+    with use_environment(base_path, f"gcham_venv_{example_id}") as env_path:
+        if not os.path.exists(os.path.join(env_path, "bin", "python")):
+            print(f"No environment for example {example_id}, not calibrated")
+            return None
+        runtimes = {"measured_at": time.strftime("%Y-%m-%dT%H:%M:%S")}
+        test_file_path = os.path.join(test_dir, f"test_sample_{example_id}.py")
+        if os.path.exists(test_file_path):
+            with open(test_file_path, "r") as tf:
+                test_file_content = tf.read()
+            runtimes["hidden"] = time_hidden(
+                example_id, env_path, code, test_file_content, backend, repeats
+            )
+        if row.get("test"):
+            runtimes["visible"] = time_visible(
+                env_path, code + "\n" + row["test"], backend, repeats
+            )
+    return runtimes
+
+
+def calibrate(rows, base_path, test_dir, jobs=1, backend="subprocess", repeats=1):
+    """
+    Measure and store the reference runtimes of the dataset `rows` with `jobs`
+    concurrent examples. Returns {example_id: reference runtimes}.
+    """
+    runtimes = {}
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {
+            executor.submit(
+                calibrate_example, row, base_path, test_dir, backend, repeats
+            ): str(row["example_id"])
+            for row in rows
+        }
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            result = future.result()
+            if result is not None:
+                runtimes[futures[future]] = result
+    update_reference_runtimes(base_path, runtimes)
+    return runtimes
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Measure or show the reference runtimes of the examples."
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    calibrate_parser = subparsers.add_parser(
+        "calibrate", help="Time the reference solutions against their tests."
+    )
+    calibrate_parser.add_argument("data_file", help="Dataset JSONL file.")
+    calibrate_parser.add_argument("env_dir", help="Directory of the environments.")
+    calibrate_parser.add_argument("test_dir", help="Directory of the hidden tests.")
+    calibrate_parser.add_argument(
+        "--jobs", type=int, default=1, help="Examples timed at the same time."
+    )
+    calibrate_parser.add_argument(
+        "--repeats", type=int, default=1, help="Runs of each test, the slowest is kept."
+    )
+    calibrate_parser.add_argument(
+        "--exec-backend", choices=["subprocess", "zygote"], default="subprocess"
+    )
+    calibrate_parser.add_argument(
+        "--examples", nargs="+", default=None, help="Only calibrate these example ids."
+    )
+    show_parser = subparsers.add_parser(
+        "show", help="Print the reference runtimes and the timeouts they give."
+    )
+    show_parser.add_argument("env_dir", help="Directory of the environments.")
+    show_parser.add_argument("--multiplier", type=float, default=DEFAULT_MULTIPLIER)
+    show_parser.add_argument("--floor", type=float, default=DEFAULT_FLOOR)
+    args = parser.parse_args()
+
+    if args.command == "calibrate":
+        with open(args.data_file, "r", encoding="utf-8") as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+        if args.examples:
+            rows = [row for row in rows if str(row["example_id"]) in args.examples]
+        runtimes = calibrate(
+            rows,
+            args.env_dir,
+            args.test_dir,
+            jobs=args.jobs,
+            backend=args.exec_backend,
+            repeats=args.repeats,
+        )
+        failed = [
+            example_id
+            for example_id, r in runtimes.items()
+            if any(not r[kind]["passed"] for kind in ("hidden", "visible") if kind in r)
+        ]
+        print(f"Calibrated {len(runtimes)}/{len(rows)} examples")
+        if failed:
+            print(
+                f"Reference solutions failing (fixed timeouts kept): {sorted(failed, key=int)}"
+            )
+    else:
+        timeouts = Timeouts(
+            load_reference_runtimes(args.env_dir), args.multiplier, args.floor
+        )
+        print(
+            f"{'example':>8} {'hidden s':>9} {'timeout':>8} {'visible s':>10} {'timeout':>8}"
+        )
+        for example_id in sorted(timeouts.runtimes, key=int):
+            r = timeouts.runtimes[example_id]
+            columns = []
+            for kind in ("hidden", "visible"):
+                reference = r.get(kind)
+                seconds = f"{reference['seconds']:.2f}" if reference else "-"
+                if reference and not reference["passed"]:
+                    seconds += "!"
+                columns += [seconds, timeouts.get(example_id, kind, "-")]
+            print(
+                f"{example_id:>8} {columns[0]:>9} {columns[1]:>8} {columns[2]:>10} {columns[3]:>8}"
+            )
@@ -7,6 +7,8 @@ from typing import Dict, Iterable
 import pandas as pd
 from tqdm import tqdm
 
+from src.capture import decompress_log
+
 
 def write_jsonl(
     filename: str, data: Iterable[Dict], append: bool = False, drop_builtin: bool = True
@@ -168,7 +170,8 @@ Please start with the following markdown code block:
 def generate_prompt(model_name, example, df_idx, sample_idx):
     base_model_name = model_name.split("/")[-1]
     parsed_code = example[f"parsed_code_{sample_idx}"]
-    error_log = example[f"error_log_{sample_idx}"]
+    # logs of evaluations run with --compress-logs
+    error_log = decompress_log(example[f"error_log_{sample_idx}"])
     # task_id is index of the example
     task_id = df_idx
     # print(type(parsed_code), type(error_log))
@@ -0,0 +1,210 @@
+"""
+Warm pre-forked interpreters for running candidates.
+
+Every candidate used to start a new interpreter of its environment, which then
+imported the library (torch, librosa, sympy, ...) and pytest from scratch.
+With the "zygote" backend, `run_python` instead keeps one long-lived process
+per environment, the zygote (src/zygote_server.py), with the library of the
+environment (from its manifest) and pytest already imported. Each run is a
+fresh fork of it: candidates are isolated from each other as with separate
+interpreters, but skip the imports.
+
+Zygotes are started on first use, one per environment and process environment
+(`env`, whose thread variables the preloaded libraries read when they are
+imported), at most `MAX_ZYGOTES` per evaluation process (least recently used
+ones are stopped). If a zygote cannot be started, runs fall back to plain
+subprocesses.
+"""
+
+import atexit
+import json
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+from collections import OrderedDict
+
+from src.capture import output_limit, run_captured
+from src.env_store import read_manifest
+from src.sandbox import cpu_slot
+
+EXEC_BACKENDS = ["subprocess", "zygote"]
+
+MAX_ZYGOTES = 8
+
+SERVER_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "zygote_server.py"
+)
+
+_zygotes = OrderedDict()
+_zygotes_lock = threading.Lock()
+_start_locks = {}
+_failed = set()
+
+
+class Zygote:
+    """A zygote process serving the interpreter `python_executable`."""
+
+    def __init__(self, python_executable, modules, env=None):
+        self.python_executable = python_executable
+        self.dir = tempfile.mkdtemp(prefix="gcham_zygote_")
+        self.socket_path = os.path.join(self.dir, "socket")
+        with open(SERVER_FILE, "r") as f:
+            source = f.read()
+        self.process = subprocess.Popen(
+            [python_executable, "-c", source, self.socket_path] + modules,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            env=env,
+            text=True,
+        )
+        if self.process.stdout.readline().strip() != "ready":
+            self.close()
+            raise RuntimeError(f"Zygote of {python_executable} did not start")
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def run(self, args, cwd=None, timeout=None, input=None, cpus=None):
+        """Run `python <args>` in a fork of the zygote (on `cpus` if given), like `subprocess.run`."""
+        command = [self.python_executable] + list(args)
+        request = {
+            "args": list(args),
+            "cwd": cwd or os.getcwd(),
+            "timeout": timeout,
+            "input": input,
+            "cpus": cpus,
+            "limit": output_limit(),
+        }
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+            conn.connect(self.socket_path)
+            conn.sendall(json.dumps(request).encode("utf-8") + b"\n")
+            data = b"".join(iter(lambda: conn.recv(1 << 16), b""))
+        response = json.loads(data.decode("utf-8"))
+        if response["timeout"]:
+            expired = subprocess.TimeoutExpired(
+                command, timeout, output=response["stdout"], stderr=response["stderr"]
+            )
+            expired.output_bytes = tuple(response["output_bytes"])
+            raise expired
+        completed = subprocess.CompletedProcess(
+            command, response["returncode"], response["stdout"], response["stderr"]
+        )
+        completed.output_bytes = tuple(response["output_bytes"])
+        return completed
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=10)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+def preload_modules(env_path):
+    """Modules a zygote imports: the library of the environment and pytest."""
+    manifest = read_manifest(env_path) or {}
+    module = (manifest.get("import_times") or {}).get("module")
+    return [module, "pytest"] if module else ["pytest"]
+
+
+def get_zygote(python_executable, env=None):
+    """
+    Zygote of the environment of `python_executable` with the process
+    environment `env`, started if needed; None if it cannot start.
+    """
+    env_path = os.path.realpath(os.path.dirname(os.path.dirname(python_executable)))
+    key = (env_path, None if env is None else tuple(sorted(env.items())))
+    with _zygotes_lock:
+        if env_path in _failed:
+            return None
+        start_lock = _start_locks.setdefault(key, threading.Lock())
+    with start_lock:
+        with _zygotes_lock:
+            zygote = _zygotes.get(key)
+            if zygote is not None and zygote.alive():
+                _zygotes.move_to_end(key)
+                return zygote
+        try:
+            zygote = Zygote(python_executable, preload_modules(env_path), env=env)
+        except (OSError, RuntimeError) as e:
+            print(f"Running {env_path} without a zygote: {e}")
+            with _zygotes_lock:
+                _failed.add(env_path)
+            return None
+        with _zygotes_lock:
+            _zygotes[key] = zygote
+            stopped = []
+            while len(_zygotes) > MAX_ZYGOTES:
+                stopped.append(_zygotes.popitem(last=False)[1])
+    for old in stopped:
+        old.close()
+    return zygote
+
+
+def close_zygotes():
+    """Stop all the zygotes of this process."""
+    with _zygotes_lock:
+        zygotes = list(_zygotes.values())
+        _zygotes.clear()
+    for zygote in zygotes:
+        zygote.close()
+
+
+atexit.register(close_zygotes)
+
+
+def run_python(
+    python_executable,
+    args,
+    timeout=None,
+    env=None,
+    cwd=None,
+    backend="subprocess",
+    input=None,
+    pass_fds=(),
+):
+    """
+    Run `python_executable <args>` and capture its output as text, like
+    `subprocess.run(..., capture_output=True, text=True)`: returns a
+    CompletedProcess and raises subprocess.TimeoutExpired on timeout.
+    Only the first and last bytes of long outputs are kept (see src/capture.py).
+    `input` is written to its stdin, as with `subprocess.run`.
+    `backend` is "subprocess" (a new interpreter) or "zygote" (a fork of the
+    warm zygote of the environment). Runs that must inherit the file
+    descriptors `pass_fds` always start a new interpreter: the forks of a
+    zygote do not see the descriptors of this process.
+    With CPU pinning (see src/sandbox.py), the run is pinned to free CPUs.
+    """
+    with cpu_slot() as cpus:
+        if backend == "zygote" and not pass_fds:
+            zygote = get_zygote(python_executable, env=env)
+            if zygote is not None:
+                try:
+                    return zygote.run(
+                        args, cwd=cwd, timeout=timeout, input=input, cpus=cpus
+                    )
+                except (OSError, ValueError) as e:
+                    print(
+                        f"Zygote of {python_executable} failed, running without it: {e}"
+                    )
+        command = [python_executable] + list(args)
+        preexec_fn = None
+        if cpus is not None:
+            if shutil.which("taskset"):
+                command = ["taskset", "-c", ",".join(map(str, cpus))] + command
+            else:
+                preexec_fn = lambda: os.sched_setaffinity(0, cpus)
+        return run_captured(
+            command,
+            timeout=timeout,
+            env=env,
+            cwd=cwd,
+            input=input,
+            preexec_fn=preexec_fn,
+            pass_fds=pass_fds,
+        )
@@ -0,0 +1,283 @@
+"""
+Zygote of an evaluation environment (see src/zygote.py).
+
+Run with the interpreter of the environment as
+    python -c <source of this file> <socket path> <module> ...
+It imports the given modules once, prints "ready", then serves requests on the
+Unix socket: for every connection it forks a supervisor, which forks a runner
+that executes the request like `python <args>` would, in a fresh copy of the
+warm interpreter, and sends back its return code and output (its first and
+last bytes past the "limit" of the request, see src/capture.py). The zygote exits
+when its stdin is closed, i.e. when the process that started it is gone.
+
+This file is sent to interpreters from Python 3.7 on and only uses the standard library.
+"""
+
+import atexit
+import json
+import os
+import runpy
+import select
+import selectors
+import signal
+import socket
+import sys
+import threading
+import traceback
+
+
+def _print_exception(e):
+    # skip the frames of `run` and of runpy, like a plain `python <args>` traceback
+    tb = e.__traceback__.tb_next
+    while tb is not None and os.path.basename(tb.tb_frame.f_code.co_filename) in (
+        "runpy.py",
+        "<frozen runpy>",
+    ):
+        tb = tb.tb_next
+    traceback.print_exception(type(e), e, tb)
+
+
+def run(request):
+    """Execute a request in the runner process and exit with its return code."""
+    # own process group (the supervisor sets it too, whichever runs first)
+    try:
+        os.setpgid(0, 0)
+    except OSError:
+        pass
+    args = request["args"]
+    code = 0
+    try:
+        if request.get("cpus"):
+            os.sched_setaffinity(0, request["cpus"])
+        if request.get("cwd"):
+            os.chdir(request["cwd"])
+        if args[0] == "-c":
+            sys.argv = ["-c"] + args[2:]
+            sys.path[0] = ""
+            code_globals = {"__name__": "__main__", "__builtins__": __builtins__}
+            exec(compile(args[1], "<string>", "exec"), code_globals)
+        elif args[0] == "-m":
+            sys.argv = [args[1]] + args[2:]
+            sys.path[0] = os.getcwd()
+            runpy.run_module(args[1], run_name="__main__", alter_sys=True)
+        else:
+            sys.argv = list(args)
+            sys.path[0] = os.path.dirname(os.path.abspath(args[0]))
+            runpy.run_path(args[0], run_name="__main__")
+        if hasattr(threading, "_shutdown"):
+            threading._shutdown()
+    except SystemExit as e:
+        if e.code is None:
+            code = 0
+        elif isinstance(e.code, int):
+            code = e.code
+        else:
+            sys.stderr.write(str(e.code) + "\n")
+            code = 1
+    except BaseException as e:
+        _print_exception(e)
+        code = 1
+    try:
+        atexit._run_exitfuncs()
+        sys.stdout.flush()
+        sys.stderr.flush()
+    finally:
+        os._exit(code & 0xFF)
+
+
+class Output:
+    """
+    The first and last bytes of an output of a runner, out of `limit` bytes in
+    all (0: everything). A copy of src/capture.py BoundedBuffer (this file
+    cannot import from src/); keep both in sync.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.head_size = limit // 4
+        self.tail_size = limit - self.head_size
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.total = 0
+
+    def write(self, data):
+        self.total += len(data)
+        if not self.limit:
+            self.head += data
+            return
+        if len(self.head) < self.head_size:
+            n = self.head_size - len(self.head)
+            self.head += data[:n]
+            data = data[n:]
+        self.tail += data
+        if len(self.tail) > self.tail_size:
+            del self.tail[: len(self.tail) - self.tail_size]
+
+    def getvalue(self):
+        omitted = self.total - len(self.head) - len(self.tail)
+        if omitted <= 0:
+            return _decode(bytes(self.head + self.tail))
+        head, tail = _utf8_boundaries(bytes(self.head), bytes(self.tail))
+        omitted = self.total - len(head) - len(tail)
+        return (
+            _decode(head)
+            + "\n[... %d bytes omitted, %d bytes in total ...]\n"
+            % (omitted, self.total)
+            + _decode(tail)
+        )
+
+
+def _utf8_boundaries(head, tail):
+    # copy of src/capture.py utf8_boundaries
+    end = len(head)
+    for i in range(len(head) - 1, max(len(head) - 4, -1), -1):
+        byte = head[i]
+        if byte & 0xC0 != 0x80:
+            if byte >= 0xC0:
+                length = 2 if byte < 0xE0 else 3 if byte < 0xF0 else 4
+                if len(head) - i < length:
+                    end = i
+            break
+    start = 0
+    while start < min(3, len(tail)) and tail[start] & 0xC0 == 0x80:
+        start += 1
+    return head[:end], tail[start:]
+
+
+def _decode(data):
+    text = data.decode("utf-8", errors="replace")
+    return text.replace("\r\n", "\n").replace("\r", "\n")
+
+
+def supervise(conn):
+    """Run one request in a runner process and send back its result."""
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    with conn.makefile("rb") as f:
+        request = json.loads(f.readline().decode("utf-8"))
+    out_read, out_write = os.pipe()
+    err_read, err_write = os.pipe()
+    stdin_read, stdin_write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        conn.close()
+        for fd in (out_read, err_read, stdin_write):
+            os.close(fd)
+        os.dup2(stdin_read, 0)
+        os.dup2(out_write, 1)
+        os.dup2(err_write, 2)
+        run(request)
+    # before the timer is armed, so that killpg always finds the group
+    try:
+        os.setpgid(pid, pid)
+    except OSError:
+        pass
+    for fd in (stdin_read, out_write, err_write):
+        os.close(fd)
+
+    timed_out = []
+
+    def kill(signum, frame):
+        timed_out.append(True)
+        try:
+            os.killpg(pid, signal.SIGKILL)
+        except OSError:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+    if request.get("timeout"):
+        signal.signal(signal.SIGALRM, kill)
+        signal.setitimer(signal.ITIMER_REAL, request["timeout"])
+    signal.signal(signal.SIGPIPE, signal.SIG_IGN)
+    # read the outputs through bounded buffers while feeding the input, if any
+    outputs = {
+        out_read: Output(request.get("limit") or 0),
+        err_read: Output(request.get("limit") or 0),
+    }
+    pending = (request.get("input") or "").encode("utf-8")
+    selector = selectors.DefaultSelector()
+    for fd in outputs:
+        selector.register(fd, selectors.EVENT_READ)
+    if pending:
+        selector.register(stdin_write, selectors.EVENT_WRITE)
+    else:
+        os.close(stdin_write)
+    status = None
+    while selector.get_map():
+        events = selector.select(0.1)
+        if not events and (status is not None or timed_out):
+            # the runner is gone, but something it started still holds the pipes
+            break
+        for key, _ in events:
+            if key.fd in outputs:
+                data = os.read(key.fd, 1 << 16)
+                if data:
+                    outputs[key.fd].write(data)
+                    continue
+            else:
+                try:
+                    pending = pending[os.write(key.fd, pending[: select.PIPE_BUF]) :]
+                except OSError:
+                    pending = b""
+                if pending:
+                    continue
+            selector.unregister(key.fd)
+            os.close(key.fd)
+        if status is None:
+            reaped, reaped_status = os.waitpid(pid, os.WNOHANG)
+            if reaped:
+                status = reaped_status
+    selector.close()
+    if status is None:
+        _, status = os.waitpid(pid, 0)
+    signal.setitimer(signal.ITIMER_REAL, 0)
+    if os.WIFEXITED(status):
+        returncode = os.WEXITSTATUS(status)
+    else:
+        returncode = -os.WTERMSIG(status)
+    response = {
+        "stdout": outputs[out_read].getvalue(),
+        "stderr": outputs[err_read].getvalue(),
+        "output_bytes": [outputs[out_read].total, outputs[err_read].total],
+        "returncode": returncode,
+        "timeout": bool(timed_out),
+    }
+    conn.sendall(json.dumps(response).encode("utf-8"))
+    conn.close()
+
+
+def main():
+    socket_path, modules = sys.argv[1], sys.argv[2:]
+    sys.argv = [""]
+    for module in modules:
+        try:
+            __import__(module)
+        except Exception:
+            pass
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(socket_path)
+    listener.listen(128)
+    # supervisors are reaped automatically
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    sys.stdout.write("ready\n")
+    sys.stdout.flush()
+    while True:
+        readable = select.select([listener, sys.stdin], [], [])[0]
+        if sys.stdin in readable:
+            break
+        conn, _ = listener.accept()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        if os.fork() == 0:
+            listener.close()
+            try:
+                supervise(conn)
+            finally:
+                os._exit(0)
+        conn.close()
+    listener.close()
+
+
+if __name__ == "__main__":
+    main()
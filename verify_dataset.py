@@ -4,6 +4,7 @@ import os
 import argparse
 from tqdm import tqdm
 import pandas as pd
+from src.env_store import resolve_env_path
 from src.eval_sample import eval_sample
 
 
@@ -43,7 +44,7 @@ def main():
             example_id = int(example_id)
             code = record.get("starting_code", "")
             solution = record.get("solution", "")
-            env_path = os.path.join(args.env_dir, f"gcham_venv_{example_id}")
+            env_path = resolve_env_path(args.env_dir, f"gcham_venv_{example_id}")
 
             # Locate the matching test file
             test_file_path = os.path.join(args.test_dir, f"test_sample_{example_id}.py")